@@ -0,0 +1,88 @@
+"""Compare `sum_counts` (used to sum counts when combining and counting
+a lab's data) with the `groupby` it replaced, on synthetic rows of
+test results.
+
+    PYTHONPATH=. python benchmarks/aggregation.py [rows ...]
+
+Each size of input (default 10000000 rows; 100000000 rows needs about
+10GB of memory, and 500000000 about 50GB) has a dummy `count` of 1 for
+each row, as when intermediate files aren't aggregated. Both
+implementations must give the same counts before their time and peak
+memory (as traced by `tracemalloc`) are reported.
+
+"""
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from lib import settings
+from lib.aggregation import sum_counts
+
+KEYS = ["month", "test_code", "practice_id", "result_category"]
+
+
+def synthetic_rows(rows):
+    state = np.random.RandomState(0)
+    categories = {
+        "month": settings.INTERMEDIATE_OUTPUT_DTYPES["month"].categories,
+        "test_code": ["TEST{}".format(i) for i in range(1000)],
+        "practice_id": ["P{:05d}".format(i) for i in range(8000)],
+        "result_category": settings.INTERMEDIATE_OUTPUT_DTYPES[
+            "result_category"
+        ].categories,
+    }
+    df = pd.DataFrame(
+        {
+            key: pd.Categorical.from_codes(state.randint(0, len(values), rows), values)
+            for key, values in categories.items()
+        }
+    )
+    df["count"] = 1
+    return df
+
+
+def groupby(df, keys):
+    """The original implementation"""
+    return df.groupby(keys, observed=True)["count"].sum().reset_index()
+
+
+def in_order(df):
+    order = np.lexsort([df[key].cat.codes for key in reversed(KEYS)])
+    return df.iloc[order].reset_index(drop=True)
+
+
+def measure(function, df):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = function(df, KEYS)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def main(sizes):
+    for rows in sizes:
+        df = synthetic_rows(rows)
+        size = df.memory_usage(deep=True).sum()
+        legacy, legacy_time, legacy_peak = measure(groupby, df)
+        kernel, kernel_time, kernel_peak = measure(sum_counts, df)
+        assert in_order(legacy).equals(kernel)
+        print("{} rows ({:.0f}MB)".format(rows, size / 1e6))
+        for name, elapsed, peak in [
+            ("groupby", legacy_time, legacy_peak),
+            ("sum_counts", kernel_time, kernel_peak),
+        ]:
+            print(
+                "{}: {:.2f}s, peak {:.0f}MB ({:.1f}x the data)".format(
+                    name, elapsed, peak / 1e6, peak / size
+                )
+            )
+        del df, legacy, kernel
+
+
+if __name__ == "__main__":
+    main([int(rows) for rows in sys.argv[1:]] or [10000000])
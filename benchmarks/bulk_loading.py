@@ -0,0 +1,101 @@
+"""Compare reading intermediate files with `iter_intermediate_files`
+and concatenating them once (as `combine_and_append_csvs` does) with
+the loop of `concat`s it replaced, for a year of synthetic monthly
+intermediate CSVs.
+
+    PYTHONPATH=. python benchmarks/bulk_loading.py [files] [rows]
+
+There are `files` files (default 24) of `rows` rows each (default
+200000). Both implementations must give the same counts before their
+times are reported.
+
+"""
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from lib import settings
+from lib.bulk_loading import iter_intermediate_files
+from lib.intermediate_format import concat_intermediate
+
+
+def legacy_combine_csvs_to_dataframe(csv_filenames, dtypes):
+    """The original implementation"""
+    unmerged = pd.read_csv(io.StringIO(""), names=dtypes.keys(), dtype=dtypes)
+    for filename in csv_filenames:
+        unmerged = pd.concat(
+            [unmerged, pd.read_csv(filename, na_filter=False, dtype=dtypes)],
+            sort=False,
+        )
+    return unmerged
+
+
+def bulk_combine(filenames, dtypes):
+    return concat_intermediate(
+        df for _, df in iter_intermediate_files(filenames, dtypes)
+    )
+
+
+def write_files(directory, files, rows):
+    state = np.random.RandomState(0)
+    months = settings.INTERMEDIATE_OUTPUT_DTYPES["month"].categories
+    result_categories = settings.INTERMEDIATE_OUTPUT_DTYPES[
+        "result_category"
+    ].categories
+    test_codes = ["TEST{}".format(i) for i in range(400)]
+    practice_ids = ["P{:05d}".format(i) for i in range(2000)]
+    filenames = []
+    for i in range(files):
+        filename = os.path.join(directory, "converted_{}.csv".format(i))
+        pd.DataFrame(
+            {
+                "month": months[i % len(months)],
+                "test_code": state.choice(test_codes, rows),
+                "practice_id": state.choice(practice_ids, rows),
+                "result_category": state.choice(result_categories, rows),
+                "count": state.randint(1, 50, rows),
+            }
+        ).to_csv(filename, index=False)
+        filenames.append(filename)
+    return filenames
+
+
+def counts(df):
+    keys = list(settings.REQUIRED_NORMALISED_KEYS)
+    df = df.astype({key: str for key in keys}).astype({"count": int})
+    return df.groupby(keys)["count"].sum()
+
+
+def measure(function, filenames):
+    start = time.perf_counter()
+    # Don't report each file
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = function(filenames, settings.INTERMEDIATE_OUTPUT_DTYPES)
+    return result, time.perf_counter() - start
+
+
+def main(files, rows):
+    with tempfile.TemporaryDirectory() as directory:
+        filenames = write_files(directory, files, rows)
+        size = sum(os.path.getsize(filename) for filename in filenames)
+        legacy, legacy_time = measure(legacy_combine_csvs_to_dataframe, filenames)
+        bulk, bulk_time = measure(bulk_combine, filenames)
+        assert counts(legacy).equals(counts(bulk))
+        print("{} files of {} rows ({:.0f}MB)".format(files, rows, size / 1e6))
+        for name, elapsed in [("concat per file", legacy_time), ("bulk", bulk_time)]:
+            print(
+                "{}: {:.2f}s ({:.0f}MB/s)".format(name, elapsed, size / elapsed / 1e6)
+            )
+
+
+if __name__ == "__main__":
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 24,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 200000,
+    )
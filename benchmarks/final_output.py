@@ -0,0 +1,88 @@
+"""Compare loading the final columnar output with loading the zipped CSV,
+for a synthetic national dataset.
+
+    PYTHONPATH=. python benchmarks/final_output.py [rows]
+
+Both files are written by `FinalOutputWriter` from `rows` rows (default
+2000000) of random data, spread over five labs, and must hold the same
+data before their sizes and load times are reported.
+
+"""
+import pathlib
+import sys
+import tempfile
+import timeit
+
+import numpy as np
+import pandas as pd
+
+from lib import settings
+from lib.final_output import FinalOutputWriter, load_final_columns, read_final_columns
+
+LABS = ["cambridge", "cornwall", "exeter", "nd", "plymouth"]
+
+
+def synthetic_lab(lab, rows):
+    state = np.random.RandomState(len(lab))
+    practices = ["{}{:05d}".format(lab[0].upper(), i) for i in range(1500)]
+    practice_ids = state.choice(practices, rows)
+    ccgs = {
+        practice: "{}CCG{}".format(lab, i % 20) for i, practice in enumerate(practices)
+    }
+    count = state.randint(1, 200, rows)
+    suppressed = count < settings.SUPPRESS_UNDER
+    count[suppressed] = 3
+    return pd.DataFrame(
+        {
+            "month": pd.to_datetime(
+                state.choice(pd.date_range("2015-01-01", periods=60, freq="MS"), rows)
+            ),
+            "test_code": state.choice(["T{}".format(i) for i in range(100)], rows),
+            "practice_id": practice_ids,
+            "result_category": state.choice([0, 1, 2, -1, -2, -3], rows),
+            "count": count,
+            "lab_id": lab,
+            "error": np.where(suppressed, 2.0, 0.0),
+            "ccg_id": [ccgs[practice] for practice in practice_ids],
+            "practice_name": ["{} SURGERY".format(p) for p in practice_ids],
+            "total_list_size": state.randint(1000, 20000, rows),
+        }
+    )
+
+
+def main(rows):
+    with tempfile.TemporaryDirectory() as directory:
+        csv_path = pathlib.Path(directory) / "all_processed.csv.zip"
+        columns_path = pathlib.Path(directory) / "all_processed.npz"
+        with FinalOutputWriter(csv_path, columns_path) as writer:
+            for lab in LABS:
+                writer.write(synthetic_lab(lab, rows // len(LABS)))
+
+        from_csv = pd.read_csv(csv_path, na_filter=False)
+        from_columns = read_final_columns(columns_path)
+        from_columns["month"] = from_columns["month"].astype(str)
+        assert from_columns.astype(str).equals(from_csv.astype(str))
+
+        loaders = [
+            ("CSV", lambda: pd.read_csv(csv_path, na_filter=False)),
+            (
+                "CSV with FINAL_OUTPUT_DTYPES",
+                lambda: pd.read_csv(
+                    csv_path, na_filter=False, dtype=settings.FINAL_OUTPUT_DTYPES
+                ),
+            ),
+            ("columns as a DataFrame", lambda: read_final_columns(columns_path)),
+            ("columns memory-mapped", lambda: load_final_columns(columns_path)),
+        ]
+        print(
+            "{} rows: CSV zip {:.1f}MB, columns {:.1f}MB".format(
+                rows, csv_path.stat().st_size / 1e6, columns_path.stat().st_size / 1e6
+            )
+        )
+        for name, loader in loaders:
+            timing = min(timeit.repeat(loader, number=1, repeat=3))
+            print("{}: {:.3f}s".format(name, timing))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000000)
@@ -0,0 +1,109 @@
+"""Compare the binary intermediate files written by
+`merge_converted_parts` with the CSVs they replaced, for a synthetic
+month of a lab's counts.
+
+    PYTHONPATH=. python benchmarks/intermediate_format.py [rows]
+
+The synthetic file has `rows` rows (default 1000000) of counts, mostly
+for a single month. Both files must hold the same data (in any order)
+before their sizes and the time to read them (as categoricals, which
+is how `combine_and_append_csvs` reads them) are reported.
+
+"""
+from collections import Counter
+import csv
+import os
+import sys
+import tempfile
+import timeit
+
+import numpy as np
+import pandas as pd
+
+from lib import settings
+from lib.intermediate_format import (
+    counts_to_dataframe,
+    read_intermediate_file,
+    write_intermediate_file,
+)
+
+
+def synthetic_counts(rows):
+    state = np.random.RandomState(0)
+    months = settings.INTERMEDIATE_OUTPUT_DTYPES["month"].categories[-13:]
+    test_codes = ["TEST{}".format(i) for i in range(400)]
+    practice_ids = ["P{:05d}".format(i) for i in range(2000)]
+    result_categories = settings.INTERMEDIATE_OUTPUT_DTYPES[
+        "result_category"
+    ].categories
+    counts = Counter()
+    while len(counts) < rows:
+        size = rows - len(counts)
+        keys = zip(
+            # A file is mostly tests for one month
+            np.where(state.rand(size) < 0.95, months[-1], state.choice(months, size)),
+            state.choice(test_codes, size),
+            state.choice(practice_ids, size),
+            state.choice(result_categories, size).tolist(),
+        )
+        counts.update(dict(zip(keys, state.randint(1, 50, size).tolist())))
+    return counts
+
+
+def write_csv(filename, counts):
+    """How intermediate files used to be written"""
+    with open(filename, "w") as f:
+        writer = csv.writer(f)
+        writer.writerow(settings.REQUIRED_NORMALISED_KEYS + ["count"])
+        for key, count in counts.items():
+            writer.writerow(list(key) + [count])
+
+
+def read_csv(filename):
+    """How intermediate files used to be read"""
+    df = pd.read_csv(
+        filename, na_filter=False, dtype=settings.INTERMEDIATE_OUTPUT_DTYPES
+    )
+    df["test_code"] = df["test_code"].astype("category")
+    df["practice_id"] = df["practice_id"].astype("category")
+    return df
+
+
+def in_order(df):
+    df = df.astype(str).sort_values(settings.REQUIRED_NORMALISED_KEYS)
+    return df.reset_index(drop=True)
+
+
+def main(rows):
+    counts = synthetic_counts(rows)
+    with tempfile.TemporaryDirectory() as directory:
+        csv_filename = os.path.join(directory, "converted.csv")
+        binary_filename = os.path.join(directory, "converted.npz")
+        write_csv(csv_filename, counts)
+        with open(binary_filename, "wb") as f:
+            write_intermediate_file(f, counts_to_dataframe(counts))
+
+        from_csv = read_csv(csv_filename)
+        from_binary = read_intermediate_file(binary_filename)
+        assert in_order(from_csv).equals(in_order(from_binary))
+
+        sizes = [os.path.getsize(f) for f in [csv_filename, binary_filename]]
+        timings = [
+            min(timeit.repeat(lambda: reader(filename), number=1, repeat=3))
+            for reader, filename in [
+                (read_csv, csv_filename),
+                (read_intermediate_file, binary_filename),
+            ]
+        ]
+        print("{} rows".format(rows))
+        for name, size, timing in zip(["CSV", "binary"], sizes, timings):
+            print("{}: {:.1f}MB, read in {:.3f}s".format(name, size / 1e6, timing))
+        print(
+            "{:.0f}x smaller, {:.0f}x faster".format(
+                sizes[0] / sizes[1], timings[0] / timings[1]
+            )
+        )
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
@@ -0,0 +1,119 @@
+"""Compare the peak memory of `normalise_and_suppress` processing a
+synthetic lab's whole history at once with processing it a batch of
+months at a time (`--max-memory`), as its history grows.
+
+    PYTHONPATH=. python benchmarks/max_memory.py [rows] [max_memory]
+
+Each month of the synthetic lab's combined store has `rows` rows
+(default 200000), and batches are sized to `max_memory` bytes (default
+200000000). Both modes must write the same output before their time
+and peak memory (as traced by `tracemalloc`) are reported.
+
+"""
+import pathlib
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from lib import settings
+from lib.combined_store import append_segments, counts_path
+from lib.output_cache import remove_cached_output
+from lib.whole_file_processing import normalise_and_suppress
+
+LAB = "synthetic"
+
+MONTHS = [12, 24, 48]
+
+
+class Collector:
+    """Keeps the number of rows written, and their total count"""
+
+    path = None
+
+    def __init__(self):
+        self.rows = 0
+        self.count = 0
+
+    def write(self, df):
+        self.rows += len(df)
+        self.count += df["count"].sum()
+
+
+def write_store(months, rows):
+    state = np.random.RandomState(0)
+    practice_ids = ["P{:05d}".format(i) for i in range(1000)]
+    for month in months:
+        append_segments(
+            LAB,
+            pd.DataFrame(
+                {
+                    "month": month,
+                    "test_code": state.choice(
+                        ["TEST{}".format(i) for i in range(300)], rows
+                    ),
+                    "practice_id": state.choice(practice_ids, rows),
+                    "result_category": state.choice([0, 1, 2, -1], rows),
+                    "count": state.randint(1, 20, rows),
+                }
+            ),
+            "0000",
+        )
+    pd.DataFrame(
+        [
+            ("CCG{}".format(i % 20), practice_id, practice_id, month, 1000 + i)
+            for i, practice_id in enumerate(practice_ids)
+            for month in pd.to_datetime(months).strftime("%Y-%m-%d")
+        ],
+        columns=["ccg_id", "practice_id", "practice_name", "month", "total_list_size"],
+    ).to_csv(settings.FINAL_DIR / "practice_codes.csv", index=False)
+
+
+def measure(max_memory):
+    # Process the lab from scratch
+    remove_cached_output(LAB)
+    shutil.rmtree(counts_path(LAB), ignore_errors=True)
+    collector = Collector()
+    tracemalloc.start()
+    start = time.perf_counter()
+    normalise_and_suppress(LAB, writer=collector, max_memory=max_memory)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return (collector.rows, collector.count), elapsed, peak
+
+
+def main(rows, max_memory):
+    settings.TEST_CODE_MAPPINGS[LAB] = []
+    all_months = settings.INTERMEDIATE_OUTPUT_DTYPES["month"].categories
+    with tempfile.TemporaryDirectory() as directory:
+        settings.INTERMEDIATE_DIR = pathlib.Path(directory) / "intermediate_data"
+        settings.FINAL_DIR = pathlib.Path(directory) / "final_data"
+        settings.FINAL_DIR.mkdir(parents=True)
+        for months in MONTHS:
+            shutil.rmtree(settings.INTERMEDIATE_DIR, ignore_errors=True)
+            write_store(all_months[-months:], rows)
+            whole, whole_time, whole_peak = measure(0)
+            batched, batched_time, batched_peak = measure(max_memory)
+            assert whole == batched
+            print("{} months of {} rows".format(months, rows))
+            for name, elapsed, peak in [
+                ("all at once", whole_time, whole_peak),
+                ("batched", batched_time, batched_peak),
+            ]:
+                print(
+                    "{}: {:.2f}s, peak {:.0f}MB ({:.0f} bytes per row)".format(
+                        name, elapsed, peak / 1e6, peak / (months * rows)
+                    )
+                )
+
+
+if __name__ == "__main__":
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 200000,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 200000000,
+    )
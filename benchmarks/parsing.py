@@ -0,0 +1,179 @@
+"""Compare the date and result parsing in `lib.parsing` with the
+per-row parsing every lab configuration used to do, on each lab's
+sample file.
+
+    PYTHONPATH=. python benchmarks/parsing.py [rows]
+
+Each sample is repeated to make `rows` rows (default 100000), so the
+memoised parsers see more repeated values than they would in real data.
+All implementations must agree before any timings are reported.
+
+"""
+from datetime import datetime
+import importlib
+import itertools
+import math
+import sys
+import timeit
+
+import pandas as pd
+
+from lib import parsing
+
+# For each lab: its sample file, the date columns it parses (and their
+# formats), and the result columns it parses
+LABS = {
+    "cambridge": (
+        "data_sources/cambridge/example.csv",
+        {"CollectedDateTime": ("%d/%m/%Y",)},
+        ["TestResultValue"],
+    ),
+    "cornwall": (
+        "data_sources/cornwall/sample.csv.zip",
+        {"TestOrderDate": ("%Y-%m-%d %H:%M:%S",), "PatientDOB": ("%m-%Y",)},
+        ["TestResult"],
+    ),
+    "exeter": (
+        "data_sources/exeter/sample.xlsx",
+        {
+            "Date_Request_Made": ("%Y-%m-%d 00:00:00",),
+            "Date_Specimen_Collected": ("%Y-%m-%d 00:00:00",),
+            "Date_Specimen_Received": ("%Y-%m-%d 00:00:00",),
+        },
+        [],
+    ),
+    "north_devon": (
+        "data_sources/north_devon/sample.xlsx",
+        {"date_collected": ("%d/%m/%y", "%d/%m/%Y"), "dob": ("%d/%m/%y", "%d/%m/%Y")},
+        ["result"],
+    ),
+    "plymouth": (
+        "data_sources/plymouth/2015_sample.zip",
+        {"specimen_taken_date": ("%Y-%m-%d",)},
+        ["analyte_result_measurement"],
+    ),
+}
+
+
+def legacy_parse_date(value, formats):
+    """The original implementation, trying each format in turn for
+    every row
+    """
+    for fmt in formats:
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    return None
+
+
+def legacy_parse_result(result):
+    """The original implementation"""
+    direction = None
+    try:
+        if result.startswith("<"):
+            direction = "<"
+            result = float(result[1:]) - 0.0000001
+        elif result.startswith(">"):
+            direction = ">"
+            result = float(result[1:]) + 0.0000001
+        else:
+            result = float(result)
+    except ValueError:
+        pass
+    return result, direction
+
+
+def parse_rows(rows, dates, results, parse_date, format_month, parse_result):
+    parsed = {}
+    for column, formats in dates.items():
+        months = []
+        for row in rows:
+            date = parse_date(row[column], formats)
+            months.append(format_month(date) if date else None)
+        parsed[column] = months
+    for column in results:
+        parsed[column] = [parse_result(row[column]) for row in rows]
+    return parsed
+
+
+def legacy(rows, dates, results):
+    return parse_rows(
+        rows,
+        dates,
+        results,
+        legacy_parse_date,
+        lambda date: date.strftime("%Y/%m/01"),
+        legacy_parse_result,
+    )
+
+
+def scalar(rows, dates, results):
+    # Start with empty memos, as a new process would
+    parsing.parse_date.cache_clear()
+    parsing.parse_result.cache_clear()
+    return parse_rows(
+        rows,
+        dates,
+        results,
+        parsing.parse_date,
+        parsing.format_month,
+        parsing.parse_result,
+    )
+
+
+def vectorised(df, dates, results):
+    parsing.parse_date.cache_clear()
+    parsing.parse_result.cache_clear()
+    parsed = {}
+    for column, formats in dates.items():
+        parsed[column] = parsing.format_months(parsing.parse_dates(df[column], formats))
+    for column in results:
+        parsed[column] = parsing.parse_results(df[column])
+    return parsed
+
+
+def check_vectorised(expected, actual, dates, results):
+    for column in dates:
+        months = [None if pd.isnull(m) else m for m in actual[column]]
+        assert months == expected[column], "Months differ for {}".format(column)
+    for column in results:
+        values, parsed, directions = actual[column]
+        for (result, direction), value, is_parsed, actual_direction in zip(
+            expected[column], values, parsed, directions
+        ):
+            assert is_parsed == isinstance(result, float)
+            assert not is_parsed or value == result or math.isnan(result)
+            assert direction == actual_direction
+
+
+def main(count):
+    for lab, (sample, dates, results) in LABS.items():
+        config = importlib.import_module(
+            "data_sources.{}.anonymiser_config".format(lab)
+        )
+        sample_rows = [dict(row) for row in config.row_iterator(sample)]
+        rows = list(itertools.islice(itertools.cycle(sample_rows), count))
+        df = pd.DataFrame(rows)
+        expected = legacy(rows, dates, results)
+        assert scalar(rows, dates, results) == expected
+        check_vectorised(expected, vectorised(df, dates, results), dates, results)
+        timings = []
+        for function, data in [(legacy, rows), (scalar, rows), (vectorised, df)]:
+            timings.append(
+                min(
+                    timeit.repeat(
+                        lambda: function(data, dates, results), number=1, repeat=3
+                    )
+                )
+            )
+        print(
+            "{}: {:.0f} rows/s legacy, {:.0f} rows/s memoised, "
+            "{:.0f} rows/s vectorised".format(
+                lab, *[len(rows) / timing for timing in timings]
+            )
+        )
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
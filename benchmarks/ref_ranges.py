@@ -0,0 +1,205 @@
+"""Compare the compiled reference range lookup used by
+`standard_convert_to_result`, and the vectorised `classify_results`,
+with the linear scan they replaced.
+
+    PYTHONPATH=. python benchmarks/ref_ranges.py [rows]
+
+All implementations are run against the same randomly generated rows
+for every lab with a reference ranges file, and must agree on every
+result category before any timings are reported.
+
+"""
+import csv
+import logging
+import random
+import sys
+import timeit
+
+import numpy as np
+
+from lib import settings
+from lib.intermediate_file_processing import get_ref_ranges, standard_convert_to_result
+from lib.logger import log_info, log_warning
+from lib.result_classification import classify_results, get_ref_range_table
+
+REFERENCE_RANGES = [
+    "data_sources/cornwall/cornwall_ref_ranges.csv",
+    "data_sources/north_devon/north_devon_reference_ranges.csv",
+]
+
+
+def scan_convert_to_result(row, ranges):
+    """The original implementation, which scans a list of reference
+    range dicts (sorted by test) for every row
+    """
+    test_code = row["test_code"]
+    result = row["test_result"]
+    sex = row["sex"]
+    age = row["age"]
+    direction = row["direction"]
+    found = False
+    return_code = None
+    for ref_range in ranges:
+        if ref_range["test"] == test_code:
+            found = True
+            if not isinstance(result, float):
+                log_info(row, "Unparseable result")
+                return_code = settings.ERR_UNPARSEABLE_RESULT
+                break
+            high = low = None
+            if age >= int(float(ref_range["min_adult_age"])) and age < int(
+                float(ref_range["max_adult_age"])
+            ):
+                if sex == "M":
+                    if ref_range["low_M"] and ref_range["high_M"]:
+                        low = float(ref_range["low_M"])
+                        high = float(ref_range["high_M"])
+                elif sex == "F":
+                    if ref_range["low_F"] and ref_range["high_F"]:
+                        low = float(ref_range["low_F"])
+                        high = float(ref_range["high_F"])
+                else:
+                    return_code = settings.ERR_INVALID_SEX
+                    log_info(row, "Invalid sex %s", sex)
+                    break
+                if low is not None and high is not None:
+                    if result > high:
+                        if direction == "<":
+                            log_warning(
+                                row, "Over range %s but result <; invalid", high
+                            )
+                            return_code = settings.ERR_INVALID_RANGE_WITH_DIRECTION
+                        else:
+                            log_info(row, "Over range %s", high)
+                            return_code = settings.OVER_RANGE
+                    elif result < low:
+                        if direction == ">":
+                            log_warning(row, "Under range %s but >; invalid", high)
+                            return_code = settings.ERR_INVALID_RANGE_WITH_DIRECTION
+                        else:
+                            log_info(row, "Under range %s", low)
+                            return_code = settings.UNDER_RANGE
+                    else:
+                        if not direction or (
+                            (direction == "<" and low == 0)
+                            or (direction == ">" and high == settings.RANGE_CEILING)
+                        ):
+                            log_info(row, "Within range %s - %s", low, high)
+                            return_code = settings.WITHIN_RANGE
+                        else:
+                            log_warning(
+                                row,
+                                "Within range %s-%s but direction %s; invalid",
+                                low,
+                                high,
+                                direction,
+                            )
+                            return_code = settings.ERR_INVALID_RANGE_WITH_DIRECTION
+                else:
+                    return_code = settings.ERR_INVALID_REF_RANGE
+                    log_warning(row, "Couldn't process ref range %s - %s", low, high)
+                break
+            else:
+                return_code = settings.ERR_DISCARDED_AGE
+    if not found:
+        log_info(row, "Couldn't find ref range")
+        return_code = settings.ERR_NO_REF_RANGE
+    row["result_category"] = return_code
+    return row
+
+
+def make_rows(lines, count):
+    """Generate rows which exercise every branch of the lookup: unknown
+    tests and sexes, unparseable results, directions, and ages and
+    results either side of every boundary in the file
+    """
+    tests = sorted(set(line["test"] for line in lines)) + ["UNKNOWN"]
+    values = [0.0, settings.RANGE_CEILING, float("nan")]
+    for line in lines:
+        for col in ["low_F", "low_M", "high_F", "high_M"]:
+            if line[col]:
+                values.extend([float(line[col]) + delta for delta in [-0.5, 0, 0.5]])
+    # Seeded, so every run times the same rows
+    rng = random.Random(1)
+    ages = [rng.uniform(0, 130) for _ in range(100)] + [float("nan")]
+    for line in lines:
+        for col in ["min_adult_age", "max_adult_age"]:
+            ages.extend([float(line[col]) + delta for delta in [-0.01, 0, 0.99]])
+    rows = []
+    for _ in range(count):
+        rows.append(
+            {
+                "test_code": rng.choice(tests),
+                "test_result": rng.choice(values + ["<5", "Haemolysed"]),
+                "sex": rng.choice(["M", "F", "M", "F", "U", ""]),
+                "age": rng.choice(ages),
+                "direction": rng.choice([None, None, None, "<", ">"]),
+            }
+        )
+    return rows
+
+
+def rows_to_columns(rows):
+    """Convert generated rows into the columns taken by `classify_results`
+    """
+    results = [row["test_result"] for row in rows]
+    return {
+        "test_codes": np.array([row["test_code"] for row in rows], dtype=object),
+        "results": np.array(
+            [r if isinstance(r, float) else np.nan for r in results], dtype=float
+        ),
+        "directions": np.array([row["direction"] for row in rows], dtype=object),
+        "ages": np.array([row["age"] for row in rows], dtype=float),
+        "sexes": np.array([row["sex"] for row in rows], dtype=object),
+        "parsed": np.array([isinstance(r, float) for r in results], dtype=bool),
+    }
+
+
+def main(count):
+    # Many of the generated rows are deliberately invalid
+    logging.disable(logging.WARNING)
+    for path in REFERENCE_RANGES:
+        with open(path, newline="", encoding="ISO-8859-1") as f:
+            lines = sorted(list(csv.DictReader(f)), key=lambda x: x["test"])
+        compiled = get_ref_ranges(path)
+        table = get_ref_range_table(path)
+        rows = make_rows(lines, count)
+        columns = rows_to_columns(rows)
+        vectorised = classify_results(table, **columns)
+        for row, category in zip(rows, vectorised):
+            expected = scan_convert_to_result(dict(row), lines)["result_category"]
+            actual = standard_convert_to_result(dict(row), compiled)["result_category"]
+            assert expected == actual, "{} != {} for {}".format(expected, actual, row)
+            assert expected == category, "{} != {} for {}".format(
+                expected, category, row
+            )
+        scan = min(
+            timeit.repeat(
+                lambda: [scan_convert_to_result(dict(row), lines) for row in rows],
+                number=1,
+                repeat=3,
+            )
+        )
+        indexed = min(
+            timeit.repeat(
+                lambda: [
+                    standard_convert_to_result(dict(row), compiled) for row in rows
+                ],
+                number=1,
+                repeat=3,
+            )
+        )
+        batch = min(
+            timeit.repeat(
+                lambda: classify_results(table, **columns), number=1, repeat=3
+            )
+        )
+        print(
+            "{}: {} rows/s scan, {} rows/s indexed, {} rows/s vectorised".format(
+                path, *["{:.0f}".format(count / t) for t in [scan, indexed, batch]]
+            )
+        )
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50000)
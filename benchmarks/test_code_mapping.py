@@ -0,0 +1,118 @@
+"""Compare the compiled test code map used by `_normalise_test_codes`
+with the join against the mapping for each alias column it replaced,
+on a synthetic lab using the aliases in `final_data/test_codes.csv`.
+
+    PYTHONPATH=. python benchmarks/test_code_mapping.py [rows] [lab]
+
+The synthetic lab has `rows` rows (default 1000000), using codes for
+`lab` (default plymouth, which has the most alias columns) and some
+unmapped codes. Both implementations must give the same counts before
+their time and peak memory (as traced by `tracemalloc`) are reported.
+
+"""
+import random
+import sys
+import time
+import tracemalloc
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from lib import settings
+from lib.whole_file_processing import _normalise_test_codes, get_test_code_map
+
+
+def legacy_get_test_codes(lab):
+    """The original implementation"""
+    columns = settings.TEST_CODE_MAPPINGS[lab] + ["datalab_testcode"]
+    df = pd.read_csv(
+        settings.FINAL_DIR / "test_codes.csv",
+        na_filter=False,
+        usecols=columns + ["show_in_app?", "testname"],
+    )
+    df = df[df["show_in_app?"] == True]
+    for colname in settings.TEST_CODE_MAPPINGS[lab]:
+        df.loc[df[colname] == df["datalab_testcode"], colname] = "_DONTJOIN_"
+    return df[columns]
+
+
+def legacy_normalise_test_codes(lab, df):
+    """The original implementation"""
+    orig_cols = df.columns
+    test_code_mapping = legacy_get_test_codes(lab)
+    output = pd.DataFrame(columns=orig_cols)
+    for colname in settings.TEST_CODE_MAPPINGS[lab] + ["datalab_testcode"]:
+        result = df.merge(
+            test_code_mapping, how="inner", left_on="test_code", right_on=colname
+        )
+        result = result.rename(
+            columns={"test_code": "source_test_code", "datalab_testcode": "test_code"}
+        )
+        output = output.append(result[orig_cols])
+    return output
+
+
+def synthetic_lab(lab, rows):
+    random.seed(lab)
+    # Blank cells have never matched a real test code
+    test_codes = [code for code in get_test_code_map(lab) if code]
+    test_codes += ["UNMAPPED{}".format(i) for i in range(len(test_codes) // 4)]
+    months = settings.INTERMEDIATE_OUTPUT_DTYPES["month"].categories
+    practice_ids = ["P{:05d}".format(i) for i in range(500)]
+    df = pd.DataFrame(
+        {
+            "month": pd.Categorical(random.choices(months, k=rows), categories=months),
+            "test_code": pd.Categorical(random.choices(test_codes, k=rows)),
+            "practice_id": pd.Categorical(random.choices(practice_ids, k=rows)),
+            "result_category": np.random.RandomState(0).randint(-1, 9, rows),
+            "count": np.random.RandomState(1).randint(1, 20, rows),
+        }
+    )
+    return df
+
+
+def counts(df):
+    keys = list(settings.REQUIRED_NORMALISED_KEYS)
+    # Appending to an empty frame (as the joins did) makes every
+    # column an object column
+    df = df.astype({key: str for key in keys}).astype({"count": int})
+    return df.groupby(keys)["count"].sum().sort_index()
+
+
+def measure(function, lab, df):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = function(lab, df)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def main(rows, lab):
+    warnings.simplefilter("ignore", FutureWarning)
+    df = synthetic_lab(lab, rows)
+    # Compile the map up front, as it's only compiled once per run
+    get_test_code_map(lab)
+    size = df.memory_usage(deep=True).sum()
+    legacy, legacy_time, legacy_peak = measure(legacy_normalise_test_codes, lab, df)
+    compiled, compiled_time, compiled_peak = measure(_normalise_test_codes, lab, df)
+    assert counts(legacy).equals(counts(compiled))
+    print("{} rows for {} ({:.0f}MB)".format(rows, lab, size / 1e6))
+    for name, elapsed, peak in [
+        ("joins", legacy_time, legacy_peak),
+        ("compiled map", compiled_time, compiled_peak),
+    ]:
+        print(
+            "{}: {:.2f}s, peak {:.0f}MB ({:.1f}x the data)".format(
+                name, elapsed, peak / 1e6, peak / size
+            )
+        )
+
+
+if __name__ == "__main__":
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 1000000,
+        sys.argv[2] if len(sys.argv) > 2 else "plymouth",
+    )
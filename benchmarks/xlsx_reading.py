@@ -0,0 +1,56 @@
+"""Compare `iter_xlsx_rows` with the openpyxl read-only reader it
+replaced, on the sample XLSX files.
+
+    PYTHONPATH=. python benchmarks/xlsx_reading.py [repeat]
+
+Both readers must return the same rows before any timings are
+reported. Each file is read `repeat` times per timing (default 20), as
+the samples are small.
+
+"""
+import sys
+import timeit
+
+from openpyxl import load_workbook
+
+from lib.xlsx_reading import iter_xlsx_rows
+
+SAMPLES = [
+    "data_sources/exeter/sample.xlsx",
+    "data_sources/north_devon/sample.xlsx",
+]
+
+
+def openpyxl_rows(filename):
+    """The original implementation"""
+    wb = load_workbook(filename, read_only=True)
+    return [[str(x.value) for x in row] for row in wb.active.iter_rows()]
+
+
+def streaming_rows(filename):
+    return list(iter_xlsx_rows(filename))
+
+
+def main(repeat):
+    for path in SAMPLES:
+        expected = openpyxl_rows(path)
+        actual = streaming_rows(path)
+        assert expected == actual, "Rows differ for {}".format(path)
+        cells = sum(len(row) for row in expected) * repeat
+        timings = {}
+        for name, read in [("openpyxl", openpyxl_rows), ("streaming", streaming_rows)]:
+            timings[name] = min(
+                timeit.repeat(lambda: read(path), number=repeat, repeat=3)
+            )
+        print(
+            "{}: {:.0f} cells/s openpyxl, {:.0f} cells/s streaming ({:.1f}x)".format(
+                path,
+                cells / timings["openpyxl"],
+                cells / timings["streaming"],
+                timings["openpyxl"] / timings["streaming"],
+            )
+        )
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20)
@@ -2,10 +2,11 @@ import glob
 import os
 import csv
 import re
-from datetime import datetime
 
+from lib.input_splitting import iter_csv_lines, split_csv
 from lib.intermediate_file_processing import StopProcessing
 from lib.logger import log_warning, log_info
+from lib.parsing import format_month, match_group, parse_date, parse_result
 
 LAB_CODE = "cambridge"
 REFERENCE_RANGES = ""
@@ -31,12 +32,28 @@ ERR_INVALID_REF_RANGE = 7
 ERR_NO_TEST_CODE = 8
 
 
+def split_file(filename):
+    """Split large files into parts that can be processed in parallel
+    """
+    return split_csv(filename)
+
+
+ROW_COLUMNS = [
+    "CollectedDateTime",
+    "Patient Age",
+    "TestResultValue",
+    "SubmitterName",
+    "TestResultName",
+    "TestResult",
+]
+
+
 def row_iterator(filename):
     """Provide a way to iterate over every row as a dict in the given file
+    (or part of a file)
     """
-    with open(filename, "r") as f:
-        for row in csv.DictReader(f):
-            yield row
+    for row in csv.DictReader(iter_csv_lines(filename)):
+        yield row
 
 
 def drop_unwanted_data(row):
@@ -63,37 +80,22 @@ def normalise_data(row):
 
     """
     result = row["TestResultValue"]
-    try:
-        order_date = datetime.strptime(row["CollectedDateTime"], "%d/%m/%Y")
-    except ValueError:
+    order_date = parse_date(row["CollectedDateTime"], ("%d/%m/%Y",))
+    if not order_date:
         log_warning(row, "Unparseable date %s", result)
         raise StopProcessing()
 
-    row["month"] = order_date.strftime("%Y/%m/01")
-    direction = None
+    row["month"] = format_month(order_date)
     row["dob"] = ""
     row["age"] = ""
     row["sex"] = ""
-    try:
-        if result.startswith("<"):
-            direction = "<"
-            result = float(result[1:]) - 0.0000001
-        elif result.startswith(">"):
-            direction = ">"
-            result = float(result[1:]) + 0.0000001
-        else:
-            result = float(result)
-    except ValueError:
-        pass
-    row["test_result"] = result
-    row["direction"] = direction
-    # Should probably use regex but this is faster XXX
-    practice_code_match = PRACTICE_REGEX.match(row["SubmitterName"])
-    if not practice_code_match:
+    row["test_result"], row["direction"] = parse_result(result)
+    practice_code = match_group(PRACTICE_REGEX, row["SubmitterName"])
+    if not practice_code:
         log_warning(row, "Unparseable practice %s", row["SubmitterName"])
         raise StopProcessing()
 
-    row["requestor_organisation_code"] = practice_code_match.groups()[0]
+    row["requestor_organisation_code"] = practice_code
     col_mapping = {
         "month": "month",
         "test_code": "TestResultName",  # XXX or name...
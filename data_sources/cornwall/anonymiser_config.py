@@ -4,10 +4,22 @@ import zipfile
 import tempfile
 import csv
 import codecs
-from datetime import datetime
 import re
 
+import pandas as pd
+
+from lib import settings
 from lib.intermediate_file_processing import StopProcessing
+from lib.parsing import (
+    age_at,
+    ages_at,
+    format_month,
+    format_months,
+    parse_date,
+    parse_dates,
+    parse_result,
+    parse_results,
+)
 
 LAB_CODE = "cornwall"
 REFERENCE_RANGES = "cornwall_ref_ranges.csv"
@@ -17,6 +29,17 @@ files_path = os.path.join(
 INPUT_FILES = glob.glob(files_path)
 
 
+ROW_COLUMNS = [
+    "PatientDOB",
+    "SpecialtyCode",
+    "TestResult",
+    "TestOrderDate",
+    "TestResultCode",
+    "PracticeCode",
+    "PatientGender",
+]
+
+
 def row_iterator(filename):
     """Provide a way to iterate over every row as a dict in the given file
     """
@@ -38,6 +61,13 @@ def drop_unwanted_data(row):
         raise StopProcessing()
 
 
+# Replace rows containing floats and percentages with just the floats.
+# See https://github.com/ebmdatalab/openpathology/issues/87#issuecomment-512765880
+#
+# A typical cll looks like `0.03 0.5%`
+FLOAT_PERCENT_RX = re.compile(r"([0-9.])+ +[0-9. ]+%")
+
+
 def normalise_data(row):
     """Convert test results to float wherever possible; extract a
     direction if required; set age from DOB; format the date to
@@ -46,36 +76,19 @@ def normalise_data(row):
     Additionally, rename the fields to the standardised list.
 
     """
-    # Replace rows containing floats and percentages with just the floats.
-    # See https://github.com/ebmdatalab/openpathology/issues/87#issuecomment-512765880
-    #
-    # A typical cll looks like `0.03 0.5%`
-    FLOAT_PERCENT_RX = re.compile(r"([0-9.])+ +[0-9. ]+%")
     result = re.sub(FLOAT_PERCENT_RX, r"\1", row["TestResult"])
-    order_date = datetime.strptime(row["TestOrderDate"], "%Y-%m-%d %H:%M:%S")
-    row["month"] = order_date.strftime("%Y/%m/01")
-    direction = None
-    try:
-        dob = datetime.strptime(row["PatientDOB"], "%m-%Y")
-        row["age"] = (order_date - dob).days / 365
-        if row["age"] < 18:
-            raise StopProcessing()
-    except ValueError:
+    order_date = parse_date(row["TestOrderDate"], ("%Y-%m-%d %H:%M:%S",))
+    if not order_date:
+        raise ValueError("Unparseable date {}".format(row["TestOrderDate"]))
+    row["month"] = format_month(order_date)
+    dob = parse_date(row["PatientDOB"], ("%m-%Y",))
+    if not dob:
         # Couldn't parse age. Drop row.
         raise StopProcessing()
-    try:
-        if result.startswith("<"):
-            direction = "<"
-            result = float(result[1:]) - 0.0000001
-        elif result.startswith(">"):
-            direction = ">"
-            result = float(result[1:]) + 0.0000001
-        else:
-            result = float(result)
-    except ValueError:
-        pass
-    row["test_result"] = result
-    row["direction"] = direction
+    row["age"] = age_at(order_date, dob)
+    if row["age"] < 18:
+        raise StopProcessing()
+    row["test_result"], row["direction"] = parse_result(result)
 
     col_mapping = {
         "month": "month",
@@ -90,3 +103,68 @@ def normalise_data(row):
     for k, v in col_mapping.items():
         mapped[k] = row[v]
     return mapped
+
+
+# The columns read by `chunk_iterator`; the remainder are never used
+CHUNK_COLUMNS = [
+    "TestOrderDate",
+    "TestResultCode",
+    "TestResult",
+    "SpecialtyCode",
+    "PracticeCode",
+    "PatientDOB",
+    "PatientGender",
+]
+
+
+def chunk_iterator(filename):
+    """Provide a way to iterate over every row in the given file, as
+    DataFrames of string columns
+    """
+    zf = zipfile.ZipFile(filename)
+    fname = zf.namelist()[0]
+    with zf.open(fname, "r") as zipf:
+        for chunk in pd.read_csv(
+            zipf,
+            encoding="ISO-8859-1",
+            dtype=str,
+            na_filter=False,
+            usecols=CHUNK_COLUMNS,
+            chunksize=settings.CHUNK_SIZE,
+        ):
+            yield chunk
+
+
+def drop_unwanted_chunk(df):
+    """Columnar version of `drop_unwanted_data`
+    """
+    return df[(df["PatientDOB"] != "") & df["SpecialtyCode"].isin(["600", "180"])]
+
+
+def normalise_chunk(df):
+    """Columnar version of `normalise_data`
+    """
+    order_date = pd.to_datetime(df["TestOrderDate"], format="%Y-%m-%d %H:%M:%S")
+    dob = parse_dates(df["PatientDOB"], ("%m-%Y",))
+    age = ages_at(order_date, dob)
+    # Rows with unparseable dates of birth have a NaN age, so are
+    # dropped here too
+    adult = age >= 18
+    df = df[adult]
+    order_date = order_date[adult]
+
+    test_result, result_parsed, direction = parse_results(
+        df["TestResult"].str.replace(FLOAT_PERCENT_RX, r"\1", regex=True)
+    )
+    return pd.DataFrame(
+        {
+            "month": format_months(order_date),
+            "test_code": df["TestResultCode"],
+            "test_result": test_result,
+            "result_parsed": result_parsed,
+            "practice_id": df["PracticeCode"],
+            "age": age[adult],
+            "sex": df["PatientGender"],
+            "direction": direction,
+        }
+    )
@@ -2,11 +2,10 @@ import glob
 import os
 import pandas as pd
 
-from datetime import datetime
-from openpyxl import load_workbook
-
 from lib.intermediate_file_processing import StopProcessing
 from lib.logger import log_info, log_warning
+from lib.parsing import format_month, parse_date
+from lib.xlsx_reading import iter_xlsx_rows
 
 LAB_CODE = "exeter"
 REFERENCE_RANGES = ""
@@ -32,6 +31,18 @@ ERR_INVALID_REF_RANGE = 7
 ERR_NO_TEST_CODE = 8
 
 
+ROW_COLUMNS = [
+    "Age_on_Date_Request_Rec'd",
+    "Requesting_Organisation_Desc",
+    "Requesting_Organisation_Code",
+    "Date_Request_Made",
+    "Date_Specimen_Collected",
+    "Date_Specimen_Received",
+    "Test_Performed",
+    "Test_Result_Range",
+]
+
+
 def row_iterator(filename):
     """Provide a way to iterate over every row as a dict in the given file
     """
@@ -50,21 +61,16 @@ def row_iterator(filename):
         "Test_Result_Range",
         "Test_Result_Units",
     ]
-    wb = load_workbook(filename, read_only=True)
-    ws = wb.active
-    keys = []
-    for row in ws.iter_rows():
-        if not keys:
-            keys = [x.value for x in row]
-            # check every element in required_cols is in keys
-            assert set(required_cols).issubset(
-                set(keys)
-            ), "File at {} must define columns {}, has {}".format(
-                filename, required_cols, keys
-            )
-
-        else:
-            yield dict(zip(keys, [str(x.value) for x in row]))
+    rows = iter_xlsx_rows(filename)
+    keys = next(rows, [])
+    # check every element in required_cols is in keys
+    assert set(required_cols).issubset(
+        set(keys)
+    ), "File at {} must define columns {}, has {}".format(
+        filename, required_cols, keys
+    )
+    for row in rows:
+        yield dict(zip(keys, row))
 
 
 def drop_unwanted_data(row):
@@ -81,9 +87,9 @@ def drop_unwanted_data(row):
 
 PRACTICE_MAP = (
     pd.read_csv(os.path.join(os.path.dirname(__file__), "exeter_practices_branch.csv"))
-    .set_index("Requesting_Organisation_Code")[["Parent_Requesting_Organisation_Code"]]
+    .set_index("Requesting_Organisation_Code")["Parent_Requesting_Organisation_Code"]
     .dropna()
-    .to_dict(orient="index")
+    .to_dict()
 )
 
 
@@ -100,17 +106,15 @@ def normalise_data(row):
         "Date_Specimen_Collected",
         "Date_Specimen_Received",
     ]
+    # The last parseable date is used
     order_date = None
     for date_field in date_fields:
-        try:
-            order_date = datetime.strptime(row[date_field], "%Y-%m-%d 00:00:00")
-        except ValueError:
-            pass
+        order_date = parse_date(row[date_field], ("%Y-%m-%d 00:00:00",)) or order_date
     if not order_date:
         log_warning(row, "Unparseable date")
         raise StopProcessing()
 
-    row["month"] = order_date.strftime("%Y/%m/01")
+    row["month"] = format_month(order_date)
     row["dob"] = ""
     row["age"] = ""
     row["sex"] = ""
@@ -1,12 +1,13 @@
 import glob
 import os
 import pandas as pd
-from openpyxl import load_workbook
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
 
 from lib.intermediate_file_processing import StopProcessing
 from lib.logger import log_error
+from lib.parsing import age_at, format_month, parse_date, parse_result
+from lib.xlsx_reading import iter_xlsx_rows
 
 LAB_CODE = "nd"
 REFERENCE_RANGES = "north_devon_reference_ranges.csv"
@@ -16,6 +17,17 @@ files_path = os.path.join(
 INPUT_FILES = glob.glob(files_path)
 
 
+ROW_COLUMNS = [
+    "dob",
+    "patient_category",
+    "source",
+    "test_code",
+    "date_collected",
+    "result",
+    "sex",
+]
+
+
 def row_iterator(filename):
     """Provide a way to iterate over every row as a dict in the given file
     """
@@ -37,25 +49,14 @@ def row_iterator(filename):
         "patient_numer",
         "patient_category",
     ]
-    try:
-        os.symlink(os.path.split(filename)[-1], filename + ".xlsx")
-        wb = load_workbook(filename + ".xlsx", read_only=True)
-        ws = wb.active
-        for row in ws.iter_rows():
-            yield dict(zip(cols, [str(x.value) for x in row]))
-    finally:
-        os.remove(filename + ".xlsx")
+    for row in iter_xlsx_rows(filename):
+        yield dict(zip(cols, row))
 
 
 def _date_string_to_past_datetime(date_str):
-    try:
-        d = datetime.strptime(date_str, "%d/%m/%y")
-    except ValueError:
-        d = datetime.strptime(date_str, "%d/%m/%Y")
-    except ValueError:
-        d = datetime.strptime(date_str, "%d %b %Y")
-    except ValueError:
-        d = datetime.strptime(date_str, "%d %b %y")
+    d = parse_date(date_str, ("%d/%m/%y", "%d/%m/%Y"))
+    if d is None:
+        raise ValueError("Unparseable date {}".format(date_str))
     if d > datetime.now():
         d -= relativedelta(years=100)
     return d
@@ -118,25 +119,11 @@ def normalise_data(row):
         raise
     collected = _date_string_to_past_datetime(row["date_collected"])
 
-    row["age"] = (collected - dob).days / 365
+    row["age"] = age_at(collected, dob)
     if row["age"] < 18:
         raise StopProcessing()
-    result = row["result"]
-    row["month"] = collected.strftime("%Y/%m/01")
-    direction = None
-    try:
-        if result.startswith("<"):
-            direction = "<"
-            result = float(result[1:]) - 0.0000001
-        elif result.startswith(">"):
-            direction = ">"
-            result = float(result[1:]) + 0.0000001
-        else:
-            result = float(result)
-    except ValueError:
-        pass
-    row["test_result"] = result
-    row["direction"] = direction
+    row["month"] = format_month(collected)
+    row["test_result"], row["direction"] = parse_result(row["result"])
 
     col_mapping = {
         "month": "month",
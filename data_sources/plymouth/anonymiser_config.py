@@ -3,10 +3,11 @@ import os
 import zipfile
 import csv
 import codecs
-from datetime import datetime
 
+from lib.input_splitting import split_zip, zip_members
 from lib.intermediate_file_processing import StopProcessing
 from lib.logger import log_info, log_warning
+from lib.parsing import format_month, parse_date, parse_result
 
 LAB_CODE = "plymouth"
 REFERENCE_RANGES = ""
@@ -32,11 +33,29 @@ ERR_INVALID_REF_RANGE = 7
 ERR_NO_TEST_CODE = 8
 
 
+def split_file(filename):
+    """Process each member of a zip file in parallel
+    """
+    return split_zip(filename)
+
+
+ROW_COLUMNS = [
+    "specimen_taken_date",
+    "patient_age",
+    "analyte_result_measurement",
+    "analyte_lab_code",
+    "requestor_organisation_code",
+    "Reference Range",
+]
+
+
 def row_iterator(filename):
     """Provide a way to iterate over every row as a dict in the given file
+    (or part of a file)
     """
-    zf = zipfile.ZipFile(filename)
-    for fname in zf.namelist():
+    zip_filename, members = zip_members(filename)
+    zf = zipfile.ZipFile(zip_filename)
+    for fname in members:
         with zf.open(fname, "r") as zipf:
             for row in csv.DictReader(codecs.iterdecode(zipf, "ISO-8859-1")):
                 yield row
@@ -63,30 +82,16 @@ def normalise_data(row):
 
     """
     result = row["analyte_result_measurement"]
-    try:
-        order_date = datetime.strptime(row["specimen_taken_date"], "%Y-%m-%d")
-    except ValueError:
+    order_date = parse_date(row["specimen_taken_date"], ("%Y-%m-%d",))
+    if not order_date:
         log_warning(row, "Unparseable date %s", result)
         raise StopProcessing()
 
-    row["month"] = order_date.strftime("%Y/%m/01")
-    direction = None
+    row["month"] = format_month(order_date)
     row["dob"] = ""
     row["age"] = ""
     row["sex"] = ""
-    try:
-        if result.startswith("<"):
-            direction = "<"
-            result = float(result[1:]) - 0.0000001
-        elif result.startswith(">"):
-            direction = ">"
-            result = float(result[1:]) + 0.0000001
-        else:
-            result = float(result)
-    except ValueError:
-        pass
-    row["test_result"] = result
-    row["direction"] = direction
+    row["test_result"], row["direction"] = parse_result(result)
 
     col_mapping = {
         "month": "month",
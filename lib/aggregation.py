@@ -0,0 +1,86 @@
+"""Summing counts by several keys at once, without `groupby`: the
+category codes of each row's keys are packed into a single integer,
+and counts are summed by `np.bincount` (when there are few possible
+keys) or by sorting the packed keys and summing each run of them.
+
+`sum_counts` is benchmarked against `groupby` in
+`benchmarks/aggregation.py`.
+
+"""
+import numpy as np
+import pandas as pd
+
+# Largest number of possible packed keys, per row, for which counts
+# are summed into an array with an element for every possible key
+# rather than by sorting
+DENSE_KEYS_PER_ROW = 1
+
+
+def _sum_dense(packed, counts, possible):
+    present = np.bincount(packed, minlength=possible) > 0
+    # `weights` are summed as floats, which are exact for any realistic
+    # count
+    totals = np.bincount(packed, weights=counts, minlength=possible)
+    groups = np.flatnonzero(present)
+    return groups, totals[groups].astype(np.int64)
+
+
+def _run_starts(values):
+    return np.flatnonzero(np.concatenate([[True], values[1:] != values[:-1]]))
+
+
+def _sum_sorted(packed, counts):
+    if not len(packed):
+        return packed, counts
+    if (counts == 1).all():
+        # Each row is a single test result, so the sum for each key is
+        # the length of its run once sorted, and only the keys need
+        # sorting (in place, as `packed` isn't used again)
+        packed.sort()
+        starts = _run_starts(packed)
+        return packed[starts], np.diff(np.append(starts, len(packed)))
+    order = np.argsort(packed)
+    packed = packed[order]
+    starts = _run_starts(packed)
+    return packed[starts], np.add.reduceat(counts[order], starts)
+
+
+def sum_counts(df, keys, count="count"):
+    """Return the sum of the `count` column of `df` for each combination
+    of `keys` it contains, like
+    `df.groupby(keys, observed=True)[count].sum().reset_index()`, but
+    sorted by the keys (in the order of their categories). Keys that
+    aren't categorical are made so.
+    """
+    categoricals = [pd.Categorical(df[key]) for key in keys]
+    sizes = [len(categorical.categories) for categorical in categoricals]
+    if np.prod(sizes, dtype=float) >= 2 ** 63:
+        # Too many possible combinations to pack into an integer
+        df = df.assign(**dict(zip(keys, categoricals)))
+        return df.groupby(keys, observed=True)[count].sum().reset_index()
+
+    packed = np.zeros(len(df), dtype=np.int64)
+    missing = np.zeros(len(df), dtype=bool)
+    for categorical, size in zip(categoricals, sizes):
+        packed *= size
+        packed += categorical.codes
+        # Like `groupby`, ignore rows with any missing keys
+        missing |= categorical.codes == -1
+    counts = df[count].to_numpy(dtype=np.int64)
+    if missing.any():
+        packed = packed[~missing]
+        counts = counts[~missing]
+
+    possible = int(np.prod(sizes))
+    if possible <= DENSE_KEYS_PER_ROW * len(packed):
+        groups, totals = _sum_dense(packed, counts, possible)
+    else:
+        groups, totals = _sum_sorted(packed, counts)
+
+    columns = {}
+    for key, categorical, size in reversed(list(zip(keys, categoricals, sizes))):
+        groups, codes = np.divmod(groups, size)
+        columns[key] = pd.Categorical.from_codes(codes, dtype=categorical.dtype)
+    result = pd.DataFrame({key: columns[key] for key in keys})
+    result[count] = totals
+    return result
@@ -0,0 +1,84 @@
+"""Read many intermediate or processed files at once, in threads (the
+C CSV parser and zlib release the GIL for most of their work), and
+report how quickly each was read.
+
+"""
+from collections import deque
+from functools import partial
+from multiprocessing.pool import ThreadPool
+import os
+import time
+
+import pandas as pd
+
+from .intermediate_format import SUFFIX, read_intermediate_file
+
+
+def read_table(filename, dtypes, parse_dates=None):
+    """Read a file in the binary format of `intermediate_format`, or a
+    CSV, parsing only the columns in `dtypes` and `parse_dates`
+    """
+    if os.path.splitext(filename)[1] == SUFFIX:
+        return read_intermediate_file(filename)
+    columns = set(dtypes) | set(parse_dates or [])
+    return pd.read_csv(
+        filename,
+        engine="c",
+        na_filter=False,
+        usecols=lambda column: column in columns,
+        dtype=dtypes,
+        parse_dates=parse_dates,
+    )
+
+
+def _timed(read, filename):
+    start = time.perf_counter()
+    df = read(filename)
+    return df, time.perf_counter() - start
+
+
+def _reported(filename, result):
+    df, elapsed = result.get()
+    size = os.path.getsize(filename) / 1e6
+    print(
+        "Read {} rows ({:.1f}MB) from {} in {:.2f}s ({:.1f}MB/s)".format(
+            len(df),
+            size,
+            os.path.basename(filename),
+            elapsed,
+            size / max(elapsed, 1e-6),
+        )
+    )
+    return df
+
+
+def iter_tables(filenames, read, threads=None):
+    """Yield `(filename, DataFrame)` for each of `filenames`, in order,
+    as returned by `read(filename)`. Files are read in `threads` threads
+    (default: one per CPU), and no more than `threads` files are read
+    ahead of the one being yielded.
+    """
+    threads = threads or os.cpu_count() or 1
+    with ThreadPool(threads) as pool:
+        pending = deque()
+        for filename in filenames:
+            pending.append((filename, pool.apply_async(_timed, (read, filename))))
+            if len(pending) > threads:
+                filename, result = pending.popleft()
+                yield filename, _reported(filename, result)
+        while pending:
+            filename, result = pending.popleft()
+            yield filename, _reported(filename, result)
+
+
+def iter_intermediate_files(filenames, dtypes, threads=None):
+    """Yield `(filename, DataFrame)` for each intermediate file (binary,
+    or a CSV with the columns in `dtypes`), reading them in parallel,
+    with test codes and practice ids as categoricals
+    """
+    # Reading test codes and practice ids as categoricals saves
+    # creating a string for every row
+    dtypes = dict(dtypes, test_code="category", practice_id="category")
+    read = partial(read_table, dtypes=dtypes)
+    return iter_tables(filenames, read, threads)
+
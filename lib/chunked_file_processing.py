@@ -0,0 +1,106 @@
+"""A columnar alternative to `convert_part`, for labs whose
+configurations can read and normalise their input files as pandas
+DataFrames, a chunk of rows at a time
+
+"""
+from collections import Counter
+import csv
+import os
+import tempfile
+
+from . import settings
+from .intermediate_file_processing import ConvertedPart, NAMING_SAMPLE_SIZE
+from .input_cache import cached_chunks
+from .logger import log_summary
+from .overlap_index import fingerprint_sources, merged_fingerprints
+from .result_classification import (
+    compile_ref_range_table,
+    get_ref_range_table,
+    standard_convert_chunk_to_result,
+)
+
+
+def skip_old_chunk_data(df):
+    return df[df["month"] >= settings.DATE_FLOOR]
+
+
+def convert_part_in_chunks(
+    reference_ranges,
+    chunk_iterator,
+    drop_unwanted_chunk,
+    normalise_chunk,
+    source,
+    convert_chunk_to_result=None,
+    source_hash=None,
+):
+    """Normalise every chunk yielded by `chunk_iterator` for `source` (an
+    input filename, or a `FilePart` of one, whose file's content hash is
+    `source_hash`), returning a `ConvertedPart`, exactly as `convert_part`
+    does for rows.
+
+    Rather than being called once per row, each of the lab's functions
+    is called with a DataFrame of up to `settings.CHUNK_SIZE` rows, and
+    returns a DataFrame with unwanted rows removed.
+    """
+    if settings.AGGREGATE_INTERMEDIATE_FILES:
+        rows_file = None
+    else:
+        rows_file = tempfile.NamedTemporaryFile(mode="w", delete=False)
+        writer = csv.writer(rows_file)
+    convert_chunk_to_result = (
+        convert_chunk_to_result or standard_convert_chunk_to_result
+    )
+    if os.path.isfile(reference_ranges):
+        ref_range_table = get_ref_range_table(reference_ranges)
+    else:
+        ref_range_table = compile_ref_range_table({})
+
+    counts = Counter()
+    fingerprints = []
+    first_months = []
+    validated = False
+
+    # Execute a range of operations, per-chunk
+    for source_chunk in cached_chunks(chunk_iterator, source, source_hash):
+        chunk = drop_unwanted_chunk(source_chunk)
+        chunk = normalise_chunk(chunk)
+        chunk = skip_old_chunk_data(chunk)
+        if not len(chunk):
+            continue
+        chunk = convert_chunk_to_result(chunk, ref_range_table)
+
+        if not validated:
+            # Check all the required keys have been provided (in the
+            # first chunk only)
+            missing_keys = set(settings.REQUIRED_NORMALISED_KEYS) - set(chunk.columns)
+            assert not missing_keys, "Required keys missing: {}".format(missing_keys)
+            validated = True
+        if len(first_months) < NAMING_SAMPLE_SIZE:
+            # find most common date in this file, for naming
+            first_months.extend(
+                chunk["month"].iloc[: NAMING_SAMPLE_SIZE - len(first_months)]
+            )
+        # Only output the columns we care about
+        subset = chunk[settings.REQUIRED_NORMALISED_KEYS]
+        if rows_file:
+            writer.writerows(subset.itertuples(index=False, name=None))
+        else:
+            counts.update(
+                subset.groupby(settings.REQUIRED_NORMALISED_KEYS, sort=False)
+                .size()
+                .to_dict()
+            )
+            # Each row of the normalised chunk keeps the index of its
+            # source row
+            fingerprints.append(
+                fingerprint_sources(
+                    source_chunk.loc[chunk.index],
+                    chunk["month"],
+                    chunk["result_category"],
+                )
+            )
+    log_summary()
+    if rows_file:
+        rows_file.close()
+        return ConvertedPart(rows_file.name, counts, {}, first_months)
+    return ConvertedPart(None, counts, merged_fingerprints(fingerprints), first_months)
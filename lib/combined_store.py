@@ -0,0 +1,205 @@
+"""An append-only store of each lab's combined data (i.e. the counts
+from every intermediate file merged so far), partitioned by month.
+
+A lab's store is a directory of segments, each holding counts for a
+single month as an intermediate file (see `intermediate_format`). New
+data is always written as new segments, so adding data never rewrites
+what's already there, and only the months being read are loaded.
+Segments are named for the month and the batch of data they were
+appended from (`YYYY_MM_<batch>`), so appending a batch again (after an
+interrupted run) replaces its segments rather than adding to them.
+
+Each lab's unsuppressed counts are kept in the same format, with one
+segment per month, so that only the months which have changed need
+recounting.
+
+"""
+import json
+import os
+import shutil
+
+import pandas as pd
+
+from . import settings
+from .file_utils import atomic_write
+from .intermediate_format import (
+    SUFFIX,
+    concat_intermediate,
+    intermediate_file_rows,
+    read_intermediate_file,
+    write_intermediate_file,
+)
+
+
+# The batch of data moved from a legacy combined CSV
+MIGRATED_BATCH = "0000"
+
+
+def store_path(lab):
+    return settings.INTERMEDIATE_DIR / "{}combined_{}".format(settings.ENV, lab)
+
+
+def legacy_combined_path(lab):
+    """The CSV in which combined data used to be kept
+    """
+    return settings.INTERMEDIATE_DIR / "{}combined_{}.csv".format(settings.ENV, lab)
+
+
+def _segment_month(path):
+    year, month = path.stem.split("_")[:2]
+    return "{}/{}/01".format(year, month)
+
+
+def _list_segments(path):
+    segments = {}
+    for segment_path in sorted(path.glob("*" + SUFFIX)):
+        segments.setdefault(_segment_month(segment_path), []).append(segment_path)
+    return segments
+
+
+def list_segments(lab):
+    """Return a dict of month (as `%Y/%m/01`) to a sorted list of the
+    paths of its segments
+    """
+    return _list_segments(store_path(lab))
+
+
+def segment_batch(segment_path):
+    """Return the batch a segment was appended from
+    """
+    return segment_path.stem.split("_", 2)[2]
+
+
+def _write_segment(path, month, rows, name, fingerprints=None):
+    year, month_number = month.split("/")[:2]
+    segment_path = path / "{}_{}_{}{}".format(year, month_number, name, SUFFIX)
+    # An interrupted write never leaves part of a segment in the store
+    with atomic_write(segment_path) as f:
+        write_intermediate_file(f, rows, fingerprints)
+    return segment_path
+
+
+def append_segments(lab, df, batch, fingerprints=None):
+    """Add a DataFrame of REQUIRED_NORMALISED_KEYS and `count` columns
+    to a lab's store, as one segment for each month of `batch` (replacing
+    any written before), with the `fingerprints` of its results (see
+    `overlap_index`), returning the paths of the segments
+    """
+    path = store_path(lab)
+    os.makedirs(path, exist_ok=True)
+    fingerprints = fingerprints or {}
+    return [
+        _write_segment(
+            path,
+            month,
+            rows,
+            batch,
+            {month: fingerprints[month]} if month in fingerprints else None,
+        )
+        for month, rows in df.groupby(df["month"].astype(str), sort=True)
+    ]
+
+
+def segment_rows(segment_path):
+    """Return the number of rows in a segment, without reading it
+    """
+    return intermediate_file_rows(segment_path)
+
+
+def read_segment(segment_path):
+    """Return the rows of a single segment (as listed by `list_segments`)
+    """
+    return read_intermediate_file(segment_path)
+
+
+def _read_segments(path, months):
+    frames = []
+    for month, paths in sorted(_list_segments(path).items()):
+        if months is not None and month not in months:
+            continue
+        for segment_path in paths:
+            frames.append(read_segment(segment_path))
+    return concat_intermediate(frames)
+
+
+def read_segments(lab, months=None):
+    """Return a DataFrame of the REQUIRED_NORMALISED_KEYS and `count`
+    columns of every segment in a lab's store, or only of those for
+    `months`. Counts for the same keys in different segments aren't
+    summed.
+    """
+    return _read_segments(store_path(lab), months)
+
+
+def counts_path(lab):
+    """Where a lab's unsuppressed counts (i.e. its combined data, with
+    test codes normalised and counts summed) are kept, one segment per
+    month
+    """
+    return settings.INTERMEDIATE_DIR / "{}counts_{}".format(settings.ENV, lab)
+
+
+def list_counts_segments(lab):
+    """Return a dict of month to a list of the paths of a lab's counts
+    segments (of which there's one per month)
+    """
+    return _list_segments(counts_path(lab))
+
+
+def read_counts_manifest(lab):
+    """Return a dict describing what a lab's counts were computed from
+    (as last passed to `replace_counts`), or an empty dict
+    """
+    try:
+        with open(counts_path(lab) / "manifest.json") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def read_counts(lab, months=None):
+    """Return a DataFrame of a lab's counts, for every month or only for
+    `months`
+    """
+    return _read_segments(counts_path(lab), months)
+
+
+def replace_counts(lab, df, months, manifest):
+    """Replace a lab's counts for each of `months` with those in `df`,
+    and then its manifest with `manifest`
+    """
+    path = counts_path(lab)
+    os.makedirs(path, exist_ok=True)
+    existing = _list_segments(path)
+    by_month = dict(list(df.groupby(df["month"].astype(str))))
+    for month in months:
+        for segment_path in existing.get(month, []):
+            os.remove(segment_path)
+        if month in by_month:
+            _write_segment(path, month, by_month[month], "0000")
+    with atomic_write(path / "manifest.json", "w") as f:
+        json.dump(manifest, f)
+
+
+def migrate_combined_csv(lab):
+    """Move the data in a lab's legacy combined CSV (if there is one)
+    into its store
+    """
+    path = legacy_combined_path(lab)
+    if not path.exists():
+        return False
+    # Keep every month, even those now before DATE_FLOOR
+    dtypes = {"month": str, "test_code": str, "practice_id": str}
+    df = pd.read_csv(path, dtype=dtypes, na_filter=False)
+    if "count" not in df.columns:
+        df["count"] = 1
+    df = df.groupby(settings.REQUIRED_NORMALISED_KEYS)["count"].sum().reset_index()
+    remove_store(lab)
+    append_segments(lab, df, MIGRATED_BATCH)
+    os.remove(path)
+    return True
+
+
+def remove_store(lab):
+    shutil.rmtree(store_path(lab), ignore_errors=True)
+    shutil.rmtree(counts_path(lab), ignore_errors=True)
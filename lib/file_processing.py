@@ -1,16 +1,99 @@
+from collections import Counter, defaultdict, namedtuple
 from functools import partial
 from multiprocessing import Pool
 import glob
+import importlib
 import os
+import traceback
 
-from .intermediate_file_tracking import reset_lab, get_processed_filenames
+from .intermediate_file_tracking import (
+    file_fingerprints,
+    get_processed_fingerprints,
+    mark_as_duplicate,
+    mark_as_processed,
+    reset_lab,
+    update_fingerprints,
+)
 
-from .intermediate_file_processing import make_intermediate_file
+from .intermediate_file_processing import (
+    convert_part,
+    get_ref_ranges,
+    merge_converted_parts,
+)
+from .chunked_file_processing import convert_part_in_chunks
+from .combined_store import remove_store
+from .input_cache import content_hash
+from .input_splitting import source_size
+from .intermediate_format import SUFFIX
+from .logger import log_error, log_warning
+from .output_cache import remove_cached_output
+from .result_classification import get_ref_range_table
 
 from . import settings
 
+# A unit of work for the pool: convert `source` (all of `filename`, or
+# the part of it numbered `index`) for `lab`, by calling `convert`,
+# which carries all the lab-specific configuration it needs.
+# `source_hash` is the content hash of `filename`, computed once for
+# all its parts.
+ConversionTask = namedtuple(
+    "ConversionTask",
+    [
+        "lab",
+        "convert",
+        "filename",
+        "index",
+        "source",
+        "source_hash",
+        "reference_ranges",
+        "modules",
+    ],
+)
 
-def process_files(
+
+def init_worker(reference_ranges, modules):
+    """Load everything needed to convert files once per process, rather
+    than once per file: lab configuration modules (which build any
+    practice mappings when imported) and reference ranges
+    """
+    for module in modules:
+        importlib.import_module(module)
+    for path in reference_ranges:
+        if os.path.isfile(path):
+            get_ref_ranges(path)
+            get_ref_range_table(path)
+
+
+def convert_source(task):
+    """Convert a single file or part of a file, returning any exception
+    as a formatted traceback rather than raising it, so the failure is
+    confined to that file
+    """
+    try:
+        return task, task.convert(task.source, source_hash=task.source_hash), None
+    except Exception:
+        return task, None, traceback.format_exc()
+
+
+def process_files(lab, reference_ranges, filenames, *args, **kwargs):
+    """Process (normalise and anonymise) a list of filenames for a single
+    lab; see `make_conversion_tasks` and `run_conversion_tasks`, which
+    take the same arguments, for details.
+
+    Returns a list of files which couldn't be processed.
+
+    """
+    multiprocessing = kwargs.pop("multiprocessing", False)
+    jobs = kwargs.pop("jobs", None)
+    tasks, failed = make_conversion_tasks(
+        lab, reference_ranges, filenames, *args, **kwargs
+    )
+    return sorted(
+        failed + run_conversion_tasks(tasks, multiprocessing=multiprocessing, jobs=jobs)
+    )
+
+
+def make_conversion_tasks(
     lab,
     reference_ranges,
     filenames,
@@ -18,14 +101,37 @@ def process_files(
     drop_unwanted_data,
     normalise_data,
     convert_to_result,
-    multiprocessing=False,
     reimport=False,
     yes=False,
+    accept_changed=(),
+    chunk_iterator=None,
+    drop_unwanted_chunk=None,
+    normalise_chunk=None,
+    convert_chunk_to_result=None,
+    split_file=None,
+    row_columns=None,
 ):
-    """Process (normalise and anonymise) a list of filenames, using custom
-    functions that are passed in from per-lab configurations.
+    """Make a list of `ConversionTask`s to process (normalise and
+    anonymise) a list of filenames, using custom functions that are
+    passed in from per-lab configurations.
+
+    If `chunk_iterator` is provided, files are processed a DataFrame at
+    a time with the `*_chunk` functions, rather than row by row.
+
+    If `row_columns` (a lab's ROW_COLUMNS) is provided, only those
+    columns of each row yielded by `row_iterator` are kept, cached (see
+    `input_cache`) and fingerprinted (see `overlap_index`), so it must
+    list every column that `drop_unwanted_data` and `normalise_data`
+    use: the rest are dropped before either of them sees a row.
 
-    Any filenames already processed are skipped.
+    If `split_file` is provided, it is called with each filename to
+    split it into a list of `FilePart`s, which are converted in
+    parallel and then merged into a single intermediate file.
+
+    Any filenames already processed, or with the same contents as a
+    file already processed, are skipped. Returns the tasks, and a list
+    of files which couldn't be split, or which have changed since they
+    were processed (unless they're in `accept_changed`).
 
     """
     if reimport:
@@ -41,29 +147,204 @@ def process_files(
             # Delete everything, including the merged intermediate
             # files that are a running record of what's been done so
             # far
-            target_filenames = glob.glob(
-                str(settings.INTERMEDIATE_DIR / "{}*_{}*.csv".format(settings.ENV, lab))
-            )
+            target_filenames = [
+                filename
+                for suffix in [".csv", SUFFIX]
+                for filename in glob.glob(
+                    str(
+                        settings.INTERMEDIATE_DIR
+                        / "{}*_{}*{}".format(settings.ENV, lab, suffix)
+                    )
+                )
+            ]
             for target_filename in target_filenames:
                 os.remove(target_filename)
+            remove_store(lab)
+            remove_cached_output(lab)
         else:
-            return
-    filenames = sorted(filenames)
-    seen_filenames = get_processed_filenames(lab)
-    filenames = set(filenames) - set(seen_filenames)
-    if filenames:
-        make_intermediate_file_partial = partial(
-            make_intermediate_file,
-            lab,
+            return [], []
+    filenames, failed = _new_filenames(lab, sorted(set(filenames)), accept_changed)
+    if chunk_iterator:
+        convert = partial(
+            convert_part_in_chunks,
+            reference_ranges,
+            chunk_iterator,
+            drop_unwanted_chunk,
+            normalise_chunk,
+            convert_chunk_to_result=convert_chunk_to_result,
+        )
+    else:
+        convert = partial(
+            convert_part,
             reference_ranges,
             row_iterator,
             drop_unwanted_data,
             normalise_data,
             convert_to_result=convert_to_result,
+            row_columns=row_columns,
         )
-        if multiprocessing:
-            with Pool() as pool:
-                pool.map(make_intermediate_file_partial, filenames)
+    modules = tuple(
+        sorted(
+            set(
+                f.__module__
+                for f in [row_iterator, chunk_iterator, split_file]
+                if f is not None
+            )
+        )
+    )
+    tasks = []
+    for filename in filenames:
+        try:
+            parts = split_file(filename) if split_file else [filename]
+        except Exception:
+            log_error({}, "Unable to split %s:\n%s", filename, traceback.format_exc())
+            failed.append(filename)
+            continue
+        # Hashed already, when checking whether it's new
+        source_hash = content_hash(filename)
+        tasks.extend(
+            ConversionTask(
+                lab,
+                convert,
+                filename,
+                index,
+                part,
+                source_hash,
+                reference_ranges,
+                modules,
+            )
+            for index, part in enumerate(parts)
+        )
+    return tasks, failed
+
+
+def _new_filenames(lab, filenames, accept_changed=()):
+    """Return those `filenames` whose contents haven't already been
+    processed for `lab`, and those which have changed since they were
+    processed.
+
+    Files with the same contents as one already processed are recorded
+    as duplicates of it, so they're skipped quickly next time. The new
+    fingerprints of changed files in `accept_changed` are recorded, so
+    they're treated as unchanged from then on.
+
+    """
+    accept_changed = {os.path.abspath(filename) for filename in accept_changed}
+    known = get_processed_fingerprints(lab)
+    fingerprints = file_fingerprints(filenames, known)
+    processed = {}
+    for filename, fingerprint in known.items():
+        # Files processed before fingerprints were recorded can only be
+        # identified if they're still present
+        fingerprint = fingerprint or fingerprints.get(filename)
+        if fingerprint:
+            processed.setdefault(fingerprint.content_hash, filename)
+    new = []
+    changed = []
+    updated = {}
+    for filename in filenames:
+        fingerprint = fingerprints[filename]
+        original = processed.get(fingerprint.content_hash)
+        if filename in known:
+            if not known[filename]:
+                updated[filename] = fingerprint
+            elif known[filename].content_hash != fingerprint.content_hash:
+                if os.path.abspath(filename) in accept_changed:
+                    log_warning(
+                        {},
+                        "%s has changed since it was processed; keeping the "
+                        "data already processed from it",
+                        filename,
+                    )
+                    updated[filename] = fingerprint
+                else:
+                    log_warning(
+                        {},
+                        "%s has changed since it was processed; use "
+                        "--accept-changed to keep the data already processed "
+                        "from it, or --reimport to process every file again",
+                        filename,
+                    )
+                    changed.append(filename)
+            elif known[filename] != fingerprint:
+                # Touched, but not changed
+                updated[filename] = fingerprint
+        elif original:
+            log_warning({}, "%s is a duplicate of %s; skipping", filename, original)
+            if original in known:
+                mark_as_duplicate(lab, filename, fingerprint, original)
         else:
-            for f in filenames:
-                make_intermediate_file_partial(f)
+            processed[fingerprint.content_hash] = filename
+            new.append(filename)
+    if updated:
+        update_fingerprints(lab, updated)
+    return new, changed
+
+
+def run_conversion_tasks(tasks, multiprocessing=False, jobs=None):
+    """Run `ConversionTask`s (which may be for any number of labs),
+    largest first, by `jobs` processes if multiprocessing. A file that
+    fails to convert is logged and left unprocessed, without affecting
+    the others. Returns a list of such files.
+    """
+    if not tasks:
+        return []
+    tasks = sorted(tasks, key=lambda task: source_size(task.source), reverse=True)
+    initargs = (
+        sorted(set(task.reference_ranges for task in tasks)),
+        sorted(set(module for task in tasks for module in task.modules)),
+    )
+    # Loading in this process first means forked workers inherit
+    # everything already loaded
+    init_worker(*initargs)
+    if multiprocessing:
+        with Pool(jobs, initializer=init_worker, initargs=initargs) as pool:
+            return _merge_converted(tasks, pool.imap_unordered(convert_source, tasks))
+    else:
+        return _merge_converted(tasks, map(convert_source, tasks))
+
+
+def _merge_converted(tasks, results):
+    """Merge the converted parts of each file into an intermediate file
+    as soon as all of them are available, returning a list of files
+    which couldn't be converted.
+
+    Each lab's files are recorded as processed in a single transaction
+    once they've all been merged. Intermediate files left unrecorded by
+    an interruption are removed before the next merge (see
+    `remove_orphaned_files`), and their input files processed again.
+    """
+    remaining = Counter((task.lab, task.filename) for task in tasks)
+    converted = defaultdict(dict)
+    processed = defaultdict(list)
+    failed = set()
+    for task, converted_part, error in results:
+        key = (task.lab, task.filename)
+        remaining[key] -= 1
+        if error:
+            log_error({}, "Unable to convert %s:\n%s", task.filename, error)
+            failed.add(key)
+        else:
+            converted[key][task.index] = converted_part
+        if remaining[key]:
+            continue
+        done = converted.pop(key, {})
+        parts = [done[index] for index in sorted(done)]
+        if key in failed:
+            for part in parts:
+                if part.rows_filename:
+                    os.remove(part.rows_filename)
+            continue
+        try:
+            converted_filename = merge_converted_parts(task.lab, task.filename, parts)
+        except Exception:
+            log_error(
+                {}, "Unable to merge %s:\n%s", task.filename, traceback.format_exc()
+            )
+            failed.add(key)
+            continue
+        if converted_filename:
+            processed[task.lab].append((task.filename, converted_filename))
+    for lab, entries in processed.items():
+        mark_as_processed(lab, entries)
+    return sorted(filename for _, filename in failed)
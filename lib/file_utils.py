@@ -0,0 +1,69 @@
+"""Helpers for the files the pipeline writes, and the files it reads
+many times over.
+
+"""
+from functools import lru_cache, wraps
+import os
+import tempfile
+
+
+class atomic_write:
+    """A context manager which yields a temporary file (opened with
+    `mode`) in the same directory as `path`, and replaces `path` with it
+    when the block exits without an exception, or removes it otherwise,
+    so that an interrupted write never leaves part of a file at `path`.
+
+    Writers which outlive a `with` block can instead use `file`, and then
+    call `commit` or `discard` themselves.
+
+    """
+
+    def __init__(self, path, mode="wb"):
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.file = tempfile.NamedTemporaryFile(
+            mode, dir=directory, suffix=".tmp", delete=False
+        )
+
+    def commit(self):
+        self.file.close()
+        os.replace(self.file.name, self.path)
+
+    def discard(self):
+        self.file.close()
+        os.remove(self.file.name)
+
+    def __enter__(self):
+        return self.file
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.discard()
+
+
+def memoise_by_mtime(maxsize=128):
+    """Decorate a function whose first argument is a filename, to memoise
+    its results (for each filename and any other, hashable, arguments)
+    until the file's size or modification time changes. The function is
+    always called with the file's absolute path.
+    """
+
+    def decorator(function):
+        @lru_cache(maxsize=maxsize)
+        def memoised(filename, size, mtime, *args):
+            return function(filename, *args)
+
+        @wraps(function)
+        def wrapper(filename, *args):
+            stat = os.stat(filename)
+            return memoised(
+                os.path.abspath(filename), stat.st_size, stat.st_mtime_ns, *args
+            )
+
+        wrapper.cache_clear = memoised.cache_clear
+        return wrapper
+
+    return decorator
@@ -0,0 +1,364 @@
+"""Writing the final, all-labs output, one lab at a time, so the whole
+dataset is never held in memory at once.
+
+The output is written both as a zipped CSV, and as a columnar file
+(`all_processed.npz`) which can be loaded without any parsing. The
+columnar file is an uncompressed `.npz` (so `numpy.load` can read it)
+with these arrays:
+
+* `columns`: the names of the columns, in the same order as the CSV
+* `<column>`: the values of each integer column (see
+  FINAL_OUTPUT_DTYPES), as the smallest signed integer type that fits
+* `<column>.codes` and `<column>.categories`: every other column,
+  dictionary-encoded; each row's value is `categories[code]`, or
+  missing where the code is -1. Codes are the smallest signed integer
+  type that fits; categories are strings, integers, or (for `month`)
+  datetimes.
+
+As members are stored uncompressed, `load_final_columns` can
+memory-map each one in place, rather than reading it.
+
+"""
+import os
+import queue
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+from . import settings
+from .file_utils import atomic_write
+from .intermediate_format import (
+    DictionaryEncoder,
+    read_npy_header,
+    smallest_int,
+    write_npy,
+    write_npy_header,
+)
+
+# Rows formatted as CSV at a time
+CHUNK_ROWS = 100000
+
+# Formatted chunks waiting to be compressed
+QUEUE_SIZE = 4
+
+
+def final_csv_path():
+    return settings.FINAL_DIR / "all_processed.csv.zip"
+
+
+def final_columns_path():
+    return settings.FINAL_DIR / "all_processed.npz"
+
+
+def _final_columns(df, dtypes, columns):
+    """Convert columns to the types they'd have if read with `dtypes`,
+    in the order they'd have if concatenated with an empty DataFrame
+    with those columns (or in the order of `columns`, if given).
+    Returns the DataFrame and its columns.
+    """
+    if columns is None:
+        columns = list(dtypes) + [
+            column for column in df.columns if column not in dtypes
+        ]
+    df = df[[column for column in columns if column in df.columns]]
+    for column, dtype in dtypes.items():
+        # Only integer columns format differently after a round trip
+        # (e.g. floats like "2.0" are read as 2)
+        if dtype is int and column in df.columns:
+            values = df[column]
+            if values.dtype.name in ("object", "category"):
+                values = values.astype(str)
+            df = df.assign(**{column: values.astype(int)})
+    return df.reindex(columns=columns), columns
+
+
+class FinalCsvWriter:
+    """Streams DataFrames into a single zipped CSV, with the columns and
+    formatting it would have if they were read from CSVs with `dtypes`,
+    concatenated, and written with `to_csv`.
+
+    Rows are formatted as CSV in chunks, and compressed in a background
+    thread while the next chunk is formatted. The file at `path` is only
+    replaced once everything has been written (i.e. on leaving the
+    `with` block without an exception).
+
+    """
+
+    def __init__(self, path, dtypes=None):
+        self.path = path
+        self.dtypes = settings.FINAL_OUTPUT_DTYPES if dtypes is None else dtypes
+        self.columns = None
+        self.error = None
+
+    def __enter__(self):
+        self.output = atomic_write(self.path)
+        self.zip_file = zipfile.ZipFile(
+            self.output.file, "w", compression=zipfile.ZIP_DEFLATED
+        )
+        # As with `to_csv`, the member is named after the zip file
+        member_name = self.path.name[: -len(".zip")]
+        # The size isn't known up front, so allow for more than 2GB
+        self.member = self.zip_file.open(member_name, "w", force_zip64=True)
+        self.queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self.thread = threading.Thread(target=self._compress, daemon=True)
+        self.thread.start()
+        return self
+
+    def _compress(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                return
+            if self.error is None:
+                try:
+                    self.member.write(data)
+                except Exception as e:
+                    # Keep taking chunks off the queue, so `write`
+                    # doesn't block, until it sees the error
+                    self.error = e
+
+    def _put(self, data):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(data)
+
+    def write(self, df):
+        """Append the rows of a DataFrame
+        """
+        first = self.columns is None
+        df, self.columns = _final_columns(df, self.dtypes, self.columns)
+        if first:
+            self._put(df.iloc[:0].to_csv(index=False).encode("utf8"))
+        for start in range(0, len(df), CHUNK_ROWS):
+            chunk = df.iloc[start : start + CHUNK_ROWS]
+            self._put(chunk.to_csv(index=False, header=False).encode("utf8"))
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None and self.error is None and self.columns is None:
+            # Nothing was written, so write the header of an empty file
+            self.queue.put(",".join(self.dtypes).encode("utf8") + b"\n")
+        self.queue.put(None)
+        self.thread.join()
+        try:
+            self.member.close()
+            self.zip_file.close()
+        except Exception as e:
+            self.error = self.error or e
+        if exc_type is None and self.error is None:
+            self.output.commit()
+        else:
+            self.output.discard()
+            if exc_type is None:
+                raise self.error
+
+
+def _copy_member(zip_file, name, f, from_dtype, to_dtype):
+    """Write the values in a file of `from_dtype` values as an array of
+    `to_dtype`
+    """
+    f.flush()
+    length = os.path.getsize(f.name) // np.dtype(from_dtype).itemsize
+    f.seek(0)
+    with zip_file.open(name + ".npy", "w", force_zip64=True) as member:
+        write_npy_header(member, to_dtype, length)
+        for start in range(0, length, CHUNK_ROWS):
+            values = np.fromfile(f, dtype=from_dtype, count=CHUNK_ROWS)
+            member.write(values.astype(to_dtype).tobytes())
+
+
+class FinalColumnsWriter:
+    """Streams DataFrames into a single columnar file (see the layout
+    above), with the columns and types they would have in a
+    `FinalCsvWriter`.
+
+    Each column is accumulated in its own temporary file, and only
+    assembled into the file at `path` on leaving the `with` block
+    without an exception.
+
+    """
+
+    def __init__(self, path, dtypes=None):
+        self.path = path
+        self.dtypes = settings.FINAL_OUTPUT_DTYPES if dtypes is None else dtypes
+        self.columns = None
+
+    def __enter__(self):
+        os.makedirs(self.path.parent, exist_ok=True)
+        self.directory = tempfile.mkdtemp(dir=self.path.parent, suffix=".tmp")
+        self.files = {}
+        self.encoders = {}
+        self.ranges = {}
+        return self
+
+    def _is_integer(self, column):
+        return self.dtypes.get(column) is int
+
+    def write(self, df):
+        """Append the rows of a DataFrame
+        """
+        df, self.columns = _final_columns(df, self.dtypes, self.columns)
+        for i, column in enumerate(self.columns):
+            if column not in self.files:
+                self.files[column] = open(os.path.join(self.directory, str(i)), "w+b")
+                if not self._is_integer(column):
+                    self.encoders[column] = DictionaryEncoder()
+            if self._is_integer(column):
+                values = df[column].to_numpy(dtype=np.int64)
+                values.tofile(self.files[column])
+                if len(values):
+                    low, high = self.ranges.get(column, (0, 0))
+                    self.ranges[column] = (
+                        min(low, values.min()),
+                        max(high, values.max()),
+                    )
+            else:
+                self.encoders[column].encode(df[column]).tofile(self.files[column])
+
+    def _assemble(self, f):
+        columns = self.columns or list(self.dtypes)
+        with zipfile.ZipFile(f, "w", compression=zipfile.ZIP_STORED) as zip_file:
+            write_npy(zip_file, "columns", np.array(columns, dtype=str))
+            for column in columns:
+                if column not in self.files:
+                    # Nothing was written
+                    if self._is_integer(column):
+                        write_npy(zip_file, column, np.array([], dtype=np.int64))
+                    else:
+                        write_npy(
+                            zip_file, column + ".codes", np.array([], dtype=np.int8)
+                        )
+                        write_npy(
+                            zip_file, column + ".categories", np.array([], dtype=str)
+                        )
+                elif self._is_integer(column):
+                    low, high = self.ranges.get(column, (0, 0))
+                    _copy_member(
+                        zip_file,
+                        column,
+                        self.files[column],
+                        np.int64,
+                        smallest_int(low, high),
+                    )
+                else:
+                    categories = self.encoders[column].categories()
+                    code_dtype = smallest_int(-1, len(categories) - 1)
+                    _copy_member(
+                        zip_file,
+                        column + ".codes",
+                        self.files[column],
+                        np.int32,
+                        code_dtype,
+                    )
+                    write_npy(zip_file, column + ".categories", categories)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                with atomic_write(self.path) as f:
+                    self._assemble(f)
+        finally:
+            for f in self.files.values():
+                f.close()
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class FinalOutputWriter:
+    """Streams DataFrames into both the final zipped CSV and the final
+    columnar file
+    """
+
+    def __init__(self, csv_path=None, columns_path=None):
+        self.path = csv_path or final_csv_path()
+        self.writers = [
+            FinalCsvWriter(self.path),
+            FinalColumnsWriter(columns_path or final_columns_path()),
+        ]
+
+    def __enter__(self):
+        self.entered = []
+        try:
+            for writer in self.writers:
+                self.entered.append(writer.__enter__())
+        except BaseException:
+            self.__exit__(*sys.exc_info())
+            raise
+        return self
+
+    def write(self, df):
+        for writer in self.writers:
+            writer.write(df)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Leave every writer, even if an earlier one fails, so none of
+        # them leave temporary files behind
+        error = None
+        for writer in reversed(self.entered):
+            try:
+                writer.__exit__(exc_type, exc_value, traceback)
+            except Exception as e:
+                if exc_type is None and error is None:
+                    error = e
+                    exc_type, exc_value, traceback = type(e), e, e.__traceback__
+        if error is not None:
+            raise error
+
+
+def _member_offset(f, info):
+    """Return the offset of the data of an uncompressed zip member
+    """
+    f.seek(info.header_offset)
+    header = f.read(30)
+    name_length, extra_length = struct.unpack("<HH", header[26:30])
+    return info.header_offset + 30 + name_length + extra_length
+
+
+def load_final_columns(path=None):
+    """Return a dict of every array in a columnar file (see the layout
+    above), keyed by member name (e.g. "count", "month.codes"), each
+    memory-mapped rather than read
+    """
+    path = path or final_columns_path()
+    arrays = {}
+    with zipfile.ZipFile(path) as zip_file, open(path, "rb") as f:
+        for info in zip_file.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError("{} is compressed".format(info.filename))
+            f.seek(_member_offset(f, info))
+            shape, dtype = read_npy_header(f)
+            name = info.filename[: -len(".npy")]
+            if np.prod(shape) == 0:
+                arrays[name] = np.empty(shape, dtype=dtype)
+            else:
+                arrays[name] = np.memmap(
+                    path, dtype=dtype, mode="r", offset=f.tell(), shape=shape
+                )
+    return arrays
+
+
+def read_final_columns(path=None):
+    """Return a columnar file (see the layout above) as a DataFrame, with
+    dictionary-encoded columns as categoricals
+    """
+    arrays = load_final_columns(path)
+    columns = {}
+    for column in arrays["columns"].tolist():
+        # pandas treats `memmap`s as sequences of Python objects, but
+        # a plain view of one as an array
+        if column in arrays:
+            columns[column] = np.asarray(arrays[column])
+        else:
+            categories = arrays[column + ".categories"]
+            if categories.dtype.kind == "U":
+                categories = categories.astype(object)
+            columns[column] = pd.Categorical.from_codes(
+                np.asarray(arrays[column + ".codes"]), categories
+            )
+    # Passing `columns` too makes pandas convert categoricals of dates to
+    # objects, but the dict is already in order
+    return pd.DataFrame(columns)
@@ -0,0 +1,382 @@
+"""A cache of the rows parsed from input files, so that reprocessing a
+file (after a reimport, or a change to reference ranges or to how rows
+are normalised) needn't parse it again.
+
+Each entry holds the columns yielded by a lab's `row_iterator` (or
+just its ROW_COLUMNS) or `chunk_iterator` for a single input file (or
+`FilePart`), as an `.npz` file of dictionary-encoded columns. Entries
+are written and read a chunk of rows at a time (of CHUNK_SIZE rows, or
+of each DataFrame yielded by `chunk_iterator`), each chunk encoded
+separately, so caching or reading a file needs memory for only one
+chunk of it. Entries
+are keyed by the contents of the input file, the source of the lab's
+configuration and of the modules which read input files, and the
+settings which affect what's read, so a changed file or reader is
+never read from the cache. The least recently used entries are
+removed when the cache grows larger than INPUT_CACHE_SIZE.
+
+"""
+from collections import namedtuple
+import datetime
+import hashlib
+import importlib
+import json
+import os
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+from . import settings
+from .file_utils import atomic_write, memoise_by_mtime
+from .input_splitting import FilePart
+from .intermediate_format import DictionaryEncoder, smallest_int, write_npy
+from .logger import log_info, log_warning
+
+# Bump this to invalidate every existing entry
+CACHE_FORMAT_VERSION = 3
+
+# Modules (besides a lab's own configuration) whose code determines the
+# rows read from input files
+READER_MODULES = ["lib.input_splitting", "lib.xlsx_reading"]
+
+CacheEntry = namedtuple(
+    "CacheEntry", ["key", "size", "last_used", "source", "iterator"]
+)
+
+
+@memoise_by_mtime(maxsize=1024)
+def content_hash(filename):
+    """Return the SHA-256 hex digest of a file's contents
+    """
+    digest = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _reader_hashes(iterator):
+    """Return the content hashes of the source of `iterator`'s module
+    (i.e. the lab's configuration, with any helpers and constants it
+    uses) and of READER_MODULES
+    """
+    modules = [iterator.__module__] + READER_MODULES
+    return [
+        content_hash(importlib.import_module(module).__file__) for module in modules
+    ]
+
+
+def cache_key(iterator, source, columns=None, source_hash=None):
+    """Return a key for the rows (or only the `columns` of them)
+    `iterator` yields for `source` (a filename or `FilePart`), whose
+    file's content hash is `source_hash` (computed if not given)
+    """
+    if isinstance(source, FilePart):
+        filename, part = source.filename, [source.member, source.start, source.end]
+    else:
+        filename, part = source, None
+    digest = hashlib.sha256()
+    digest.update(
+        json.dumps(
+            [
+                CACHE_FORMAT_VERSION,
+                source_hash or content_hash(filename),
+                part,
+                iterator.__module__,
+                iterator.__qualname__,
+                columns,
+                _reader_hashes(iterator),
+                settings.CHUNK_SIZE,
+            ]
+        ).encode("utf8")
+    )
+    return digest.hexdigest()
+
+
+def _entry_path(key):
+    return settings.INPUT_CACHE_DIR / "{}.npz".format(key)
+
+
+def _encode_strings(values):
+    offsets = np.cumsum([0] + [len(value) for value in values], dtype=np.int64)
+    text = np.frombuffer("".join(values).encode("utf8"), dtype=np.uint8)
+    return text, offsets
+
+
+def _decode_strings(text, offsets):
+    text = text.tobytes().decode("utf8")
+    values = np.empty(len(offsets) - 1, dtype=object)
+    values[:] = [text[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+    return values
+
+
+def _is_strings(values):
+    return pd.api.types.infer_dtype(values, skipna=False) in ("string", "empty")
+
+
+class _EntryWriter:
+    """Writes the entry for `key` a chunk at a time, until it's either
+    committed to the cache or discarded
+    """
+
+    def __init__(self, key, columns):
+        self.columns = columns
+        self.chunks = []
+        # Concurrent readers never see part of an entry
+        self.output = atomic_write(_entry_path(key))
+        self.zip_file = zipfile.ZipFile(self.output.file, "w", allowZip64=True)
+
+    def write(self, index_start, values):
+        """Add a chunk of rows, given the index of its first row and a
+        sequence of the values of each column
+        """
+        number = len(self.chunks)
+        for i, column_values in enumerate(values):
+            encoder = DictionaryEncoder()
+            codes = encoder.encode(np.asarray(column_values, dtype=object))
+            text, offsets = _encode_strings(list(encoder.index))
+            dtype = smallest_int(-1, len(encoder.index) - 1)
+            arrays = {"codes": codes.astype(dtype), "text": text, "offsets": offsets}
+            for name, array in arrays.items():
+                write_npy(self.zip_file, "{}_{}_{}".format(name, number, i), array)
+        self.chunks.append((index_start, len(values[0])))
+
+    def commit(self, source, iterator):
+        text, offsets = _encode_strings(self.columns)
+        write_npy(self.zip_file, "columns_text", text)
+        write_npy(self.zip_file, "columns_offsets", offsets)
+        chunks = np.array(self.chunks, dtype=np.int64).reshape(-1, 2)
+        write_npy(self.zip_file, "chunks", chunks)
+        meta = {
+            "source": os.path.abspath(
+                source.filename if isinstance(source, FilePart) else source
+            ),
+            "part": list(source[1:]) if isinstance(source, FilePart) else None,
+            "iterator": "{}.{}".format(iterator.__module__, iterator.__qualname__),
+            "created": datetime.datetime.now().isoformat(),
+        }
+        meta = np.frombuffer(json.dumps(meta).encode("utf8"), dtype=np.uint8)
+        write_npy(self.zip_file, "meta", meta)
+        self.zip_file.close()
+        self.output.commit()
+        prune_cache(settings.INPUT_CACHE_SIZE)
+
+    def discard(self):
+        self.zip_file.close()
+        self.output.discard()
+
+
+def _open(key):
+    """Return the open `.npz` of the entry for `key`, its column names,
+    and its chunks' index starts and lengths, or None if there isn't a
+    readable entry
+    """
+    path = _entry_path(key)
+    try:
+        entry = np.load(path)
+    except FileNotFoundError:
+        return None
+    try:
+        columns = list(_decode_strings(entry["columns_text"], entry["columns_offsets"]))
+        chunks = entry["chunks"].tolist()
+    except Exception as e:
+        entry.close()
+        log_warning({}, "Ignoring unreadable cache entry %s: %s", path, e)
+        return None
+    # Record the use, for least-recently-used eviction
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+    return entry, columns, chunks
+
+
+def _read_chunks(entry, columns, chunks):
+    """Yield the index start and decoded columns of each chunk of an
+    entry opened by `_open`, closing it once they've all been read
+    """
+    with entry:
+        for number, (index_start, _) in enumerate(chunks):
+            yield index_start, [
+                _decode_strings(
+                    entry["text_{}_{}".format(number, i)],
+                    entry["offsets_{}_{}".format(number, i)],
+                )[entry["codes_{}_{}".format(number, i)]]
+                for i in range(len(columns))
+            ]
+
+
+def _projected(rows, columns):
+    for row in rows:
+        yield {column: row[column] for column in columns}
+
+
+def cached_rows(row_iterator, source, columns=None, source_hash=None):
+    """Yield the same dicts as `row_iterator(source)` (with only the keys
+    in `columns`, if given), from the cache if possible; otherwise,
+    cache them as they're yielded.
+
+    Rows are only cached if they all have the same keys, and only
+    strings as values.
+
+    """
+    rows = row_iterator(source)
+    if columns is not None:
+        rows = _projected(rows, columns)
+    if not settings.INPUT_CACHE_SIZE:
+        yield from rows
+        return
+    key = cache_key(row_iterator, source, columns, source_hash)
+    cached = _open(key)
+    if cached:
+        log_info({}, "Reading %s from input cache", source)
+        entry, columns, chunks = cached
+        for _, values in _read_chunks(entry, columns, chunks):
+            for row in zip(*[column.tolist() for column in values]):
+                yield dict(zip(columns, row))
+        return
+    columns = None
+    writer = None
+    pending = []
+    position = 0
+    try:
+        for row in rows:
+            if columns is None:
+                columns = list(row.keys())
+                writer = _EntryWriter(key, columns)
+            if writer is not None:
+                if list(row.keys()) != columns or not all(
+                    isinstance(value, str) for value in row.values()
+                ):
+                    writer.discard()
+                    writer = None
+                    pending = []
+                else:
+                    pending.append(tuple(row.values()))
+                    if len(pending) >= settings.CHUNK_SIZE:
+                        writer.write(position, list(zip(*pending)))
+                        position += len(pending)
+                        pending = []
+            yield row
+        if writer is not None:
+            if pending:
+                writer.write(position, list(zip(*pending)))
+            writer.commit(source, row_iterator)
+            writer = None
+    finally:
+        # The rows weren't all yielded, or couldn't be cached
+        if writer is not None:
+            writer.discard()
+
+
+def cached_chunks(chunk_iterator, source, source_hash=None):
+    """Yield the same DataFrames as `chunk_iterator(source)`, from the
+    cache if possible; otherwise, cache them as they're yielded.
+
+    Chunks are only cached if they all have the same string columns,
+    and a default (i.e. `RangeIndex`) index.
+
+    """
+    if not settings.INPUT_CACHE_SIZE:
+        yield from chunk_iterator(source)
+        return
+    key = cache_key(chunk_iterator, source, source_hash=source_hash)
+    cached = _open(key)
+    if cached:
+        log_info({}, "Reading %s from input cache", source)
+        entry, columns, chunks = cached
+        for (index_start, length), (_, values) in zip(
+            chunks, _read_chunks(entry, columns, chunks)
+        ):
+            yield pd.DataFrame(
+                dict(zip(columns, values)),
+                index=pd.RangeIndex(index_start, index_start + length),
+                columns=columns,
+            )
+        return
+    columns = None
+    writer = None
+    try:
+        for chunk in chunk_iterator(source):
+            if columns is None:
+                columns = list(chunk.columns)
+                writer = _EntryWriter(key, columns)
+            index = chunk.index
+            if writer is not None:
+                if (
+                    list(chunk.columns) != columns
+                    or not isinstance(index, pd.RangeIndex)
+                    or index.step != 1
+                    or not all(_is_strings(chunk[column]) for column in columns)
+                ):
+                    writer.discard()
+                    writer = None
+                else:
+                    writer.write(
+                        index.start, [chunk[column].to_numpy() for column in columns]
+                    )
+            yield chunk
+        if writer is not None:
+            writer.commit(source, chunk_iterator)
+            writer = None
+    finally:
+        # The chunks weren't all yielded, or couldn't be cached
+        if writer is not None:
+            writer.discard()
+
+
+def list_cache_entries():
+    """Return a `CacheEntry` for every entry in the cache, most recently
+    used first
+    """
+    entries = []
+    for path in settings.INPUT_CACHE_DIR.glob("*.npz"):
+        try:
+            stat = path.stat()
+            with np.load(path) as entry:
+                meta = json.loads(entry["meta"].tobytes().decode("utf8"))
+        except Exception:
+            continue
+        source = meta["source"]
+        if meta.get("part"):
+            source += " {}".format(
+                " ".join(str(x) for x in meta["part"] if x is not None)
+            )
+        entries.append(
+            CacheEntry(
+                path.stem,
+                stat.st_size,
+                datetime.datetime.fromtimestamp(stat.st_mtime),
+                source,
+                meta["iterator"],
+            )
+        )
+    return sorted(entries, key=lambda entry: entry.last_used, reverse=True)
+
+
+def prune_cache(max_size):
+    """Remove the least recently used entries until the cache is no
+    larger than `max_size` bytes. Returns the number of entries removed.
+    """
+    if not settings.INPUT_CACHE_DIR.exists():
+        return 0
+    paths = []
+    for path in settings.INPUT_CACHE_DIR.glob("*.npz"):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        paths.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in paths)
+    removed = 0
+    for _, size, path in sorted(paths):
+        if total <= max_size:
+            break
+        try:
+            os.remove(path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+        total -= size
+    return removed
@@ -0,0 +1,118 @@
+"""Functions for splitting large input files into parts which can be
+converted in parallel, and for reading those parts back
+
+"""
+from collections import namedtuple
+import io
+import os
+import zipfile
+
+from . import settings
+
+# A part of an input file: either the byte range `[start, end)` of a
+# plain CSV, or a single `member` of a zip file
+FilePart = namedtuple("FilePart", ["filename", "member", "start", "end"])
+
+BLOCK_SIZE = 16 * 1024 * 1024
+
+
+def split_csv(filename, part_size=None):
+    """Split a plain CSV file into parts of roughly `part_size` bytes,
+    each starting at the beginning of a record.
+
+    A newline only ends a record when an even number of quote
+    characters precede it, so rows with quoted newlines are never split
+    (but rows containing stray quotes outside quoted fields may be
+    misaligned).
+
+    """
+    part_size = part_size or settings.SPLIT_FILE_SIZE
+    size = os.path.getsize(filename)
+    with open(filename, "rb") as f:
+        starts = [len(f.readline())]
+        position = starts[0]
+        quotes = 0
+        for block in iter(lambda: f.read(BLOCK_SIZE), b""):
+            counted_to = 0
+            search_from = 0
+            while True:
+                target = starts[-1] + part_size - position
+                if target >= len(block):
+                    break
+                newline = block.find(b"\n", max(target, search_from))
+                if newline == -1:
+                    break
+                quotes += block.count(b'"', counted_to, newline)
+                counted_to = search_from = newline + 1
+                if quotes % 2 == 0:
+                    starts.append(position + newline + 1)
+            quotes += block.count(b'"', counted_to)
+            position += len(block)
+    starts = [start for start in starts if start < size] or [size]
+    ends = starts[1:] + [size]
+    return [FilePart(filename, None, start, end) for start, end in zip(starts, ends)]
+
+
+def split_zip(filename):
+    """Split a zip file into one part per member
+    """
+    with zipfile.ZipFile(filename) as zf:
+        return [FilePart(filename, member, None, None) for member in zf.namelist()]
+
+
+class _FileRange(io.RawIOBase):
+    """A readable view of the byte range `[start, end)` of an open file
+    """
+
+    def __init__(self, f, start, end):
+        f.seek(start)
+        self.f = f
+        self.remaining = end - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.f.read(min(len(buffer), self.remaining))
+        buffer[: len(data)] = data
+        self.remaining -= len(data)
+        return len(data)
+
+
+def iter_csv_lines(source):
+    """Yield the lines of a plain CSV file, exactly as `open(filename)`
+    would; or, for a `FilePart`, its header line followed by the lines
+    in the part's byte range
+    """
+    if not isinstance(source, FilePart):
+        with open(source, "r") as f:
+            yield from f
+        return
+    with open(source.filename, "r") as f:
+        yield f.readline()
+    with open(source.filename, "rb") as f:
+        yield from io.TextIOWrapper(
+            io.BufferedReader(_FileRange(f, source.start, source.end))
+        )
+
+
+def zip_members(source):
+    """Return the filename of the zip file for a filename or `FilePart`,
+    and a list of the members to read from it
+    """
+    if isinstance(source, FilePart):
+        return source.filename, [source.member]
+    with zipfile.ZipFile(source) as zf:
+        return source, zf.namelist()
+
+
+def source_size(source):
+    """Return the (uncompressed, where possible) size in bytes of a
+    filename or `FilePart`, for scheduling the largest first
+    """
+    if not isinstance(source, FilePart):
+        return os.path.getsize(source)
+    if source.member is not None:
+        with zipfile.ZipFile(source.filename) as zf:
+            return zf.getinfo(source.member).file_size
+    return source.end - source.start
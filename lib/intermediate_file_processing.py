@@ -2,25 +2,76 @@
 
 Currently only works for XLS formatted inputs without column headers
 """
-from collections import Counter
+from bisect import bisect_right
+from collections import Counter, defaultdict, namedtuple
 from functools import lru_cache
 import csv
 import os
+import shutil
 import tempfile
 
 from . import settings
+from .input_cache import cached_rows
 from .intermediate_file_tracking import mark_as_processed
+from .intermediate_format import SUFFIX, counts_to_dataframe, write_intermediate_file
 
-from .logger import log_info, log_warning
+from .logger import log_info, log_summary, log_warning
+from .overlap_index import RowFingerprints, merged_fingerprints
 
 
 class StopProcessing(Exception):
     pass
 
 
-@lru_cache(maxsize=1)
+# A compiled set of reference ranges for a single test. `boundaries`
+# is a sorted list of integer ages; `segments[i]` describes every age
+# in `[boundaries[i], boundaries[i + 1])`, and is either `None` (no
+# reference range covers that age) or a dict mapping sex ("M" or "F")
+# to a `(low, high)` tuple of floats, or to `None` if the range
+# doesn't define both bounds for that sex.
+AgeBands = namedtuple("AgeBands", ["boundaries", "segments"])
+
+
+def _compile_age_bands(lines):
+    """Convert every reference range row for a single test into an
+    `AgeBands` lookup.
+
+    Rows may overlap; as with a scan over the rows in file order, the
+    first row whose `[min_adult_age, max_adult_age)` interval contains
+    an age is the one that applies to it.
+
+    """
+    bands = []
+    for line in lines:
+        bounds = {}
+        for sex in ["M", "F"]:
+            if line["low_" + sex] and line["high_" + sex]:
+                bounds[sex] = (float(line["low_" + sex]), float(line["high_" + sex]))
+            else:
+                bounds[sex] = None
+        bands.append(
+            (
+                int(float(line["min_adult_age"])),
+                int(float(line["max_adult_age"])),
+                bounds,
+            )
+        )
+    boundaries = sorted(set(age for band in bands for age in band[:2]))
+    segments = []
+    for start, end in zip(boundaries, boundaries[1:]):
+        segment = None
+        for min_age, max_age, bounds in bands:
+            if min_age <= start and end <= max_age:
+                segment = bounds
+                break
+        segments.append(segment)
+    return AgeBands(boundaries, segments)
+
+
+@lru_cache(maxsize=None)
 def get_ref_ranges(path):
-    """Load a CSV of reference ranges into a list of dicts
+    """Load a CSV of reference ranges into a dict of test code to
+    `AgeBands`, for lookup by `standard_convert_to_result`
     """
     required_cols = [
         "test",
@@ -32,17 +83,19 @@ def get_ref_ranges(path):
         "high_M",
     ]
     with open(path, newline="", encoding="ISO-8859-1") as f:
-        lines = sorted(list(csv.DictReader(f)), key=lambda x: x["test"])
+        lines = list(csv.DictReader(f))
     assert set(required_cols).issubset(
         set(lines[0].keys())
     ), "CSV at {} must define columns {}, has {}".format(
         path, required_cols, lines[0].keys()
     )
-    return lines
-
-
-# Cache the fact any reference ranges are missing
-NO_REF_RANGES = set()
+    lines_by_test = defaultdict(list)
+    for line in lines:
+        lines_by_test[line["test"]].append(line)
+    return {
+        test: _compile_age_bands(test_lines)
+        for test, test_lines in lines_by_test.items()
+    }
 
 
 def skip_old_data(row):
@@ -51,7 +104,7 @@ def skip_old_data(row):
 
 
 def standard_convert_to_result(row, ranges):
-    """Given a row and a list of reference ranges, set a value of the
+    """Given a row and compiled reference ranges, set a value of the
     `result_category` key in the `row` dict, and return that row
 
     A row is a dict with these keys:
@@ -61,8 +114,8 @@ def standard_convert_to_result(row, ranges):
     Every data source is expected to (and by this point, already
     validated to) return these keys.
 
-    A list of reference ranges is a list where each element is a dict
-    with the keys
+    Reference ranges are a dict of test code to `AgeBands`, as
+    returned by `get_ref_ranges`, compiled from a CSV with the columns
 
         ["test", "min_adult_age", "max_adult_age", "low_F", "low_M", "high_F", "high_M"]
 
@@ -79,96 +132,79 @@ def standard_convert_to_result(row, ranges):
     sex = row["sex"]
     age = row["age"]
     direction = row["direction"]
-    if test_code in NO_REF_RANGES:
+    bands = ranges.get(test_code)
+    if bands is None:
+        log_info(row, "Couldn't find ref range")
         row["result_category"] = settings.ERR_NO_REF_RANGE
         return row
-    last_matched_test = None
-    found = False
-    return_code = None
-    for ref_range in ranges:
-        if ref_range["test"] == test_code:
-            found = True
-            if not isinstance(result, float):
-                log_info(row, "Unparseable result")
-                return_code = settings.ERR_UNPARSEABLE_RESULT
-                break
-            high = low = None
-            if last_matched_test and last_matched_test != ref_range["test"]:
-                # We can short-circuit as the rows are sorted by test
-                log_info(row, "No matching ref range found")
-                return_code = settings.ERR_NO_REF_RANGE
-                break
-            last_matched_test = ref_range["test"]
-            if age >= int(float(ref_range["min_adult_age"])) and age < int(
-                float(ref_range["max_adult_age"])
-            ):
-                # We've found a reference range matching this row's age
-                if sex == "M":
-                    if ref_range["low_M"] and ref_range["high_M"]:
-                        low = float(ref_range["low_M"])
-                        high = float(ref_range["high_M"])
-                elif sex == "F":
-                    if ref_range["low_F"] and ref_range["high_F"]:
-                        low = float(ref_range["low_F"])
-                        high = float(ref_range["high_F"])
-                else:
-                    return_code = settings.ERR_INVALID_SEX
-                    log_info(row, "Invalid sex %s", sex)
-                    break
-                if low != "" and high != "" and low is not None and high is not None:
-                    if result > high:
-                        if direction == "<":
-                            log_warning(
-                                row, "Over range %s but result <; invalid", high
-                            )
-                            return_code = settings.ERR_INVALID_RANGE_WITH_DIRECTION
-                            break
-                        else:
-                            log_info(row, "Over range %s", high)
-                            return_code = settings.OVER_RANGE
-                            break
-                    elif result < low:
-                        if direction == ">":
-                            log_warning(row, "Under range %s but >; invalid", high)
-                            return_code = settings.ERR_INVALID_RANGE_WITH_DIRECTION
-                            break
-                        else:
-                            log_info(row, "Under range %s", low)
-                            return_code = settings.UNDER_RANGE
-                            break
-                    else:
-                        if not direction or (
-                            (direction == "<" and low == 0)
-                            or (direction == ">" and high == settings.RANGE_CEILING)
-                        ):
-                            log_info(row, "Within range %s - %s", low, high)
-                            return_code = settings.WITHIN_RANGE
-                            break
-                        else:
-                            log_warning(
-                                row,
-                                "Within range %s-%s but direction %s; invalid",
-                                low,
-                                high,
-                                direction,
-                            )
-                            return_code = settings.ERR_INVALID_RANGE_WITH_DIRECTION
-                            break
-
-                else:
-                    return_code = settings.ERR_INVALID_REF_RANGE
-                    log_warning(row, "Couldn't process ref range %s - %s", low, high)
-                    break
-            else:
-                return_code = settings.ERR_DISCARDED_AGE
-    if not found:
-        NO_REF_RANGES.add(test_code)
-        log_info(row, "Couldn't find ref range")
-        return_code = settings.ERR_NO_REF_RANGE
+    if not isinstance(result, float):
+        log_info(row, "Unparseable result")
+        row["result_category"] = settings.ERR_UNPARSEABLE_RESULT
+        return row
+    index = bisect_right(bands.boundaries, age) - 1
+    if index < 0 or index >= len(bands.segments) or bands.segments[index] is None:
+        # No reference range applies to this row's age
+        row["result_category"] = settings.ERR_DISCARDED_AGE
+        return row
+    bounds = bands.segments[index]
+    if sex not in bounds:
+        log_info(row, "Invalid sex %s", sex)
+        row["result_category"] = settings.ERR_INVALID_SEX
+        return row
+    if bounds[sex] is None:
+        log_warning(row, "Couldn't process ref range %s - %s", None, None)
+        row["result_category"] = settings.ERR_INVALID_REF_RANGE
+        return row
+    low, high = bounds[sex]
+    if result > high:
+        if direction == "<":
+            log_warning(row, "Over range %s but result <; invalid", high)
+            return_code = settings.ERR_INVALID_RANGE_WITH_DIRECTION
+        else:
+            log_info(row, "Over range %s", high)
+            return_code = settings.OVER_RANGE
+    elif result < low:
+        if direction == ">":
+            log_warning(row, "Under range %s but >; invalid", high)
+            return_code = settings.ERR_INVALID_RANGE_WITH_DIRECTION
+        else:
+            log_info(row, "Under range %s", low)
+            return_code = settings.UNDER_RANGE
+    else:
+        if not direction or (
+            (direction == "<" and low == 0)
+            or (direction == ">" and high == settings.RANGE_CEILING)
+        ):
+            log_info(row, "Within range %s - %s", low, high)
+            return_code = settings.WITHIN_RANGE
+        else:
+            log_warning(
+                row,
+                "Within range %s-%s but direction %s; invalid",
+                low,
+                high,
+                direction,
+            )
+            return_code = settings.ERR_INVALID_RANGE_WITH_DIRECTION
     row["result_category"] = return_code
     return row
 
 
+# All or part of an input file, converted to rows of
+# REQUIRED_NORMALISED_KEYS values. These are either written (without a
+# header) to the file `rows_filename`, or if AGGREGATE_INTERMEDIATE_FILES
+# is set, counted in `counts`, with the `fingerprints` of each row (see
+# `overlap_index`). `first_months` holds the months of the first
+# NAMING_SAMPLE_SIZE rows.
+ConvertedPart = namedtuple(
+    "ConvertedPart", ["rows_filename", "counts", "fingerprints", "first_months"]
+)
+
+# The number of rows used to find the most common month in a file,
+# for naming its intermediate file
+NAMING_SAMPLE_SIZE = 200
+
+
 def make_intermediate_file(
     lab,
     reference_ranges,
@@ -191,20 +227,55 @@ def make_intermediate_file(
     pipeline.
 
     """
-    outfile = tempfile.NamedTemporaryFile(mode="w", delete=False)
+    converted = convert_part(
+        reference_ranges,
+        row_iterator,
+        drop_unwanted_data,
+        normalise_data,
+        filename,
+        convert_to_result=convert_to_result,
+    )
+    converted_filename = merge_converted_parts(lab, filename, [converted])
+    if converted_filename:
+        mark_as_processed(lab, [(filename, converted_filename)])
+    return converted_filename
+
+
+def convert_part(
+    reference_ranges,
+    row_iterator,
+    drop_unwanted_data,
+    normalise_data,
+    source,
+    convert_to_result=None,
+    row_columns=None,
+    source_hash=None,
+):
+    """Normalise every row yielded by `row_iterator` for `source` (an
+    input filename, or a `FilePart` of one, whose file's content hash is
+    `source_hash`), returning a `ConvertedPart`. If `row_columns` is
+    given, each row only has those columns.
+    """
+    if settings.AGGREGATE_INTERMEDIATE_FILES:
+        rows_file = None
+        fingerprints = RowFingerprints()
+    else:
+        rows_file = tempfile.NamedTemporaryFile(mode="w", delete=False)
+        writer = csv.writer(rows_file)
     convert_to_result = convert_to_result or standard_convert_to_result
     if os.path.isfile(reference_ranges):
         ref_ranges = get_ref_ranges(reference_ranges)
     else:
-        ref_ranges = []
+        ref_ranges = {}
 
-    writer = csv.writer(outfile)
-    first_dates = Counter()
+    counts = Counter()
+    first_months = []
     validated = False
-    dates_counter = 0
 
     # Execute a range of operations, per-row
-    for row in row_iterator(filename):
+    for row in cached_rows(row_iterator, source, row_columns, source_hash):
+        if not rows_file:
+            row_source = fingerprints.source(row)
         try:
             drop_unwanted_data(row)
             row = normalise_data(row)
@@ -215,7 +286,6 @@ def make_intermediate_file(
 
         if row:
             if not validated:
-                writer.writerow(settings.REQUIRED_NORMALISED_KEYS)
                 # Check all the required keys have been provided
                 # (in the first row only)
                 provided_keys = set(row.keys())
@@ -225,18 +295,79 @@ def make_intermediate_file(
                     missing_keys
                 )
                 validated = True
-            if dates_counter < 200:
+            if len(first_months) < NAMING_SAMPLE_SIZE:
                 # find most common date in this file, for naming
-                first_dates[row["month"]] += 1
-                dates_counter += 1
+                first_months.append(row["month"])
             # Only output the columns we care about
             subset = [row[k] for k in settings.REQUIRED_NORMALISED_KEYS]
-            writer.writerow(subset)
-    outfile.flush()
+            if rows_file:
+                writer.writerow(subset)
+            else:
+                counts[tuple(subset)] += 1
+                fingerprints.add(row_source, row)
+    log_summary()
+    if rows_file:
+        rows_file.close()
+        return ConvertedPart(rows_file.name, counts, {}, first_months)
+    return ConvertedPart(None, counts, fingerprints.result(), first_months)
+
+
+def merge_converted_parts(lab, filename, parts):
+    """Write the `ConvertedPart`s of an input file, in order, to a single
+    intermediate file, returning its path (see `save_intermediate_file`).
+
+    Counts are written in the binary format of `intermediate_format`;
+    rows (when AGGREGATE_INTERMEDIATE_FILES isn't set) are written as
+    a CSV, so they can be read when debugging.
+
+    """
+    first_months = [month for part in parts for month in part.first_months]
+    first_months = first_months[:NAMING_SAMPLE_SIZE]
+    if settings.AGGREGATE_INTERMEDIATE_FILES:
+        counts = Counter()
+        for part in parts:
+            counts.update(part.counts)
+        fingerprints = merged_fingerprints(part.fingerprints for part in parts)
+        with tempfile.NamedTemporaryFile(suffix=SUFFIX, delete=False) as outfile:
+            write_intermediate_file(outfile, counts_to_dataframe(counts), fingerprints)
+    else:
+        outfile = tempfile.NamedTemporaryFile(mode="w", suffix=".csv", delete=False)
+        writer = csv.writer(outfile)
+        if first_months:
+            writer.writerow(settings.REQUIRED_NORMALISED_KEYS)
+        for part in parts:
+            if part.rows_filename:
+                with open(part.rows_filename, newline="") as f:
+                    shutil.copyfileobj(f, outfile)
+                os.remove(part.rows_filename)
+        outfile.close()
+    return save_intermediate_file(
+        lab, filename, outfile.name, Counter(first_months), bool(first_months)
+    )
+
+
+def _converted_file_exists(basename):
+    return any(
+        os.path.exists(settings.INTERMEDIATE_DIR / "{}{}".format(basename, suffix))
+        for suffix in [".csv", SUFFIX]
+    )
+
+
+def save_intermediate_file(lab, filename, output_filename, first_dates, validated):
+    """Move a newly-written intermediate file to a name in
+    INTERMEDIATE_DIR that reflects the most common month in
+    `first_dates`, and return its path. The caller records that
+    `filename` has been processed (see `mark_as_processed`).
+
+    If no valid rows were written, the input file is deleted instead,
+    and None is returned.
+
+    """
     if not validated:
         log_warning({}, "No valid rows found in {}; deleting".format(filename))
         # Usually because the file is too old
         os.remove(filename)
+        os.remove(output_filename)
     else:
         # Compute an unused filename that reflects its contents to some degree
         try:
@@ -247,20 +378,16 @@ def make_intermediate_file(
         converted_basename = "{}converted_{}_{}".format(
             settings.ENV, lab, most_common_date.replace("/", "_")
         )
+        suffix = os.path.splitext(output_filename)[1]
         dupes = 0
-        if os.path.exists(
-            settings.INTERMEDIATE_DIR / "{}.csv".format(converted_basename)
-        ):
+        if _converted_file_exists(converted_basename):
             dupes += 1
             candidate_basename = "{}_{}".format(converted_basename, dupes)
-            while os.path.exists(
-                settings.INTERMEDIATE_DIR / "{}.csv".format(candidate_basename)
-            ):
+            while _converted_file_exists(candidate_basename):
                 dupes += 1
                 candidate_basename = "{}_{}".format(converted_basename, dupes)
             converted_basename = candidate_basename
-        converted_filename = "{}.csv".format(converted_basename)
+        converted_filename = "{}{}".format(converted_basename, suffix)
         converted_filepath = str(settings.INTERMEDIATE_DIR / converted_filename)
-        os.rename(outfile.name, converted_filepath)
-        mark_as_processed(lab, filename, converted_filepath)
+        os.rename(output_filename, converted_filepath)
         return converted_filepath
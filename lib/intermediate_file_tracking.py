@@ -1,14 +1,64 @@
-from sqlalchemy import Table, Column, String, DateTime, MetaData, Index
-from sqlalchemy import create_engine
+from collections import namedtuple
+from functools import lru_cache
+from multiprocessing.pool import ThreadPool
+from sqlalchemy import Table, Column, String, DateTime, Integer, MetaData, Index
+from sqlalchemy import create_engine, event, inspect
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.sql import and_
 from sqlalchemy.sql import select
 import datetime
+import os
 
+from .input_cache import content_hash
 from .settings import *
 
+# The identity of an input file: its size and modification time (in
+# nanoseconds), which are cheap to check, and the SHA-256 of its
+# contents, which is only recomputed when either of those has changed
+Fingerprint = namedtuple("Fingerprint", ["size", "mtime", "content_hash"])
+
+
+# Seconds to wait for another process to finish writing to the
+# database before giving up
+BUSY_TIMEOUT = 60
+
+# One engine per process, as connections can't be shared with forked
+# processes
+_engines = {}
+
+
+def _configure_connection(dbapi_connection, connection_record):
+    # Readers don't block a writer, or each other, and a write is a
+    # single append to the log
+    dbapi_connection.execute("PRAGMA journal_mode=WAL")
+
 
 def get_engine():
-    return create_engine("sqlite:///{}processed.db".format(ENV))
+    """Return this process's engine for the tracking database, which
+    keeps a pool of connections open
+    """
+    url = "sqlite:///{}processed.db".format(ENV)
+    key = (os.getpid(), url)
+    if key not in _engines:
+        engine = create_engine(
+            url,
+            poolclass=QueuePool,
+            connect_args={"timeout": BUSY_TIMEOUT, "check_same_thread": False},
+        )
+        event.listen(engine, "connect", _configure_connection)
+        _engines[key] = engine
+    return _engines[key]
+
+
+@lru_cache()
+def _processed_table(engine):
+    # Only create (or upgrade) the table once per engine
+    return get_processed_table(engine)
+
+
+def _tracking():
+    engine = get_engine()
+    return engine, _processed_table(engine)
 
 
 def get_processed_table(engine):
@@ -21,62 +71,170 @@ def get_processed_table(engine):
         Column("converted_filename", String),
         Column("converted_at", DateTime),
         Column("merged_at", DateTime),
+        Column("size", Integer),
+        Column("mtime", Integer),
+        Column("content_hash", String),
+        Column("merge_batch", String),
         Index("idx_lab_filename", "lab", "filename", unique=True),
     )
     metadata.create_all(engine)
+    _add_missing_columns(engine, processed)
     return processed
 
 
-def mark_as_processed(lab, filename, converted_filename):
-    engine = get_engine()
-    conn = engine.connect()
-    ins = get_processed_table(engine).insert()
-    conn.execute(
-        ins,
-        lab=lab,
-        filename=filename,
-        converted_filename=converted_filename,
-        converted_at=datetime.datetime.now(),
-    )
+def _add_missing_columns(engine, table):
+    """Add any columns missing from a table created by an earlier
+    version of this module
+    """
+    existing = set(column["name"] for column in inspect(engine).get_columns(table.name))
+    for column in table.columns:
+        if column.name not in existing:
+            engine.execute(
+                "ALTER TABLE {} ADD COLUMN {} {}".format(
+                    table.name, column.name, column.type.compile(engine.dialect)
+                )
+            )
 
 
-def mark_as_merged(lab, converted_filename):
-    engine = get_engine()
-    conn = engine.connect()
-    table = get_processed_table(engine)
-    conn.execute(
-        table.update()
-        .where(
-            and_(table.c.lab == lab, table.c.converted_filename == converted_filename)
+def file_fingerprint(filename, known=None):
+    """Return a `Fingerprint` for a file, reusing the content hash of a
+    `known` fingerprint if the file's size and modification time are
+    unchanged
+    """
+    stat = os.stat(filename)
+    if known and (known.size, known.mtime) == (stat.st_size, stat.st_mtime_ns):
+        return known
+    return Fingerprint(stat.st_size, stat.st_mtime_ns, content_hash(filename))
+
+
+def file_fingerprints(filenames, known):
+    """Return a dict of filename to `Fingerprint`, given a dict of
+    `known` fingerprints (as returned by `get_processed_fingerprints`),
+    hashing any new or changed files in parallel
+    """
+    with ThreadPool() as pool:
+        fingerprints = pool.starmap(
+            file_fingerprint,
+            [(filename, known.get(filename)) for filename in filenames],
         )
-        .values(merged_at=datetime.datetime.now())
-    )
+    return dict(zip(filenames, fingerprints))
 
 
-def get_processed_filenames(lab):
-    engine = get_engine()
-    conn = engine.connect()
-    table = get_processed_table(engine)
-    s = select([table.c.filename]).where(table.c.lab == lab)
-    result = conn.execute(s).fetchall()
-    return [x[0] for x in result]
+def mark_as_processed(lab, entries):
+    """Record that each of `entries`, a list of `(filename,
+    converted_filename)` tuples, has been processed, in a single
+    transaction
+    """
+    now = datetime.datetime.now()
+    rows = [
+        dict(
+            lab=lab,
+            filename=filename,
+            converted_filename=converted_filename,
+            converted_at=now,
+            **file_fingerprint(filename)._asdict()
+        )
+        for filename, converted_filename in entries
+    ]
+    if not rows:
+        return
+    engine, table = _tracking()
+    with engine.begin() as conn:
+        conn.execute(table.insert(), rows)
 
 
-def get_unmerged_filenames(lab):
-    engine = get_engine()
-    conn = engine.connect()
-    table = get_processed_table(engine)
-    s = (
-        select([table.c.filename, table.c.converted_filename])
-        .where(table.c.lab == lab)
-        .where(table.c.merged_at == None)
-    )
-    result = conn.execute(s).fetchall()
-    return [(x[0], x[1]) for x in result]
+def mark_as_duplicate(lab, filename, fingerprint, original_filename):
+    """Record that `filename` has the same contents as the already
+    processed `original_filename`, so needn't be processed itself
+    """
+    engine, table = _tracking()
+    with engine.begin() as conn:
+        original = conn.execute(
+            select([table.c.converted_filename, table.c.merged_at]).where(
+                and_(table.c.lab == lab, table.c.filename == original_filename)
+            )
+        ).fetchone()
+        now = datetime.datetime.now()
+        conn.execute(
+            table.insert(),
+            lab=lab,
+            filename=filename,
+            converted_filename=original[0],
+            converted_at=now,
+            # The original's data will be merged (if it hasn't been already)
+            merged_at=original[1] or now,
+            **fingerprint._asdict()
+        )
+
+
+def update_fingerprints(lab, fingerprints):
+    """Record the `Fingerprint` of each file in a dict of filename to
+    fingerprint, in a single transaction
+    """
+    engine, table = _tracking()
+    with engine.begin() as conn:
+        for filename, fingerprint in fingerprints.items():
+            conn.execute(
+                table.update()
+                .where(and_(table.c.lab == lab, table.c.filename == filename))
+                .values(**fingerprint._asdict())
+            )
+
+
+def start_merge(lab):
+    """Put every unmerged file which isn't already in a merge batch into
+    a new one, and return a dict of each batch of unmerged files
+    (including any left by an interrupted merge) to a sorted list of
+    their converted filenames
+    """
+    engine, table = _tracking()
+    batch = datetime.datetime.now().strftime("%Y%m%d%H%M%S%f")
+    unmerged = and_(table.c.lab == lab, table.c.merged_at == None)
+    with engine.begin() as conn:
+        conn.execute(
+            table.update()
+            .where(and_(unmerged, table.c.merge_batch == None))
+            .values(merge_batch=batch)
+        )
+        result = conn.execute(
+            select([table.c.merge_batch, table.c.converted_filename]).where(unmerged)
+        ).fetchall()
+    batches = {}
+    for merge_batch, converted_filename in result:
+        batches.setdefault(merge_batch, set()).add(converted_filename)
+    return {batch: sorted(filenames) for batch, filenames in batches.items()}
+
+
+def mark_batch_as_merged(lab, batch):
+    """Record that every file in a merge batch has been merged, in a
+    single statement, so that either all of them are or none are
+    """
+    engine, table = _tracking()
+    with engine.begin() as conn:
+        conn.execute(
+            table.update()
+            .where(and_(table.c.lab == lab, table.c.merge_batch == batch))
+            .values(merged_at=datetime.datetime.now())
+        )
+
+
+def get_processed_fingerprints(lab):
+    """Return a dict of every processed filename to its `Fingerprint`,
+    or to None if it was processed before fingerprints were recorded
+    """
+    engine, table = _tracking()
+    s = select(
+        [table.c.filename, table.c.size, table.c.mtime, table.c.content_hash]
+    ).where(table.c.lab == lab)
+    with engine.connect() as conn:
+        result = conn.execute(s).fetchall()
+    return {
+        x[0]: Fingerprint(x[1], x[2], x[3]) if x[3] is not None else None
+        for x in result
+    }
 
 
 def reset_lab(lab):
-    engine = get_engine()
-    conn = engine.connect()
-    table = get_processed_table(engine)
-    conn.execute(table.delete().where(table.c.lab == lab))
+    engine, table = _tracking()
+    with engine.begin() as conn:
+        conn.execute(table.delete().where(table.c.lab == lab))
@@ -0,0 +1,281 @@
+"""The binary format of intermediate files, i.e. counts of
+REQUIRED_NORMALISED_KEYS values, as written for each converted input
+file and for each segment of a lab's combined store.
+
+Each file is a compressed `.npz` holding, for each key:
+
+* `month`: `int16` positions in `month.categories` (the months in
+  the file, as `%Y/%m/01`)
+* `test_code`, `practice_id`: positions in `test_code.categories` and
+  `practice_id.categories`
+* `result_category`: `int8` result categories
+
+and a `count` column, in the smallest integer type that holds it. Rows
+are read straight back into categoricals, without any parsing.
+
+A file may also hold the distinct fingerprints of the test results it
+counts (see `overlap_index`), as `fingerprint` (`uint64`, sorted within
+each month) and `fingerprint.month` (positions in `month.categories`).
+
+The other `.npz` files the pipeline writes (input cache entries, the
+practice table and the final columnar output) are built from the same
+parts: columns dictionary-encoded by a `DictionaryEncoder`, written
+with `write_npz` (or a member at a time, with `write_npy`).
+
+"""
+import os
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+from . import settings
+
+SUFFIX = ".npz"
+
+DICTIONARY_COLUMNS = ["month", "test_code", "practice_id"]
+
+# Missing values have the code -1
+CODE_DTYPES = {"month": np.int16}
+
+
+def lookup_codes(codes, values, missing=-1):
+    """Return the element of `values` for each of `codes` (as made by
+    `pd.factorize`, a categorical, or a `DictionaryEncoder`), or
+    `missing` for the code -1 of a missing value
+    """
+    values = np.asarray(values)
+    # The code -1 indexes an extra last element
+    extended = np.empty(len(values) + 1, dtype=values.dtype)
+    extended[:-1] = values
+    extended[-1] = missing
+    return extended[codes]
+
+
+class DictionaryEncoder:
+    """Dictionary-encodes a column, a chunk at a time if need be, giving
+    each distinct value the next code as it's first seen
+    """
+
+    def __init__(self):
+        self.index = {}
+
+    def encode(self, values):
+        """Return the `int32` codes of `values`, with -1 for missing values
+        """
+        codes, uniques = pd.factorize(values)
+        mapping = np.array(
+            [self.index.setdefault(value, len(self.index)) for value in uniques],
+            dtype=np.int32,
+        )
+        return lookup_codes(codes, mapping)
+
+    def categories(self):
+        """Return the distinct values, in order of their codes, as an
+        array (of fixed-width strings, if they're strings)
+        """
+        categories = pd.Index(list(self.index))
+        if categories.dtype == object:
+            return categories.to_numpy(dtype=str)
+        return categories.to_numpy()
+
+
+def smallest_int(low, high):
+    """Return the smallest signed integer type for values from `low` to
+    `high`
+    """
+    for dtype in [np.int8, np.int16, np.int32]:
+        if np.iinfo(dtype).min <= low and high <= np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+
+def write_npy(zip_file, name, array):
+    """Write an array to an open `ZipFile` as the `.npz` member `name`
+    """
+    with zip_file.open(name + ".npy", "w", force_zip64=True) as member:
+        np.lib.format.write_array(member, np.asanyarray(array), allow_pickle=False)
+
+
+def write_npy_header(member, dtype, length):
+    """Write the header of a one-dimensional array of `length` values,
+    to be followed by its data
+    """
+    np.lib.format.write_array_header_1_0(
+        member,
+        {
+            "descr": np.lib.format.dtype_to_descr(np.dtype(dtype)),
+            "fortran_order": False,
+            "shape": (length,),
+        },
+    )
+
+
+def read_npy_header(f):
+    """Return the shape and dtype of the array in an `.npy` file (or
+    `.npz` member), leaving `f` at the start of its data
+    """
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        shape, _, dtype = np.lib.format.read_array_header_1_0(f)
+    else:
+        shape, _, dtype = np.lib.format.read_array_header_2_0(f)
+    return shape, dtype
+
+
+def write_npz(f, arrays, compress=False):
+    """Write a dict of name to array to `f` (a filename or a binary
+    file), as `numpy.savez` (or `numpy.savez_compressed`) would
+    """
+    compression = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+    with zipfile.ZipFile(f, "w", compression=compression, allowZip64=True) as z:
+        for name, array in arrays.items():
+            write_npy(z, name, array)
+
+
+def write_intermediate_file(f, df, fingerprints=None):
+    """Write a DataFrame of REQUIRED_NORMALISED_KEYS and `count` columns
+    to `f` (a filename or a binary file), with any `fingerprints` (a
+    dict of month to an array of the fingerprints of its results). Rows
+    without a result category (i.e. results which couldn't be
+    categorised) are dropped, as they are when a CSV of them is combined.
+    """
+    df = df[df["result_category"].notna()]
+    arrays = {}
+    for name in DICTIONARY_COLUMNS:
+        encoder = DictionaryEncoder()
+        codes = encoder.encode(df[name])
+        categories = encoder.categories().astype(str)
+        dtype = CODE_DTYPES.get(name, smallest_int(-1, len(categories) - 1))
+        arrays[name] = codes.astype(dtype)
+        arrays["{}.categories".format(name)] = categories
+    arrays["result_category"] = np.asarray(df["result_category"]).astype(np.int8)
+    arrays["count"] = pd.to_numeric(df["count"], downcast="integer").to_numpy()
+    # Sorting the rows makes runs of the same codes, which compress to
+    # a fraction of their size
+    order = np.lexsort(
+        [arrays[name] for name in reversed(settings.REQUIRED_NORMALISED_KEYS)]
+    )
+    for name in settings.REQUIRED_NORMALISED_KEYS + ["count"]:
+        arrays[name] = arrays[name][order]
+    if fingerprints is not None:
+        months = pd.Index(arrays["month.categories"])
+        hashes = [np.array([], dtype=np.uint64)]
+        codes = [np.array([], dtype=CODE_DTYPES["month"])]
+        for month, values in sorted(fingerprints.items()):
+            code = months.get_indexer([month])[0]
+            if code >= 0:
+                hashes.append(np.sort(values).astype(np.uint64))
+                codes.append(np.full(len(values), code, dtype=CODE_DTYPES["month"]))
+        arrays["fingerprint"] = np.concatenate(hashes)
+        arrays["fingerprint.month"] = np.concatenate(codes)
+    write_npz(f, arrays, compress=True)
+
+
+def counts_to_dataframe(counts):
+    """Return a Counter of tuples of REQUIRED_NORMALISED_KEYS values as a
+    DataFrame of those keys and `count`
+    """
+    df = pd.DataFrame(list(counts), columns=settings.REQUIRED_NORMALISED_KEYS)
+    df["count"] = np.fromiter(counts.values(), dtype=np.int64, count=len(counts))
+    return df
+
+
+def _result_categorical(values):
+    # Look up the code for every possible int8 value, rather than
+    # hashing each value
+    dtype = settings.INTERMEDIATE_OUTPUT_DTYPES["result_category"]
+    possible = np.arange(-128, 128)
+    codes = pd.Index(dtype.categories).get_indexer(possible)
+    return pd.Categorical.from_codes(codes[values.astype(np.int64) + 128], dtype=dtype)
+
+
+def read_intermediate_file(filename):
+    """Return the rows of an intermediate file as a DataFrame, with
+    `INTERMEDIATE_OUTPUT_DTYPES` categoricals for `month` and
+    `result_category`, and categoricals of just the values in the file
+    for `test_code` and `practice_id`
+    """
+    columns = {}
+    with np.load(filename) as f:
+        for name in DICTIONARY_COLUMNS:
+            columns[name] = pd.Categorical.from_codes(
+                f[name], f["{}.categories".format(name)].astype(object)
+            )
+        result_categories = f["result_category"]
+        counts = f["count"].astype(np.int64)
+    # Months outside DATE_FLOOR and today become missing, as they do
+    # when read from a CSV
+    columns["month"] = columns["month"].astype(
+        settings.INTERMEDIATE_OUTPUT_DTYPES["month"]
+    )
+    columns["result_category"] = _result_categorical(result_categories)
+    columns["count"] = counts
+    return pd.DataFrame(columns)
+
+
+def read_fingerprints(filename):
+    """Return a dict of month to a sorted array of the fingerprints of
+    the results counted in an intermediate file, which is empty if the
+    file has none (e.g. it's a CSV)
+    """
+    if os.path.splitext(filename)[1] != SUFFIX:
+        return {}
+    with np.load(filename) as f:
+        if "fingerprint" not in f.files:
+            return {}
+        months = f["month.categories"].astype(str)
+        hashes = f["fingerprint"]
+        codes = f["fingerprint.month"]
+    # Fingerprints are written a month at a time
+    present, starts = np.unique(codes, return_index=True)
+    return {
+        months[code]: values
+        for code, values in zip(present, np.split(hashes, starts[1:]))
+    }
+
+
+def intermediate_file_rows(filename):
+    """Return the number of rows in an intermediate file, reading only
+    the header of one of its columns
+    """
+    with zipfile.ZipFile(filename) as zip_file, zip_file.open("count.npy") as f:
+        shape, _ = read_npy_header(f)
+    return shape[0]
+
+
+def empty_intermediate_dataframe():
+    return pd.DataFrame(
+        {
+            "month": pd.Categorical(
+                [], dtype=settings.INTERMEDIATE_OUTPUT_DTYPES["month"]
+            ),
+            "test_code": pd.Categorical([]),
+            "practice_id": pd.Categorical([]),
+            "result_category": pd.Categorical(
+                [], dtype=settings.INTERMEDIATE_OUTPUT_DTYPES["result_category"]
+            ),
+            "count": np.array([], dtype=np.int64),
+        }
+    )
+
+
+def concat_intermediate(frames):
+    """Concatenate DataFrames of intermediate rows, keeping `test_code`
+    and `practice_id` categorical (with the union of their categories)
+    rather than letting `concat` make them object columns
+    """
+    frames = [empty_intermediate_dataframe()] + list(frames)
+    columns = {}
+    for name in ["test_code", "practice_id"]:
+        columns[name] = pd.api.types.union_categoricals(
+            [pd.Categorical(frame[name]) for frame in frames]
+        )
+    df = pd.concat(
+        [frame.drop(columns=list(columns)) for frame in frames],
+        ignore_index=True,
+        sort=False,
+    )
+    for name, values in columns.items():
+        df[name] = values
+    return df[frames[0].columns]
@@ -1,8 +1,17 @@
 """Helper functions to include JSON representation of a row of data in logs
 
+Row-level messages cost nothing beyond a level check when their level
+is disabled. When enabled, only one in every `settings.LOG_SAMPLE_RATE`
+rows is logged for each message below ERROR; the rest are counted, and
+summarised at most every `settings.LOG_SUMMARY_INTERVAL` seconds, and
+whenever `log_summary` is called. File-level messages (logged with an
+empty row, `{}`) are never sampled.
+
 """
+from collections import Counter
 import json
 import logging
+import time
 from . import settings
 
 streamhandler = logging.StreamHandler()
@@ -15,11 +24,45 @@ logging.basicConfig(
 
 logger = logging.getLogger()
 
+LEVELS = {"info": logging.INFO, "warning": logging.WARNING, "error": logging.ERROR}
+
+# How many times each (level, message) has been logged, and how many
+# of those were skipped by sampling since the last summary
+message_counts = Counter()
+skipped_counts = Counter()
+last_summary_at = time.monotonic()
+
 
 def log(row, level, msg, *args):
-    msg = msg + " %s "
-    args = args + (json.dumps(row),)
-    getattr(logger, level)(msg, *args)
+    levelno = LEVELS[level]
+    if not logger.isEnabledFor(levelno):
+        return
+    if row and levelno < logging.ERROR and settings.LOG_SAMPLE_RATE > 1:
+        key = (levelno, msg)
+        message_counts[key] += 1
+        if message_counts[key] % settings.LOG_SAMPLE_RATE != 1:
+            skipped_counts[key] += 1
+            if time.monotonic() - last_summary_at > settings.LOG_SUMMARY_INTERVAL:
+                log_summary()
+            return
+    logger.log(levelno, msg + " %s ", *args, json.dumps(row))
+
+
+def log_summary():
+    """Log how many rows were skipped by sampling for each message, since
+    the last summary
+    """
+    global last_summary_at
+    for (levelno, msg), count in sorted(skipped_counts.items()):
+        logger.log(
+            levelno,
+            "%s more rows not logged (1 in %s logged): %s",
+            count,
+            settings.LOG_SAMPLE_RATE,
+            msg,
+        )
+    skipped_counts.clear()
+    last_summary_at = time.monotonic()
 
 
 def log_warning(row, msg, *args):
@@ -0,0 +1,61 @@
+"""A cache of each lab's processed output (its suppressed counts, with
+practice metadata), in the columnar format of `final_output`, so that
+labs whose inputs haven't changed since they were last processed can
+be written to the final output without being processed again.
+
+"""
+from contextlib import contextmanager
+import json
+import os
+
+from . import settings
+from .file_utils import atomic_write
+from .final_output import FinalColumnsWriter, read_final_columns
+
+
+def output_cache_path(lab):
+    return settings.INTERMEDIATE_DIR / "{}output_{}.npz".format(settings.ENV, lab)
+
+
+def _manifest_path(lab):
+    return settings.INTERMEDIATE_DIR / "{}output_{}.json".format(settings.ENV, lab)
+
+
+def read_cached_output(lab, fingerprint):
+    """Return a lab's cached output as a DataFrame, or None if it wasn't
+    cached with `fingerprint`
+    """
+    try:
+        with open(_manifest_path(lab)) as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    if manifest.get("fingerprint") != fingerprint:
+        return None
+    try:
+        return read_final_columns(output_cache_path(lab))
+    except FileNotFoundError:
+        return None
+
+
+@contextmanager
+def caching_output(lab, fingerprint):
+    """Return a context manager which yields a `FinalColumnsWriter` for a
+    lab's output, computed from inputs with `fingerprint`, which replaces
+    its cached output when the block exits without an exception
+    """
+    # Remove the manifest first, so that if writing the output is
+    # interrupted, it's never read
+    remove_cached_output(lab)
+    with FinalColumnsWriter(output_cache_path(lab)) as writer:
+        yield writer
+    with atomic_write(_manifest_path(lab), "w") as f:
+        json.dump({"fingerprint": fingerprint}, f)
+
+
+def remove_cached_output(lab):
+    for path in [_manifest_path(lab), output_cache_path(lab)]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
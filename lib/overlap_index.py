@@ -0,0 +1,173 @@
+"""Fingerprints of the individual test results in each lab's data, so
+that new data can be checked against the results already appended to
+the lab's combined store.
+
+Each result is fingerprinted as it's converted, before it's counted: a
+64-bit hash of the values of its source row (i.e. of the columns which
+`normalise_data` or `normalise_chunk` read), which identify the result
+far better than the few values it's normalised to, so that different
+files rarely share a fingerprint unless they hold the same results.
+Each intermediate file holds the distinct fingerprints of the results
+it counts, by month, and each segment of a lab's store holds those of
+the files it was appended from (see `intermediate_format`).
+
+A month of new data with more than MAX_OVERLAP of its results already
+in the store has almost certainly been appended before, so the file
+it's in is rejected (see `combine_and_append_csvs`).
+
+Data appended before fingerprints were kept, and files converted
+without AGGREGATE_INTERMEDIATE_FILES set, have no fingerprints, so
+aren't checked.
+
+"""
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from . import settings
+from .combined_store import list_segments, segment_batch
+from .intermediate_format import read_fingerprints
+
+# A file is rejected if more than this fraction of the results in any
+# month of it (and at least MIN_OVERLAPPING of them) are already in
+# the store. Data which really has been appended before overlaps
+# almost entirely, and different data hardly at all.
+MAX_OVERLAP = 0.2
+MIN_OVERLAPPING = 10
+
+# The distinct results in one month of a new file, and how many of
+# them are already in the store
+Overlap = namedtuple("Overlap", ["filename", "month", "results", "overlapping"])
+
+_EMPTY = np.array([], dtype=np.uint64)
+
+
+def fingerprint_sources(sources, months, result_categories):
+    """Return a dict of month to a sorted array of the distinct
+    fingerprints of the results converted from each row of `sources` (a
+    DataFrame of source rows), given the `months` and
+    `result_categories` they were converted to. Results without a
+    category (which are never counted) are ignored.
+    """
+    months = np.asarray(months, dtype=object)
+    counted = pd.notna(np.asarray(result_categories, dtype=object))
+    # Rows and chunks are read with their columns in different orders,
+    # and rows may have values which aren't strings
+    sources = sources[sorted(sources.columns)][counted]
+    sources = sources.fillna("").astype(str)
+    if not len(sources):
+        return {}
+    hashes = pd.util.hash_pandas_object(sources, index=False).to_numpy()
+    months = months[counted].astype(str)
+    return {month: np.unique(hashes[months == month]) for month in np.unique(months)}
+
+
+def merged_fingerprints(fingerprints):
+    """Merge dicts of month to fingerprints, as returned by
+    `fingerprint_sources`
+    """
+    by_month = {}
+    for month_fingerprints in fingerprints:
+        for month, values in month_fingerprints.items():
+            by_month.setdefault(month, []).append(values)
+    return {
+        month: np.unique(np.concatenate(values)) for month, values in by_month.items()
+    }
+
+
+class RowFingerprints:
+    """Fingerprints the source rows (dicts) of results one at a time, by
+    hashing them a chunk of CHUNK_SIZE at a time
+    """
+
+    def __init__(self):
+        self.columns = None
+        self.rows = []
+        self.fingerprints = []
+
+    def source(self, row):
+        """Return the values of a source row, which must be taken before
+        it's normalised (as normalising may change it)
+        """
+        if self.columns is None:
+            self.columns = list(row)
+        return tuple(map(row.get, self.columns))
+
+    def add(self, source, result):
+        """Add the fingerprint of the `source` of a converted `result`
+        """
+        self.rows.append(source + (result["month"], result["result_category"]))
+        if len(self.rows) >= settings.CHUNK_SIZE:
+            self._flush()
+
+    def _flush(self):
+        if self.rows:
+            df = pd.DataFrame(
+                self.rows, columns=self.columns + ["@month", "@result_category"]
+            )
+            self.fingerprints.append(
+                fingerprint_sources(
+                    df[self.columns], df["@month"], df["@result_category"]
+                )
+            )
+            self.rows = []
+
+    def result(self):
+        """Return the fingerprints of every result added, as returned by
+        `fingerprint_sources`
+        """
+        self._flush()
+        return merged_fingerprints(self.fingerprints)
+
+
+def is_rejected(overlap):
+    return (
+        overlap.overlapping >= MIN_OVERLAPPING
+        and overlap.overlapping > MAX_OVERLAP * overlap.results
+    )
+
+
+class OverlapIndex:
+    """The fingerprints of the results appended to a lab's store, read
+    from its segments a month at a time as new files need them.
+    Segments of `pending` batches (which an interrupted run may have
+    partly appended, and which are about to be appended again) are
+    ignored.
+
+    `check` each new file, and `add` the fingerprints of those which
+    are appended, so later files are checked against them too.
+    """
+
+    def __init__(self, lab, pending=()):
+        self.segments = {
+            month: [path for path in paths if segment_batch(path) not in pending]
+            for month, paths in list_segments(lab).items()
+        }
+        self.months = {}
+
+    def _fingerprints(self, month):
+        if month not in self.months:
+            self.months[month] = merged_fingerprints(
+                [{month: _EMPTY}]
+                + [read_fingerprints(path) for path in self.segments.get(month, [])]
+            )[month]
+        return self.months[month]
+
+    def check(self, filename, fingerprints):
+        """Return an `Overlap` for each month of a file's `fingerprints`
+        (as returned by `read_fingerprints`)
+        """
+        return [
+            Overlap(
+                filename,
+                month,
+                len(values),
+                int(np.isin(values, self._fingerprints(month)).sum()),
+            )
+            for month, values in sorted(fingerprints.items())
+        ]
+
+    def add(self, fingerprints):
+        for month, values in fingerprints.items():
+            self.months[month] = np.union1d(self._fingerprints(month), values)
@@ -0,0 +1,131 @@
+"""Fast parsing of the dates, results and ages found in lab data, for
+use by lab configurations.
+
+Each has a scalar form, for `normalise_data`, which is memoised on its
+input string (lab data has few distinct dates or results compared to
+its number of rows); and a vectorised form, for `normalise_chunk`,
+which parses each distinct value in a column once.
+
+"""
+from datetime import datetime
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+# The number of distinct values remembered by each scalar parser
+MEMO_SIZE = 2 ** 16
+
+
+@lru_cache(maxsize=MEMO_SIZE)
+def parse_date(value, formats):
+    """Return a datetime for the first of the `formats` (a tuple of
+    `strptime` formats) that `value` matches, or None
+    """
+    for fmt in formats:
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    return None
+
+
+def format_month(date):
+    """Format a date as the first of its month, i.e. `%Y/%m/01`
+    """
+    return "{}/{:02d}/01".format(date.year, date.month)
+
+
+@lru_cache(maxsize=MEMO_SIZE)
+def parse_result(value):
+    """Split a result into a float and a direction ("<", ">" or None).
+
+    Results like "<5" are just below the number given, and results like
+    ">5" just above. Unparseable results are returned unchanged (so
+    are not floats), though any direction is still returned.
+
+    """
+    direction = None
+    result = value
+    try:
+        if value.startswith("<"):
+            direction = "<"
+            result = float(value[1:]) - 0.0000001
+        elif value.startswith(">"):
+            direction = ">"
+            result = float(value[1:]) + 0.0000001
+        else:
+            result = float(value)
+    except ValueError:
+        pass
+    return result, direction
+
+
+@lru_cache(maxsize=MEMO_SIZE)
+def match_group(regex, value):
+    """Return the first group of a compiled `regex` matched against
+    the start of `value`, or None if it doesn't match
+    """
+    match = regex.match(value)
+    return match.group(1) if match else None
+
+
+def age_at(date, dob):
+    """Return the age in years on `date` of someone born on `dob`
+    """
+    return (date - dob).days / 365
+
+
+def _map_distinct(values, function):
+    """Apply `function` to each distinct value of `values`, returning a
+    list of the results and an array indexing into that list for each
+    value (or -1 for missing values)
+    """
+    codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+    return [function(value) for value in uniques], codes
+
+
+def parse_dates(values, formats):
+    """Vectorised `parse_date`, returning a datetime64 Series (aligned
+    with `values`, if it's a Series) with NaT for unparseable dates
+    """
+    parsed, codes = _map_distinct(values, lambda value: parse_date(value, formats))
+    dates = pd.to_datetime(
+        pd.Series(parsed + [None], dtype=object), errors="coerce"
+    ).to_numpy()
+    return pd.Series(dates[codes], index=getattr(values, "index", None))
+
+
+def format_months(dates):
+    """Vectorised `format_month`, for a datetime64 Series. NaT is
+    formatted as NaN
+    """
+    period = dates.dt.year * 100 + dates.dt.month
+    months = {
+        p: "{}/{:02d}/01".format(int(p) // 100, int(p) % 100)
+        for p in period.dropna().unique()
+    }
+    return period.map(months)
+
+
+def parse_results(values):
+    """Vectorised `parse_result`, returning a float array of results
+    (NaN where unparseable), a boolean array which is True where the
+    result was parsed, and an object array of directions
+    """
+    parsed, codes = _map_distinct(values, parse_result)
+    # The extra trailing values are where `factorize` sends missing
+    # values
+    results = np.array(
+        [r if isinstance(r, float) else np.nan for r, _ in parsed] + [np.nan]
+    )
+    result_parsed = np.array([isinstance(r, float) for r, _ in parsed] + [False])
+    directions = np.array([d for _, d in parsed] + [None], dtype=object)
+    return results[codes], result_parsed[codes], directions[codes]
+
+
+def ages_at(dates, dobs):
+    """Vectorised `age_at`, for datetime64 Series. Missing dates give
+    NaN ages
+    """
+    return (dates - dobs).dt.days / 365
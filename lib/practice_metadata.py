@@ -0,0 +1,162 @@
+"""Practice metadata (CCG membership, list size) to join on to lab data,
+loaded from `practice_codes.csv` (see `get_practices`) once per run,
+and cached in a binary form which is only rebuilt when the CSV changes.
+
+"""
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from . import settings
+from .file_utils import atomic_write, memoise_by_mtime
+from .input_cache import content_hash
+from .intermediate_format import lookup_codes, write_npz
+
+# Bump this to rebuild the cached practice table
+PRACTICE_TABLE_VERSION = 1
+
+# Practice metadata, indexed by month and practice. `months` (as
+# datetimes) and `practice_ids` are sorted indexes; `positions` has a
+# row for each month and a column for each practice, holding the
+# position in `columns` (a DataFrame of every other column of the CSV,
+# with strings as categoricals) of that practice's metadata for that
+# month, or -1 if there isn't any.
+PracticeTable = namedtuple(
+    "PracticeTable", ["months", "practice_ids", "positions", "columns"]
+)
+
+
+def practice_codes_path():
+    return settings.FINAL_DIR / "practice_codes.csv"
+
+
+def _cache_path():
+    return settings.INTERMEDIATE_DIR / "{}practice_codes.npz".format(settings.ENV)
+
+
+def compile_practice_table(df):
+    """Index a DataFrame read from `practice_codes.csv` as a
+    `PracticeTable`. Where there's more than one row for a practice
+    and month, only the first is used.
+    """
+    month_codes, months = pd.factorize(df["month"], sort=True)
+    months = pd.DatetimeIndex(pd.to_datetime(months))
+    practice_codes, practice_ids = pd.factorize(df["practice_id"], sort=True)
+    positions = np.full((len(months), len(practice_ids)), -1, dtype=np.int32)
+    # Assign in reverse, so the first row for each key wins
+    rows = np.arange(len(df), dtype=np.int32)
+    positions[month_codes[::-1], practice_codes[::-1]] = rows[::-1]
+    duplicates = len(df) - (positions >= 0).sum()
+    if duplicates:
+        print(
+            "Ignoring {} repeated practices and months in {}".format(
+                duplicates, practice_codes_path()
+            )
+        )
+    columns = df.drop(columns=["month", "practice_id"]).reset_index(drop=True)
+    for name in columns.columns:
+        if columns[name].dtype == object:
+            columns[name] = columns[name].astype("category")
+    return PracticeTable(months, pd.Index(practice_ids), positions, columns)
+
+
+def _save_practice_table(table, fingerprint):
+    arrays = {
+        "fingerprint": np.array(fingerprint),
+        "months": table.months.to_numpy(),
+        "practice_ids": table.practice_ids.to_numpy(dtype=str),
+        "positions": table.positions,
+        "names": np.array(table.columns.columns, dtype=str),
+    }
+    for i, name in enumerate(table.columns.columns):
+        column = table.columns[name]
+        if column.dtype.name == "category":
+            arrays["codes_{}".format(i)] = column.cat.codes.to_numpy()
+            arrays["categories_{}".format(i)] = column.cat.categories.to_numpy(
+                dtype=str
+            )
+        else:
+            arrays["values_{}".format(i)] = column.to_numpy()
+    with atomic_write(_cache_path()) as f:
+        write_npz(f, arrays)
+
+
+def _load_cached_practice_table(fingerprint):
+    try:
+        with np.load(_cache_path()) as cached:
+            if str(cached["fingerprint"]) != fingerprint:
+                return None
+            columns = {}
+            for i, name in enumerate(cached["names"]):
+                if "codes_{}".format(i) in cached.files:
+                    columns[name] = pd.Categorical.from_codes(
+                        cached["codes_{}".format(i)],
+                        cached["categories_{}".format(i)].astype(object),
+                    )
+                else:
+                    columns[name] = cached["values_{}".format(i)]
+            return PracticeTable(
+                pd.DatetimeIndex(cached["months"]),
+                pd.Index(cached["practice_ids"].astype(object)),
+                cached["positions"],
+                pd.DataFrame(columns, columns=list(cached["names"])),
+            )
+    except FileNotFoundError:
+        return None
+
+
+def get_practice_table():
+    """Return a `PracticeTable` for `practice_codes.csv`
+    """
+    return _get_practice_table(practice_codes_path())
+
+
+@memoise_by_mtime(maxsize=1)
+def _get_practice_table(filename):
+    fingerprint = "{}:{}".format(PRACTICE_TABLE_VERSION, content_hash(filename))
+    table = _load_cached_practice_table(fingerprint)
+    if table is None:
+        table = compile_practice_table(pd.read_csv(filename, na_filter=False))
+        _save_practice_table(table, fingerprint)
+    return table
+
+
+def _lookup(index, values):
+    """Return the position in `index` of each of `values`, or -1,
+    looking up each distinct value only once
+    """
+    codes, uniques = pd.factorize(values)
+    return lookup_codes(codes, index.get_indexer(uniques))
+
+
+def join_practices(table, df):
+    """Join the metadata in a `PracticeTable` on to rows with `month`
+    and `practice_id` columns, dropping rows without any, and converting
+    months to datetimes. Returns the joined rows, and a Series of the
+    number of rows dropped for each practice.
+    """
+    codes, uniques = pd.factorize(df["month"])
+    month_datetimes = pd.to_datetime(pd.Series(uniques, dtype=object))
+    month_indexes = lookup_codes(codes, table.months.get_indexer(month_datetimes))
+    practice_indexes = _lookup(table.practice_ids, df["practice_id"])
+    found = (month_indexes >= 0) & (practice_indexes >= 0)
+    positions = np.full(len(df), -1, dtype=np.int64)
+    positions[found] = table.positions[month_indexes[found], practice_indexes[found]]
+    keep = positions >= 0
+    # As with an inner `merge`, rows for the same practice and month are
+    # kept together, in the order each practice and month first appears
+    kept = np.flatnonzero(keep)
+    _, first, groups = np.unique(
+        positions[kept], return_index=True, return_inverse=True
+    )
+    kept = kept[np.argsort(first[groups], kind="stable")]
+    joined = df.iloc[kept].reset_index(drop=True)
+    joined["month"] = lookup_codes(
+        codes[kept], month_datetimes.to_numpy(), np.datetime64("NaT")
+    )
+    metadata = table.columns.iloc[positions[kept]].reset_index(drop=True)
+    for name in metadata.columns:
+        joined[name] = metadata[name]
+    dropped = df.loc[~keep, "practice_id"].astype(str).value_counts()
+    return joined, dropped
@@ -0,0 +1,179 @@
+"""Vectorised equivalent of `standard_convert_to_result`, for
+classifying whole columns of results at once
+
+"""
+from collections import namedtuple
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+from . import settings
+from .intermediate_file_processing import get_ref_ranges
+from .intermediate_format import lookup_codes
+
+SEXES = ["M", "F"]
+
+# Reference ranges for every test, flattened into arrays indexed by
+# entry. Each entry starts at an integer age within a block of `span`
+# keys reserved for its test; `keys` is sorted, so the entry for a
+# (test, age) pair can be found with `searchsorted`. `covered` is
+# False for ages no reference range applies to; `low`, `high` and
+# `valid` have one column per sex in `SEXES`.
+RefRangeTable = namedtuple(
+    "RefRangeTable",
+    ["test_ids", "floor_age", "span", "keys", "covered", "low", "high", "valid"],
+)
+
+
+def compile_ref_range_table(ranges):
+    """Flatten a dict of test code to `AgeBands` (as returned by
+    `get_ref_ranges`) into a `RefRangeTable`
+    """
+    boundaries = [age for bands in ranges.values() for age in bands.boundaries]
+    # Every age below the lowest boundary is clipped to `floor_age`,
+    # and every age above the highest to `floor_age + span - 1`
+    floor_age = min(boundaries, default=0) - 1
+    span = max(boundaries, default=0) - floor_age + 2
+    test_ids = {}
+    keys, covered, low, high, valid = [], [], [], [], []
+    for test_id, test in enumerate(sorted(ranges)):
+        bands = ranges[test]
+        test_ids[test] = test_id
+        starts = [floor_age] + bands.boundaries
+        segments = [None] + bands.segments + [None]
+        for start, segment in zip(starts, segments):
+            bounds = [(segment or {}).get(sex) for sex in SEXES]
+            keys.append(test_id * span + start - floor_age)
+            covered.append(segment is not None)
+            low.append([b[0] if b else np.nan for b in bounds])
+            high.append([b[1] if b else np.nan for b in bounds])
+            valid.append([b is not None for b in bounds])
+    return RefRangeTable(
+        test_ids=test_ids,
+        floor_age=floor_age,
+        span=span,
+        keys=np.array(keys, dtype=np.int64),
+        covered=np.array(covered, dtype=bool),
+        low=np.array(low, dtype=float).reshape(-1, len(SEXES)),
+        high=np.array(high, dtype=float).reshape(-1, len(SEXES)),
+        valid=np.array(valid, dtype=bool).reshape(-1, len(SEXES)),
+    )
+
+
+@lru_cache(maxsize=None)
+def get_ref_range_table(path):
+    """Load a CSV of reference ranges into a `RefRangeTable`
+    """
+    return compile_ref_range_table(get_ref_ranges(path))
+
+
+def classify_results(table, test_codes, results, directions, ages, sexes, parsed=None):
+    """Return an int8 array of result categories for columns of rows,
+    exactly as `standard_convert_to_result` would set them for each
+    row.
+
+    `results` must be floats. Rows with unparseable results are marked
+    as such in the boolean `parsed` array, which defaults to every
+    non-NaN result; pass it explicitly if a result may have been
+    parsed from a string like "nan". Any direction other than "<" or
+    ">" is treated as no direction.
+
+    """
+    test_codes = np.asarray(test_codes, dtype=object)
+    results = np.asarray(results, dtype=float)
+    directions = np.asarray(directions, dtype=object)
+    ages = np.asarray(ages, dtype=float)
+    sexes = np.asarray(sexes, dtype=object)
+    if parsed is None:
+        parsed = ~np.isnan(results)
+    else:
+        parsed = np.asarray(parsed, dtype=bool)
+    if not len(table.keys):
+        return np.full(len(test_codes), settings.ERR_NO_REF_RANGE, dtype=np.int8)
+
+    # Look up each distinct test code once
+    codes, uniques = pd.factorize(test_codes)
+    test_ids = lookup_codes(
+        codes,
+        np.array([table.test_ids.get(code, -1) for code in uniques], dtype=np.int64),
+    )
+    known = test_ids >= 0
+
+    # Reference range boundaries are whole years, so the age band for
+    # a row depends only on the floor of its age; NaN ages are outside
+    # every band
+    age_keys = np.clip(
+        np.floor(ages), table.floor_age, table.floor_age + table.span - 1
+    )
+    age_keys = np.where(np.isnan(age_keys), table.floor_age, age_keys)
+    keys = np.where(known, test_ids, 0) * table.span + (
+        age_keys.astype(np.int64) - table.floor_age
+    )
+    entries = np.searchsorted(table.keys, keys, side="right") - 1
+
+    is_male = sexes == "M"
+    is_female = sexes == "F"
+    sex_col = np.where(is_female, SEXES.index("F"), SEXES.index("M"))
+    low = table.low[entries, sex_col]
+    high = table.high[entries, sex_col]
+    less_than = directions == "<"
+    greater_than = directions == ">"
+    with np.errstate(invalid="ignore"):
+        over = results > high
+        under = results < low
+    within_ok = (
+        ~(less_than | greater_than)
+        | (less_than & (low == 0))
+        | (greater_than & (high == settings.RANGE_CEILING))
+    )
+    return np.select(
+        [
+            ~known,
+            ~parsed,
+            ~table.covered[entries],
+            ~(is_male | is_female),
+            ~table.valid[entries, sex_col],
+            over & less_than,
+            over,
+            under & greater_than,
+            under,
+            within_ok,
+        ],
+        [
+            settings.ERR_NO_REF_RANGE,
+            settings.ERR_UNPARSEABLE_RESULT,
+            settings.ERR_DISCARDED_AGE,
+            settings.ERR_INVALID_SEX,
+            settings.ERR_INVALID_REF_RANGE,
+            settings.ERR_INVALID_RANGE_WITH_DIRECTION,
+            settings.OVER_RANGE,
+            settings.ERR_INVALID_RANGE_WITH_DIRECTION,
+            settings.UNDER_RANGE,
+            settings.WITHIN_RANGE,
+        ],
+        default=settings.ERR_INVALID_RANGE_WITH_DIRECTION,
+    ).astype(np.int8)
+
+
+def standard_convert_chunk_to_result(df, table):
+    """Given a DataFrame of normalised rows and a `RefRangeTable`, set a
+    `result_category` column, and return the DataFrame.
+
+    The DataFrame must have the columns [test_code, test_result,
+    direction, age, sex], where `test_result` is a float. It may
+    additionally provide a boolean `result_parsed` column (see
+    `classify_results`).
+
+    """
+    df = df.copy()
+    df["result_category"] = classify_results(
+        table,
+        df["test_code"],
+        df["test_result"],
+        df["direction"],
+        df["age"],
+        df["sex"],
+        parsed=df["result_parsed"] if "result_parsed" in df.columns else None,
+    )
+    return df
@@ -10,6 +10,11 @@ from pandas.api.types import CategoricalDtype
 
 LOG_LEVEL = logging.getLevelName(os.environ.get("OPATH_LOG_LEVEL", "WARNING"))
 
+# Only log one in every this many rows for each row-level log message,
+# summarising the rest at most every LOG_SUMMARY_INTERVAL seconds
+LOG_SAMPLE_RATE = int(os.environ.get("OPATH_LOG_SAMPLE_RATE", 1))
+LOG_SUMMARY_INTERVAL = float(os.environ.get("OPATH_LOG_SUMMARY_INTERVAL", 60))
+
 
 # In the spreadsheet that Helen currently manually maintains, indicate
 # which columns provide old-test-code-to-new mappings for each lab.
@@ -62,11 +67,42 @@ DATE_FLOOR = (datetime.date.today() - relativedelta(years=5)).strftime("%Y/%m/01
 # The keys that every anonymiser_config must export
 REQUIRED_NORMALISED_KEYS = ["month", "test_code", "practice_id", "result_category"]
 
+# Write intermediate files as a count of the rows for each distinct
+# combination of REQUIRED_NORMALISED_KEYS, rather than one row per test
+# result. Files without a `count` column are counted a row at a time
+AGGREGATE_INTERMEDIATE_FILES = (
+    os.environ.get("OPATH_AGGREGATE_INTERMEDIATE_FILES", "1") == "1"
+)
+
+# If set, process each lab's combined data a batch of months at a time,
+# in batches estimated to need no more than this many bytes of memory,
+# rather than all at once
+MAX_MEMORY = int(os.environ.get("OPATH_MAX_MEMORY", 0))
+
+# The number of rows in each DataFrame yielded by a lab's
+# `chunk_iterator`, for labs that support columnar processing
+CHUNK_SIZE = 100000
+
+# Plain CSV input files are split into parts of roughly this many
+# bytes, to be converted in parallel, for labs that define `split_file`
+SPLIT_FILE_SIZE = 256 * 1024 * 1024
+
 # Working directory for intermediate (i.e. month-by-month) files. Once
 # these have been combined successfully, files here are removed,
 # except the master all-tests file
 INTERMEDIATE_DIR = Path.cwd() / "intermediate_data"
 
+# Rows parsed from input files are cached here, keyed by the contents
+# of each file, so they needn't be parsed again when reprocessed. The
+# least recently used are removed when the cache grows larger than
+# INPUT_CACHE_SIZE bytes; set it to 0 to disable the cache. Like
+# INTERMEDIATE_DIR, it holds patient-level data, so must never leave
+# the secure environment
+INPUT_CACHE_DIR = Path(
+    os.environ.get("OPATH_INPUT_CACHE_DIR", Path.cwd() / "input_cache")
+)
+INPUT_CACHE_SIZE = int(os.environ.get("OPATH_INPUT_CACHE_SIZE", 10 * 1024 ** 3))
+
 # Directory for data that can be copied out of the secure environment
 FINAL_DIR = Path.cwd() / "final_data"
 
@@ -108,6 +144,7 @@ INTERMEDIATE_OUTPUT_DTYPES = {
     "test_code": str,
     "practice_id": str,
     "result_category": _result_dtype(),
+    "count": int,
 }
 
 
@@ -4,178 +4,302 @@ should happen the whole dataset, like normalising test names and
 suppressing low numbers
 
 """
-import glob
+import hashlib
 import io
+import json
 import os
+import shutil
+import numpy as np
 import pandas as pd
 import requests
 from pandas.api.types import CategoricalDtype
 
 
-from .intermediate_file_tracking import get_unmerged_filenames, mark_as_merged
+from .aggregation import sum_counts
+from .bulk_loading import iter_intermediate_files
+from .combined_store import (
+    append_segments,
+    legacy_combined_path,
+    list_counts_segments,
+    list_segments,
+    migrate_combined_csv,
+    read_counts,
+    read_counts_manifest,
+    read_segments,
+    replace_counts,
+    segment_rows,
+    store_path,
+)
+from .file_utils import memoise_by_mtime
+from .input_cache import content_hash
+from .intermediate_format import (
+    SUFFIX,
+    concat_intermediate,
+    lookup_codes,
+    read_fingerprints,
+)
+from .intermediate_file_tracking import mark_batch_as_merged, start_merge
+from .logger import log_error, log_info, log_warning
+from .output_cache import caching_output, read_cached_output
+from .overlap_index import OverlapIndex, is_rejected, merged_fingerprints
+from .practice_metadata import get_practice_table, join_practices, practice_codes_path
 from . import settings
 
+# Bump this when the way counts are computed from combined data
+# changes, to recount every month
+COUNTS_VERSION = 1
 
-def combine_csvs_to_dataframe(csv_filenames, dtypes):
-    """Combine CSVs (which must include columns defined in `dtypes`)
+# Bump this when the way a lab's output is computed from its counts
+# changes, to process every lab again
+OUTPUT_VERSION = 2
 
+# Each lab's output rows are sorted by these, so that the output is the
+# same however its months were batched (see `_month_batches`)
+OUTPUT_ORDER = ["month", "test_code", "practice_id", "result_category"]
+
+# Roughly how much memory each row of a lab's combined data or counts
+# needs while it's counted, suppressed and joined to practice metadata,
+# used to size batches of months to fit in MAX_MEMORY (see
+# `benchmarks/max_memory.py`)
+BYTES_PER_ROW = 200
+
+
+def _fill_counts(df):
+    """Intermediate files which weren't aggregated when they were written
+    have no `count` column, as each row is a single test result
     """
-    unmerged = pd.read_csv(
-        # Reading an empty CSV in this way allows us to define column
-        # types for an empty dataframe, which we can use for `concat`
-        # operations
-        io.StringIO(""),
-        names=dtypes.keys(),
-        dtype=dtypes,
-    )
-    for filename in csv_filenames:
-        unmerged = pd.concat(
-            [
-                unmerged,
-                pd.read_csv(
-                    settings.INTERMEDIATE_DIR / filename, na_filter=False, dtype=dtypes
-                ),
-            ],
-            sort=False,
+    if "count" in df.columns:
+        df["count"] = df["count"].fillna(1).astype(int)
+    else:
+        df["count"] = 1
+    return df
+
+
+def _aggregate_counts(df):
+    """Sum the counts for each distinct combination of
+    REQUIRED_NORMALISED_KEYS
+    """
+    return sum_counts(df, settings.REQUIRED_NORMALISED_KEYS)
+
+
+def rejected_path(lab):
+    """The directory to which a lab's intermediate files are moved if
+    they're rejected for overlapping data already appended
+    """
+    return settings.INTERMEDIATE_DIR / "{}rejected_{}".format(settings.ENV, lab)
+
+
+def _report_overlaps(overlaps):
+    """Warn about each month of a new file with results already appended
+    to a lab's store, and return whether the file should be rejected
+    (see `overlap_index`)
+    """
+    rejected = False
+    for overlap in overlaps:
+        if not overlap.overlapping:
+            continue
+        if is_rejected(overlap):
+            report = log_error
+            rejected = True
+        else:
+            report = log_warning
+        report(
+            {},
+            "%s of %s results in %s of %s (%.1f%%) have already been appended",
+            overlap.overlapping,
+            overlap.results,
+            overlap.month,
+            overlap.filename,
+            100 * overlap.overlapping / overlap.results,
         )
-    return unmerged
+    return rejected
 
 
 def combine_and_append_csvs(lab):
     """For a given lab, combine any unmerged monthly files and append them
-    to an an existing `combined` file.  Also sanity checks data to
-    provide some assurance data hasn't been appended twice.
+    to the lab's combined store (see `combined_store`), first moving
+    any existing `combined` CSV into the store.  Also checks the files
+    against the results already appended (see `overlap_index`), rejecting
+    any with too many of them, which are moved to `rejected_path(lab)`.
 
+    Returns a list of the rejected files.
+
+    """
+    if migrate_combined_csv(lab):
+        print("Moved {} into {}".format(legacy_combined_path(lab), store_path(lab)))
+
+    rejected = []
+    batches = start_merge(lab)
+    remove_orphaned_files(lab, batches)
+    if not batches:
+        return rejected
+    # Test we're not re-appending data to the store. In theory this
+    # shouldn't happen as we track imported filenames, but
+    # belt-and-braces: each file's results are checked against the
+    # fingerprints of every result appended before, and of the files
+    # before it
+    index = OverlapIndex(lab, pending=batches)
+    for batch, filenames in sorted(batches.items()):
+        frames = []
+        fingerprints = []
+        batch_rejected = []
+        paths = [settings.INTERMEDIATE_DIR / filename for filename in filenames]
+        for path, df in iter_intermediate_files(
+            paths, settings.INTERMEDIATE_OUTPUT_DTYPES
+        ):
+            file_fingerprints = read_fingerprints(path)
+            if not file_fingerprints:
+                log_info({}, "%s has no fingerprints, so isn't checked", path.name)
+            if _report_overlaps(index.check(path.name, file_fingerprints)):
+                batch_rejected.append(path)
+                continue
+            index.add(file_fingerprints)
+            fingerprints.append(file_fingerprints)
+            frames.append(_aggregate_counts(_fill_counts(df)))
+        if frames:
+            append_segments(
+                lab,
+                _aggregate_counts(concat_intermediate(frames)),
+                batch,
+                merged_fingerprints(fingerprints),
+            )
+        for path in batch_rejected:
+            os.makedirs(rejected_path(lab), exist_ok=True)
+            shutil.copyfile(path, rejected_path(lab) / path.name)
+            rejected.append(str(rejected_path(lab) / path.name))
+        # If we're interrupted before the batch is recorded as merged,
+        # it's appended again next time, replacing the same segments;
+        # if after, its files are removed by `remove_orphaned_files`
+        mark_batch_as_merged(lab, batch)
+        for path in paths:
+            os.remove(path)
+    return rejected
+
+
+def remove_orphaned_files(lab, batches):
+    """Remove any of a lab's intermediate files which aren't in one of
+    its unmerged `batches` (as returned by `start_merge`): those of a
+    batch which was recorded as merged just before an interruption, and
+    those converted just before one, which were never recorded (so
+    their input files are processed again)
     """
-    all_results_path = "{}combined_{}.csv".format(settings.ENV, lab)
+    unmerged = {
+        os.path.basename(filename)
+        for filenames in batches.values()
+        for filename in filenames
+    }
+    for suffix in [".csv", SUFFIX]:
+        pattern = "{}converted_{}_*{}".format(settings.ENV, lab, suffix)
+        for path in settings.INTERMEDIATE_DIR.glob(pattern):
+            if path.name not in unmerged:
+                log_warning({}, "Removing orphaned intermediate file %s", path.name)
+                os.remove(path)
+
+
+def _processed_months():
+    """Every month from DATE_FLOOR onwards
+    """
+    return set(settings.INTERMEDIATE_OUTPUT_DTYPES["month"].categories)
 
-    # First, build a single dataframe of all the constituent monthly
-    # CSVs that have not previously been processed
-    unmerged_filenames = [x[1] for x in get_unmerged_filenames(lab)]
-    unmerged = combine_csvs_to_dataframe(
-        unmerged_filenames, settings.INTERMEDIATE_OUTPUT_DTYPES
-    )
 
-    # Now open the existing "combined" file (if it exists), and append
-    # our new rows to that
-    try:
-        existing = pd.read_csv(
-            settings.INTERMEDIATE_DIR / all_results_path,
-            dtype=settings.INTERMEDIATE_OUTPUT_DTYPES,
-            na_filter=False,
-        )
-        # Remove any stray dates earlier than DATE_FLOOR
-        existing = existing[existing["month"] != settings.DATE_FLOOR]
-        # Test we're not re-appending rows to the same file. In theory
-        # this shouldn't happen as we track imported filenames, but
-        # belt-and-braces: has the number of tests in the
-        # previously-most-recent month stayed within 20% of previous
-        # value?
-        nan_months = existing[pd.isnull(existing["month"])]
-        assert (
-            len(nan_months) == 0
-        ), f"There are `nan` values for month in {all_results_path}: {nan_months.head()}"
-        month_vals = sorted(existing["month"].unique())
-        final_month = month_vals[-1]
-        final_count = existing[existing["month"] == final_month].count().iloc[0]
-        if unmerged_filenames:
-            merged = pd.concat([existing, unmerged], sort=False)
-        else:
-            merged = existing
-        new_final_count = merged[merged["month"] == final_month].count().iloc[0]
-        assert (new_final_count - final_count) < 0.2 * final_count, (
-            "Number of tests in month {} increased by more than 20% in {}".format(
-                final_month, all_results_path
-            )
-            # Why 20%? Normally data is provided as one file per
-            # month, but at some month boundaries (e.g. Dec/Jan) it's
-            # not unusual to have a load of tests ordered in one month
-            # and reported on in the next
-        )
-    except FileNotFoundError:
-        # The first time we've made a merged file
-        merged = unmerged
-    if unmerged_filenames:
-        # Don't bother rewriting the CSV if it hasn't changed
-        merged.to_csv(settings.INTERMEDIATE_DIR / all_results_path, index=False)
-    # Clean up unmerged files
-    for filename in unmerged_filenames:
-        mark_as_merged(lab, filename)
-        os.remove(settings.INTERMEDIATE_DIR / filename)
+def _categorise_codes(df):
     # These columns can't be `categorical` up-front as we don't know
     # what practice ids or test codes are going to be present until
-    # all the intermediate files have been combined
-    merged["practice_id"] = merged["practice_id"].astype(
-        CategoricalDtype(ordered=False)
-    )
-    merged["test_code"] = merged["test_code"].astype(CategoricalDtype(ordered=False))
-    return merged
+    # all the segments have been read
+    df["practice_id"] = df["practice_id"].astype(CategoricalDtype(ordered=False))
+    df["test_code"] = df["test_code"].astype(CategoricalDtype(ordered=False))
+    return df
+
+
+def read_combined(lab, months=None):
+    """Return a lab's combined data for every month from DATE_FLOOR
+    onwards (or only for `months`), reading only those months' segments
+    from its store
+    """
+    if months is None:
+        months = _processed_months()
+    return _categorise_codes(read_segments(lab, months))
+
 
+def get_test_code_map(lab):
+    """Return a dict of each test code in a lab's data that should be
+    kept, to the normalised `datalab_testcode` it should become, or
+    None if the lab's test codes aren't normalised.
 
-def _get_test_codes(lab):
-    """Make a CSV of all the normalised test codes and lab test codes that
-    have been marked in the Google Sheet for export.
+    The dict is compiled from all the normalised test codes and lab
+    test codes that have been marked in the Google Sheet for export,
+    and is only compiled again when `test_codes.csv` changes.
 
     """
-    if settings.TEST_CODE_MAPPINGS[lab]:
-        columns = settings.TEST_CODE_MAPPINGS[lab] + ["datalab_testcode"]
-        df = pd.read_csv(
-            settings.FINAL_DIR / "test_codes.csv",
-            na_filter=False,
-            usecols=columns + ["show_in_app?", "testname"],
+    if not settings.TEST_CODE_MAPPINGS[lab]:
+        return None
+    return _compile_test_code_map(
+        settings.FINAL_DIR / "test_codes.csv", tuple(settings.TEST_CODE_MAPPINGS[lab])
+    )
+
+
+@memoise_by_mtime(maxsize=None)
+def _compile_test_code_map(filename, alias_columns):
+    columns = list(alias_columns) + ["datalab_testcode"]
+    df = pd.read_csv(
+        filename, na_filter=False, usecols=columns + ["show_in_app?", "testname"]
+    )
+    df = df[df["show_in_app?"] == True]
+
+    dupe_codes = df.datalab_testcode[df.datalab_testcode.duplicated()]
+    dupe_names = df.testname[df.testname.duplicated()]
+    if not dupe_codes.empty or not dupe_names.empty:
+        raise ValueError(
+            f"Non-unique test codes or names\n"
+            f" codes: {', '.join(dupe_codes)}\n"
+            f" names: {', '.join(dupe_names)}"
         )
-        df = df[df["show_in_app?"] == True]
-
-        # Drop any mappings that are actually the same as the datalab one
-        for colname in settings.TEST_CODE_MAPPINGS[lab]:
-            df.loc[df[colname] == df["datalab_testcode"], colname] = "_DONTJOIN_"
-
-        dupe_codes = df.datalab_testcode[df.datalab_testcode.duplicated()]
-        dupe_names = df.testname[df.testname.duplicated()]
-        if not dupe_codes.empty or not dupe_names.empty:
-            raise ValueError(
-                f"Non-unique test codes or names\n"
-                f" codes: {', '.join(dupe_codes)}\n"
-                f" names: {', '.join(dupe_names)}"
-            )
-        return df[columns]
-    else:
-        return []
+
+    # Each extra column is a possible alias for `datalab_testcode`, as
+    # is `datalab_testcode` itself
+    test_code_map = {}
+    conflicts = []
+    for colname in columns:
+        for alias, test_code in zip(df[colname], df["datalab_testcode"]):
+            # Blank cells aren't aliases
+            if not alias:
+                continue
+            if test_code_map.setdefault(alias, test_code) != test_code:
+                conflicts.append(
+                    f"{alias} ({test_code_map[alias]}, {test_code} in {colname})"
+                )
+    if conflicts:
+        raise ValueError(
+            f"Test codes with more than one normalised code\n"
+            f" codes: {', '.join(conflicts)}"
+        )
+    return test_code_map
 
 
 def _normalise_test_codes(lab, df):
-    """Convert local test codes into a normalised version.
+    """Convert local test codes into a normalised version, dropping any
+    which aren't mapped.
 
     """
-    orig_cols = df.columns
-    # test_code_mapping contains columns referenced in CODE_MAPPINGS
-    # such that `datalab_testcode` is the canonical code, and each
-    # extra column is a possible alias. These aliases are imputed by
-    # hand and recorded in a Google Sheet; @helenCEBM is in the
-    # process of documenting this.
-
-    test_code_mapping = _get_test_codes(lab)
-    if len(test_code_mapping):
-        output = pd.DataFrame(columns=orig_cols)
-        # For each test code identified for the lab in our
-        # manually-curated mapping spreadsheet, rename any codes to our
-        # normalised `datalab_testcode`. In addition, be sure also to
-        # match on any codes in the lab data which are exactly the same as
-        # the `datalab_testcode`.
-        for colname in settings.TEST_CODE_MAPPINGS[lab] + ["datalab_testcode"]:
-            result = df.merge(
-                test_code_mapping, how="inner", left_on="test_code", right_on=colname
-            )
-            result = result.rename(
-                columns={
-                    "test_code": "source_test_code",
-                    "datalab_testcode": "test_code",
-                }
-            )
-            output = output.append(result[orig_cols])
-        return output
-    else:
+    # The mapping contains columns referenced in CODE_MAPPINGS such
+    # that `datalab_testcode` is the canonical code, and each extra
+    # column is a possible alias. These aliases are imputed by hand
+    # and recorded in a Google Sheet; @helenCEBM is in the process of
+    # documenting this.
+    test_code_map = get_test_code_map(lab)
+    if test_code_map is None:
         return df
+    # Rather than joining against the mapping, map each distinct test
+    # code to the index of its normalised code (or -1), and then use
+    # that to recode every row at once
+    test_codes = df["test_code"].astype(CategoricalDtype(ordered=False))
+    normalised_codes = pd.Index(sorted(set(test_code_map.values())))
+    lookup = normalised_codes.get_indexer(test_codes.cat.categories.map(test_code_map))
+    codes = lookup_codes(test_codes.cat.codes.to_numpy(), lookup)
+    keep = codes != -1
+    return df[keep].assign(
+        test_code=pd.Categorical.from_codes(codes[keep], normalised_codes)
+    )
 
 
 def estimate_errors(df):
@@ -188,11 +312,15 @@ def estimate_errors(df):
     return df
 
 
-def trim_trailing_months(df):
+def trim_trailing_months(df, monthly_counts=None):
     """There is often a lead-in to the available data. Filter out months
-    which have less than 5% the max monthly test count
+    which have less than 5% the max monthly test count (of the total
+    count for each month in `monthly_counts`, if `df` doesn't have every
+    month)
     """
-    t2 = df.groupby(["month"])["count"].sum().reset_index().sort_values(by="count")
+    if monthly_counts is None:
+        monthly_counts = df.groupby(["month"])["count"].sum()
+    t2 = monthly_counts.reset_index().sort_values(by="count")
     t2 = t2.loc[(t2[("count")] > t2[("count")].max() * 0.05)]
     return df.merge(t2["month"].reset_index(drop=True), on="month", how="inner")
 
@@ -219,33 +347,30 @@ def get_practices():
     df.to_csv(target_path, index=False)
 
 
-def add_practice_metadata(df):
+def add_practice_metadata(df, lab=None):
     """Joins the data on current practice codes. This has the effect of
     both providing metadata (CCG membership, list size), *and*
     removing odd or otherwise unmappable practices from the data.
 
     """
-    practices = pd.read_csv(settings.FINAL_DIR / "practice_codes.csv", na_filter=False)
-    practices["month"] = pd.to_datetime(practices["month"])
-    df["month"] = pd.to_datetime(df["month"])
-    return df.merge(
-        practices,
-        how="inner",
-        left_on=["month", "practice_id"],
-        right_on=["month", "practice_id"],
-    )
-
+    joined, dropped = join_practices(get_practice_table(), df)
+    if len(dropped):
+        print(
+            "Dropped {} rows{} for {} practices without metadata for "
+            "their month, most often: {}".format(
+                dropped.sum(),
+                " of {} data".format(lab) if lab else "",
+                len(dropped),
+                ", ".join(dropped.index[:10]),
+            )
+        )
+    return joined
 
-def normalise_and_suppress(lab, merged):
-    """Given a lab id and a file containing all processed data, (a)
-    normalise test codes so they are consistent through time (e.g. the
-    code for HB in one lab might be HB1 in April and change to HB2 in
-    May); (b) do low-number suppression against the entire dataset
 
+def _count(lab, merged):
+    """Normalise the test codes in some combined data, and sum the counts
+    for each month, test code, practice and result category
     """
-    anonymised_results_path = settings.INTERMEDIATE_DIR / "{}processed_{}.csv".format(
-        settings.ENV, lab
-    )
     normalised = _normalise_test_codes(lab, merged)
     # We have to convert these columns to categories *after* all the
     # constituent files have been loaded, as only then are all the
@@ -253,41 +378,247 @@ def normalise_and_suppress(lab, merged):
     normalised["test_code"] = normalised["test_code"].astype(
         CategoricalDtype(ordered=False)
     )
-    if len(normalised):
-        # Aggregate data to produce counts, and suppress low numbers.
-        normalised.loc[:, "count"] = 0
-        aggregated = (
-            normalised.groupby(
-                ["month", "test_code", "practice_id", "result_category"], observed=True
-            )
-            .count()
-            .dropna()
-        ).reset_index()
-        aggregated.loc[
-            aggregated["count"] < settings.SUPPRESS_UNDER, "count"
-        ] = settings.SUPPRESS_STRING
-        aggregated = aggregated[
-            ["month", "test_code", "practice_id", "result_category", "count"]
-        ]
-        aggregated["lab_id"] = lab
-        aggregated = estimate_errors(aggregated)
-        aggregated = trim_trailing_months(aggregated)
-        aggregated = add_practice_metadata(aggregated)
-        aggregated.to_csv(anonymised_results_path, index=False)
-        return anonymised_results_path
+    return sum_counts(
+        normalised, ["month", "test_code", "practice_id", "result_category"]
+    )
+
+
+def _counts_fingerprint(lab):
+    """Return a fingerprint of everything, other than the combined data
+    itself, that a lab's counts depend on
+    """
+    digest = hashlib.sha256(str(COUNTS_VERSION).encode("utf8"))
+    test_code_map = get_test_code_map(lab)
+    if test_code_map is not None:
+        digest.update(json.dumps(sorted(test_code_map.items())).encode("utf8"))
+    return digest.hexdigest()
+
+
+def _month_batches(segments, max_memory):
+    """Split a dict of month to segment paths into lists of months, in
+    order, whose segments have few enough rows in total to be processed
+    in about `max_memory` bytes (but at least one month each), or into a
+    single list of every month if `max_memory` is 0
+    """
+    months = sorted(segments)
+    if not max_memory:
+        return [months] if months else []
+    batches = []
+    batch = []
+    batch_rows = 0
+    for month in months:
+        rows = sum(segment_rows(path) for path in segments[month])
+        if batch and (batch_rows + rows) * BYTES_PER_ROW > max_memory:
+            batches.append(batch)
+            batch = []
+            batch_rows = 0
+        batch.append(month)
+        batch_rows += rows
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def _recount(lab, max_memory=0):
+    """Recount only those months of a lab's combined data, from
+    DATE_FLOOR onwards, whose segments in the combined store have
+    changed since they were last counted (or every month, if the test
+    code mappings have changed), a batch of months at a time (see
+    `_month_batches`). Returns the months counted.
+    """
+    months = _processed_months()
+    segments = {
+        month: paths for month, paths in list_segments(lab).items() if month in months
+    }
+    names = {month: [path.name for path in paths] for month, paths in segments.items()}
+    fingerprint = _counts_fingerprint(lab)
+    manifest = read_counts_manifest(lab)
+    if manifest.get("fingerprint") == fingerprint:
+        counted = manifest["months"]
     else:
-        return None
+        counted = {}
+    stale = {
+        month: paths
+        for month, paths in segments.items()
+        if counted.get(month) != names[month]
+    }
+    if stale:
+        print("Counting {} months of {} data".format(len(stale), lab))
+        # The manifest only ever lists months which have been counted
+        up_to_date = {
+            month: month_names
+            for month, month_names in names.items()
+            if month not in stale
+        }
+        for batch in _month_batches(stale, max_memory):
+            up_to_date.update({month: names[month] for month in batch})
+            replace_counts(
+                lab,
+                _count(lab, read_combined(lab, batch)),
+                batch,
+                {"fingerprint": fingerprint, "months": up_to_date},
+            )
+    return sorted(segments)
 
 
-def make_final_csv():
-    filenames = glob.glob(
-        str(settings.INTERMEDIATE_DIR / "{}processed_*".format(settings.ENV))
+def _output_fingerprint(lab):
+    """Return a fingerprint of everything a lab's processed output depends
+    on: its combined data, the settings used to suppress low numbers,
+    and (if it has any data) its test code mappings and practice metadata
+    """
+    months = _processed_months()
+    segments = []
+    for month, paths in sorted(list_segments(lab).items()):
+        if month in months:
+            for path in paths:
+                stat = os.stat(path)
+                segments.append([path.name, stat.st_size, stat.st_mtime_ns])
+    inputs = {
+        "version": OUTPUT_VERSION,
+        "segments": segments,
+        "settings": [
+            settings.SUPPRESS_UNDER,
+            settings.SUPPRESS_STRING,
+            settings.DATE_FLOOR,
+        ],
+    }
+    # Without any data, nothing is looked up in the rest
+    if segments:
+        inputs["counts"] = _counts_fingerprint(lab)
+        inputs["practices"] = content_hash(practice_codes_path())
+    return hashlib.sha256(json.dumps(inputs).encode("utf8")).hexdigest()
+
+
+def _estimate(lab, aggregated):
+    """Suppress low numbers in a lab's counts, and add error estimates
+    """
+    aggregated.loc[
+        aggregated["count"] < settings.SUPPRESS_UNDER, "count"
+    ] = settings.SUPPRESS_STRING
+    aggregated = aggregated[
+        ["month", "test_code", "practice_id", "result_category", "count"]
+    ]
+    aggregated["lab_id"] = lab
+    return estimate_errors(aggregated)
+
+
+def _suppress(lab, aggregated, monthly_counts=None):
+    """Suppress low numbers in a lab's counts, and add error estimates
+    and practice metadata, leaving out trailing months (see
+    `trim_trailing_months`)
+    """
+    aggregated = trim_trailing_months(_estimate(lab, aggregated), monthly_counts)
+    return _sort_output(add_practice_metadata(aggregated, lab))
+
+
+def _sort_output(df):
+    """Sort output rows into OUTPUT_ORDER, by value
+    """
+
+    def key(column):
+        if column.dtype.name == "category":
+            # Rather than in the order of the categories, which depends
+            # on the batch the rows were read in
+            return column.cat.reorder_categories(sorted(column.cat.categories))
+        return column
+
+    return df.sort_values(OUTPUT_ORDER, key=key, ignore_index=True)
+
+
+def _process_counts(lab, fingerprint, max_memory):
+    """Yield a lab's processed output (see `normalise_and_suppress`), a
+    batch of months at a time, computed from its counts (brought up to
+    date with its combined store), and cache it
+    """
+    months = set(_recount(lab, max_memory))
+    segments = {
+        month: paths
+        for month, paths in list_counts_segments(lab).items()
+        if month in months
+    }
+    batches = _month_batches(segments, max_memory)
+    monthly_counts = None
+    if len(batches) > 1:
+        # Trimming months needs the total count of every month first
+        monthly_counts = pd.concat(
+            [
+                _estimate(lab, read_counts(lab, batch))
+                .groupby("month", observed=True)["count"]
+                .sum()
+                for batch in batches
+            ]
+        )
+    with caching_output(lab, fingerprint) as cache:
+        for batch in batches:
+            aggregated = _categorise_codes(read_counts(lab, batch))
+            if len(aggregated):
+                processed = _suppress(lab, aggregated, monthly_counts)
+                cache.write(processed)
+                yield processed
+
+
+def _slices(df, max_memory):
+    if not max_memory:
+        yield df
+        return
+    rows = max(max_memory // BYTES_PER_ROW, 1)
+    for start in range(0, len(df), rows):
+        yield df.iloc[start : start + rows]
+
+
+def normalise_and_suppress(lab, merged=None, writer=None, max_memory=None):
+    """Given a lab id and a dataframe containing all processed data
+    (or, if not given, the lab's counts, brought up to date with its
+    combined store), (a) normalise test codes so they are consistent
+    through time (e.g. the code for HB in one lab might be HB1 in April
+    and change to HB2 in May); (b) do low-number suppression against
+    the entire dataset. The results are written to a `processed` CSV,
+    or to a `FinalOutputWriter` if given.
+
+    Results computed from the lab's counts are cached (see
+    `output_cache`), and reused until its combined data, test code
+    mappings, practice metadata or suppression settings change.
+
+    If `max_memory` (default MAX_MEMORY) isn't 0, the lab's counts are
+    computed, suppressed and written a batch of months at a time, using
+    about that many bytes of memory.
+
+    """
+    anonymised_results_path = settings.INTERMEDIATE_DIR / "{}processed_{}.csv".format(
+        settings.ENV, lab
     )
-    combined = combine_csvs_to_dataframe(filenames, settings.FINAL_OUTPUT_DTYPES)
-    combined.to_csv(settings.FINAL_DIR / "all_processed.csv.zip", index=False)
-    for filename in filenames:
-        os.remove(filename)
-    return settings.FINAL_DIR / "all_processed.csv.zip"
+    if max_memory is None:
+        max_memory = settings.MAX_MEMORY
+    if merged is None:
+        fingerprint = _output_fingerprint(lab)
+        cached = read_cached_output(lab, fingerprint)
+        if cached is not None:
+            print("Using cached output for {}".format(lab))
+            batches = _slices(cached, max_memory)
+        else:
+            batches = _process_counts(lab, fingerprint, max_memory)
+    else:
+        aggregated = _count(lab, merged)
+        batches = [_suppress(lab, aggregated)] if len(aggregated) else []
+    written = False
+    for processed in batches:
+        if not len(processed):
+            continue
+        if writer:
+            writer.write(processed)
+        else:
+            processed.to_csv(
+                anonymised_results_path,
+                index=False,
+                mode="a" if written else "w",
+                header=not written,
+            )
+        written = True
+    if not written:
+        return None
+    if writer:
+        return writer.path
+    return anonymised_results_path
 
 
 def report_oddness():
@@ -0,0 +1,275 @@
+"""A streaming reader for XLSX files, which parses worksheet XML
+straight from the zip file, rather than building a cell object for
+every value as openpyxl does
+
+"""
+from datetime import datetime, timedelta
+import posixpath
+import re
+import xml.etree.ElementTree as ET
+import zipfile
+
+from openpyxl.styles.numbers import BUILTIN_FORMATS, is_date_format
+
+MAIN_NS = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+RELATIONSHIPS_NS = (
+    "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+)
+
+ROW_TAG = MAIN_NS + "row"
+CELL_TAG = MAIN_NS + "c"
+VALUE_TAG = MAIN_NS + "v"
+INLINE_STRING_TAG = MAIN_NS + "is"
+TEXT_TAG = MAIN_NS + "t"
+RICH_TEXT_TAG = MAIN_NS + "r"
+PHONETIC_TAG = MAIN_NS + "rPh"
+DIMENSION_TAG = MAIN_NS + "dimension"
+
+WINDOWS_EPOCH = datetime(1899, 12, 30)
+MAC_EPOCH = datetime(1904, 1, 1)
+
+BLOCK_SIZE = 1024 * 1024
+
+CELL_REFERENCE_RX = re.compile(r"^\$?([A-Z]+)\$?(\d+)$")
+
+
+def _column_number(letters):
+    number = 0
+    for letter in letters:
+        number = number * 26 + ord(letter) - 64
+    return number
+
+
+def _text_content(element):
+    """Return the text of a shared or inline string, ignoring any
+    formatting and phonetic hints
+    """
+    parts = []
+    for child in element:
+        if child.tag == TEXT_TAG:
+            parts.append(child.text or "")
+        elif child.tag == RICH_TEXT_TAG:
+            parts.append(child.findtext(TEXT_TAG) or "")
+    return "".join(parts)
+
+
+def _from_excel(value, epoch):
+    """Convert an Excel serial date to a datetime (or to a time, for
+    values less than a day)
+    """
+    day, fraction = divmod(value, 1)
+    time = timedelta(milliseconds=round(fraction * 86400000))
+    if 0 <= value < 1 and time.days == 0:
+        return (datetime.min + time).time()
+    # Excel thinks 1900 was a leap year
+    if 0 < value < 60 and epoch == WINDOWS_EPOCH:
+        day += 1
+    return epoch + timedelta(days=day) + time
+
+
+def _relationships(zf, path):
+    """Return a dict of relationship id to (type, target path) for the
+    part at `path`
+    """
+    directory, basename = posixpath.split(path)
+    rels_path = posixpath.join(directory, "_rels", basename + ".rels")
+    if rels_path not in zf.namelist():
+        return {}
+    relationships = {}
+    for rel in ET.fromstring(zf.read(rels_path)):
+        target = rel.get("Target")
+        if target.startswith("/"):
+            target = target[1:]
+        else:
+            target = posixpath.normpath(posixpath.join(directory, target))
+        relationships[rel.get("Id")] = (rel.get("Type").rsplit("/", 1)[-1], target)
+    return relationships
+
+
+def _read_shared_strings(zf, path):
+    strings = []
+    with zf.open(path) as f:
+        for _, element in ET.iterparse(f):
+            if element.tag == MAIN_NS + "si":
+                strings.append(_text_content(element).replace("x005F_", ""))
+                element.clear()
+    return strings
+
+
+def _read_date_styles(zf, path):
+    """Return the set of indexes of cell styles which format numbers as
+    dates
+    """
+    styles = ET.fromstring(zf.read(path))
+    custom_formats = {
+        int(fmt.get("numFmtId")): fmt.get("formatCode")
+        for fmt in styles.iter(MAIN_NS + "numFmt")
+    }
+    cell_xfs = styles.find(MAIN_NS + "cellXfs")
+    if cell_xfs is None:
+        return set()
+    date_styles = set()
+    for index, xf in enumerate(cell_xfs.iter(MAIN_NS + "xf")):
+        format_id = int(xf.get("numFmtId", 0))
+        fmt = custom_formats.get(format_id, BUILTIN_FORMATS.get(format_id))
+        if is_date_format(fmt):
+            date_styles.add(index)
+    return date_styles
+
+
+def _open_active_sheet(zf):
+    """Return the path of the active worksheet, the shared strings, the
+    indexes of date styles, and the date epoch for an open XLSX file
+    """
+    workbook_path = "xl/workbook.xml"
+    for rel in ET.fromstring(zf.read("_rels/.rels")):
+        if rel.get("Type").endswith("/officeDocument"):
+            workbook_path = rel.get("Target").lstrip("/")
+    workbook = ET.fromstring(zf.read(workbook_path))
+    relationships = _relationships(zf, workbook_path)
+    properties = workbook.find(MAIN_NS + "workbookPr")
+    epoch = WINDOWS_EPOCH
+    if properties is not None and properties.get("date1904") in ("1", "true"):
+        epoch = MAC_EPOCH
+    view = workbook.find(MAIN_NS + "bookViews/" + MAIN_NS + "workbookView")
+    active = int(view.get("activeTab", 0)) if view is not None else 0
+    sheets = [
+        relationships[sheet.get(RELATIONSHIPS_NS + "id")][1]
+        for sheet in workbook.iter(MAIN_NS + "sheet")
+    ]
+    strings = []
+    date_styles = set()
+    for rel_type, target in relationships.values():
+        if rel_type == "sharedStrings":
+            strings = _read_shared_strings(zf, target)
+        elif rel_type == "styles":
+            date_styles = _read_date_styles(zf, target)
+    return sheets[active], strings, date_styles, epoch
+
+
+def iter_xlsx_rows(filename):
+    """Yield every row of the active worksheet of an XLSX file as a
+    list of strings, exactly as `str(cell.value)` for each cell from
+    openpyxl's read-only `iter_rows()` (so empty cells are "None", and
+    dates formatted like "2019-01-25 00:00:00"), except that formulas
+    are read as their cached values.
+
+    `filename` need not end with ".xlsx".
+
+    """
+    with zipfile.ZipFile(filename) as zf:
+        sheet_path, strings, date_styles, epoch = _open_active_sheet(zf)
+        target = _SheetTarget(strings, date_styles, epoch)
+        parser = ET.XMLParser(target=target)
+        expected_row = 1
+        with zf.open(sheet_path) as f:
+            for block in iter(lambda: f.read(BLOCK_SIZE), b""):
+                parser.feed(block)
+                # As with openpyxl, rows are padded to the width given
+                # by the sheet's dimensions, and missing rows filled in
+                # with empty ones
+                for row_number, values in target.rows:
+                    if target.max_row is not None and row_number > target.max_row:
+                        return
+                    while expected_row < row_number:
+                        yield ["None"] * (target.width or 0)
+                        expected_row += 1
+                    row_width = target.width or max(values, default=0)
+                    yield [
+                        values.get(column, "None") for column in range(1, row_width + 1)
+                    ]
+                    expected_row = row_number + 1
+                target.rows = []
+        if target.max_row is not None:
+            while expected_row <= target.max_row:
+                yield ["None"] * (target.width or 0)
+                expected_row += 1
+
+
+class _SheetTarget:
+    """An `XMLParser` target which collects the cell values of each
+    worksheet row in `rows`, as a list of (row number, dict of column
+    number to value) tuples
+    """
+
+    def __init__(self, strings, date_styles, epoch):
+        self.strings = strings
+        self.date_styles = date_styles
+        self.epoch = epoch
+        self.width = None
+        self.max_row = None
+        self.rows = []
+        self.row_number = 0
+        self.text = None
+        self.in_phonetic = False
+
+    def start(self, tag, attrib):
+        if tag == CELL_TAG:
+            reference = attrib.get("r")
+            if reference:
+                self.column = _column_number(reference.rstrip("0123456789").lstrip("$"))
+            else:
+                self.column += 1
+            self.data_type = attrib.get("t", "n")
+            self.style = attrib.get("s")
+            self.value = None
+            self.inline = [] if self.data_type == "inlineStr" else None
+        elif tag == VALUE_TAG or (tag == TEXT_TAG and not self.in_phonetic):
+            self.text = []
+        elif tag == ROW_TAG:
+            self.row_number = int(float(attrib.get("r", self.row_number + 1)))
+            self.values = {}
+            self.column = 0
+        elif tag == PHONETIC_TAG:
+            self.in_phonetic = True
+        elif tag == DIMENSION_TAG:
+            match = CELL_REFERENCE_RX.match(attrib.get("ref", "").split(":")[-1])
+            if match:
+                self.width = _column_number(match.group(1))
+                self.max_row = int(match.group(2))
+
+    def data(self, data):
+        if self.text is not None:
+            self.text.append(data)
+
+    def end(self, tag):
+        if tag == CELL_TAG:
+            self.values[self.column] = self._cell_value()
+        elif tag == VALUE_TAG:
+            self.value = "".join(self.text)
+            self.text = None
+        elif tag == TEXT_TAG and self.text is not None:
+            if self.inline is not None:
+                self.inline.append("".join(self.text))
+            self.text = None
+        elif tag == ROW_TAG:
+            self.rows.append((self.row_number, self.values))
+        elif tag == PHONETIC_TAG:
+            self.in_phonetic = False
+
+    def close(self):
+        pass
+
+    def _cell_value(self):
+        data_type = self.data_type
+        if data_type == "inlineStr":
+            return "".join(self.inline) if self.inline else "None"
+        value = self.value
+        if not value:
+            return "None"
+        if data_type == "s":
+            return self.strings[int(value)]
+        elif data_type == "n":
+            if "." in value or "E" in value or "e" in value:
+                number = float(value)
+            else:
+                number = int(value)
+            if self.style and int(self.style) in self.date_styles:
+                return str(_from_excel(number, self.epoch))
+            return str(number)
+        elif data_type == "b":
+            return str(bool(int(value)))
+        elif data_type == "d":
+            return str(datetime.fromisoformat(value.rstrip("Z")))
+        # "str" (a formula's string result) and "e" (an error like "#N/A")
+        return value
@@ -2,17 +2,24 @@ import argparse
 import os
 import sys
 
-from lib.file_processing import process_files
+from lib.file_processing import make_conversion_tasks, run_conversion_tasks
+from lib.final_output import FinalOutputWriter
 from lib.fetchers import get_codes
 from lib.fetchers import get_practices
+from lib.input_cache import list_cache_entries, prune_cache
+from lib import settings
 from lib.whole_file_processing import (
     combine_and_append_csvs,
     normalise_and_suppress,
-    make_final_csv,
 )
 import importlib
 
 
+# A lab configuration which defines all of these is processed a
+# DataFrame at a time, rather than row by row
+CHUNKED_FUNCTIONS = ["chunk_iterator", "drop_unwanted_chunk", "normalise_chunk"]
+
+
 try:
     ModuleNotFoundError
 except NameError:
@@ -73,19 +80,47 @@ def main():
         "fetch", help="Fetch latest versions of metadata files"
     )
     fetch.set_defaults(command=do_fetch)
+    cache = subparsers.add_parser(
+        "cache", help="List (and optionally prune) the cache of parsed input files"
+    )
+    cache.set_defaults(command=do_cache)
+    cache.add_argument(
+        "--prune",
+        help="Remove the least recently used entries until the cache is below "
+        "OPATH_INPUT_CACHE_SIZE (or --max-size) bytes",
+        action="store_true",
+    )
+    cache.add_argument("--max-size", help="Size to prune the cache to", type=int)
     process.add_argument("lab", help="lab", choices=choices)
     process.add_argument("--single-file", help="Process single input file")
     process.add_argument(
         "--no-multiprocessing", help="Use multiprocessing", action="store_true"
     )
+    process.add_argument(
+        "--jobs", help="Number of processes to use (default: one per CPU)", type=int,
+    )
     process.add_argument(
         "--test", help="Use test environment and file-naming", action="store_true"
     )
+    process.add_argument(
+        "--max-memory",
+        help="Process each lab's data a batch of months at a time, using about "
+        "this many bytes (default: OPATH_MAX_MEMORY, or all months at once)",
+        type=int,
+    )
     process.add_argument(
         "--reimport",
         help="Delete existing files and import everything from scratch",
         action="store_true",
     )
+    process.add_argument(
+        "--accept-changed",
+        help="Keep the data already processed from FILE, although it has "
+        "changed since (may be given more than once)",
+        metavar="FILE",
+        action="append",
+        default=[],
+    )
     process.add_argument(
         "--yes",
         help="Avoid prompts by answering 'yes' to any questions",
@@ -103,6 +138,28 @@ def do_fetch(args):
     get_practices()
 
 
+def do_cache(args):
+    if args.prune:
+        max_size = settings.INPUT_CACHE_SIZE if args.max_size is None else args.max_size
+        print("Removed {} entries".format(prune_cache(max_size)))
+    entries = list_cache_entries()
+    for entry in entries:
+        print(
+            "{}  {:>12}  {:%Y-%m-%d %H:%M}  {} ({})".format(
+                entry.key[:16],
+                entry.size,
+                entry.last_used,
+                entry.source,
+                entry.iterator,
+            )
+        )
+    print(
+        "{} entries, {} bytes, in {}".format(
+            len(entries), sum(entry.size for entry in entries), settings.INPUT_CACHE_DIR
+        )
+    )
+
+
 def do_process(args):
     labs = get_lab_configs()
     multiprocessing = not args.no_multiprocessing
@@ -114,9 +171,13 @@ def do_process(args):
         labs_to_process = list(labs.keys())
     else:
         labs_to_process = [args.lab]
+    # Every lab's files go into a single queue, so that one lab's large
+    # files don't leave processes idle while the next lab waits
+    tasks = []
+    failed = []
     for lab in labs_to_process:
         config = labs[lab]
-        print("Processing {lab}".format(lab=lab))
+        print("Queueing {lab}".format(lab=lab))
         if args.single_file:
             files = [args.single_file]
         else:
@@ -126,7 +187,11 @@ def do_process(args):
             convert_to_result = config.convert_to_result
         else:
             convert_to_result = None
-        process_files(
+        chunked_functions = {}
+        if all(hasattr(config, name) for name in CHUNKED_FUNCTIONS):
+            for name in CHUNKED_FUNCTIONS + ["convert_chunk_to_result"]:
+                chunked_functions[name] = getattr(config, name, None)
+        lab_tasks, lab_failed = make_conversion_tasks(
             config.LAB_CODE,
             os.path.join(os.path.dirname(config.__file__), config.REFERENCE_RANGES),
             files,
@@ -134,25 +199,46 @@ def do_process(args):
             config.drop_unwanted_data,
             config.normalise_data,
             convert_to_result,
-            multiprocessing=multiprocessing,
             reimport=args.reimport,
             yes=args.yes,
+            accept_changed=args.accept_changed,
+            split_file=getattr(config, "split_file", None),
+            row_columns=getattr(config, "ROW_COLUMNS", None),
+            **chunked_functions
         )
+        tasks += lab_tasks
+        failed += lab_failed
+    print("Processing {} files or parts of files".format(len(tasks)))
+    failed = sorted(
+        failed
+        + run_conversion_tasks(tasks, multiprocessing=multiprocessing, jobs=args.jobs)
+    )
     # Although we've processed individual labs, we always update / create
     done_something = False
-    for lab in labs.keys():
-        # This creates a `combined` file from `converted` files (and
-        # any existing `combined` file)
-        merged = combine_and_append_csvs(lab)
-        # This creates `processed` files in intermediate folder from
-        # `combined` ones
-        done_something = normalise_and_suppress(lab, merged) or done_something
-    # This merges (and deletes) the `processed` files
-    combined = make_final_csv()
+    # Each lab's results are streamed straight into the final output
+    with FinalOutputWriter() as writer:
+        for lab in labs.keys():
+            # This appends `converted` files to the lab's `combined`
+            # store, rejecting any with data that's already there
+            failed += combine_and_append_csvs(lab)
+            # This suppresses low numbers in the `combined` store and
+            # writes the results to the final output
+            done_something = (
+                normalise_and_suppress(
+                    lab, writer=writer, max_memory=args.max_memory
+                )
+                or done_something
+            )
+    combined = writer.path
     if done_something:
         print("Final data at {}".format(combined))
     else:
         print("No data written")
+    if failed:
+        print("Unable to process these files (see log for details):")
+        for filename in failed:
+            print("  {}".format(filename))
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,43 @@
+import os
+
+from lib import intermediate_file_tracking
+from lib.file_processing import _new_filenames
+from lib.intermediate_file_tracking import get_processed_fingerprints, mark_as_processed
+
+
+def _use_database(tmp_path, monkeypatch):
+    # The database is opened relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(intermediate_file_tracking, "_engines", {})
+
+
+def _write(path, text):
+    path.write_text(text)
+    return str(path)
+
+
+def test_duplicates_are_skipped(tmp_path, monkeypatch):
+    _use_database(tmp_path, monkeypatch)
+    original = _write(tmp_path / "a.csv", "x,y\n1,2\n")
+    mark_as_processed("lab", [(original, "converted_lab_2020_01_01.npz")])
+    copy = _write(tmp_path / "copy of a.csv", "x,y\n1,2\n")
+    new = _write(tmp_path / "b.csv", "x,y\n3,4\n")
+    assert _new_filenames("lab", [original, copy, new]) == ([new], [])
+    # The duplicate is recorded, so it's skipped without being compared
+    assert copy in get_processed_fingerprints("lab")
+    assert _new_filenames("lab", [copy]) == ([], [])
+
+
+def test_changed_files_are_reported_until_accepted(tmp_path, monkeypatch):
+    _use_database(tmp_path, monkeypatch)
+    path = _write(tmp_path / "a.csv", "x,y\n1,2\n")
+    mark_as_processed("lab", [(path, "converted_lab_2020_01_01.npz")])
+    # Touched, but not changed
+    os.utime(path, ns=(0, 0))
+    assert _new_filenames("lab", [path]) == ([], [])
+    assert get_processed_fingerprints("lab")[path].mtime == 0
+    _write(tmp_path / "a.csv", "x,y\n1,3\n")
+    assert _new_filenames("lab", [path]) == ([], [path])
+    assert _new_filenames("lab", [path]) == ([], [path])
+    assert _new_filenames("lab", [path], accept_changed=[path]) == ([], [])
+    assert _new_filenames("lab", [path]) == ([], [])
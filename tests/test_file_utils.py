@@ -0,0 +1,35 @@
+import os
+
+import pytest
+
+from lib.file_utils import atomic_write, memoise_by_mtime
+
+
+def test_atomic_write_replaces_only_on_success(tmp_path):
+    path = tmp_path / "out.txt"
+    with atomic_write(path, "w") as f:
+        f.write("one")
+    with pytest.raises(ValueError):
+        with atomic_write(path, "w") as f:
+            f.write("two")
+            raise ValueError
+    assert path.read_text() == "one"
+    assert os.listdir(tmp_path) == ["out.txt"]
+
+
+def test_memoise_by_mtime(tmp_path):
+    calls = []
+
+    @memoise_by_mtime()
+    def read(filename, suffix):
+        calls.append(filename)
+        with open(filename) as f:
+            return f.read() + suffix
+
+    path = tmp_path / "in.txt"
+    path.write_text("a")
+    assert read(path, "!") == read(str(path), "!") == "a!"
+    assert len(calls) == 1
+    path.write_text("bc")
+    assert read(path, "!") == "bc!"
+    assert calls == [str(path)] * 2
@@ -0,0 +1,75 @@
+import pandas as pd
+
+from data_sources.cornwall import anonymiser_config as cornwall
+from lib import settings
+from lib.input_cache import cached_chunks, cached_rows, list_cache_entries
+
+SOURCE = "data_sources/cornwall/sample.csv.zip"
+
+
+def _use_cache(monkeypatch, tmp_path, chunk_size):
+    monkeypatch.setattr(settings, "INPUT_CACHE_DIR", tmp_path)
+    monkeypatch.setattr(settings, "INPUT_CACHE_SIZE", 10 ** 9)
+    monkeypatch.setattr(settings, "CHUNK_SIZE", chunk_size)
+
+
+def test_cached_rows_round_trip(monkeypatch, tmp_path):
+    _use_cache(monkeypatch, tmp_path, 3)
+    calls = []
+
+    def row_iterator(source):
+        calls.append(source)
+        for i in range(7):
+            yield {"a": str(i), "b": "x" if i % 2 else "", "c": "y"}
+
+    missed = list(cached_rows(row_iterator, SOURCE, columns=["b", "a"]))
+    [entry] = list_cache_entries()
+    hit = list(cached_rows(row_iterator, SOURCE, columns=["b", "a"]))
+    assert len(calls) == 1
+    assert hit == missed
+    assert [list(row) for row in hit] == [["b", "a"]] * 7
+    assert missed[3] == {"b": "x", "a": "3"}
+
+
+def test_uncacheable_and_unfinished_rows_are_not_cached(monkeypatch, tmp_path):
+    _use_cache(monkeypatch, tmp_path, 2)
+
+    def row_iterator(source):
+        yield {"a": "1"}
+        yield {"a": "2"}
+        yield {"a": 3}
+
+    assert [row["a"] for row in cached_rows(row_iterator, SOURCE)] == ["1", "2", 3]
+    rows = cached_rows(lambda source: iter([{"a": "1"}, {"a": "2"}]), SOURCE)
+    next(rows)
+    rows.close()
+    assert list_cache_entries() == []
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_cached_chunks_round_trip(monkeypatch, tmp_path):
+    _use_cache(monkeypatch, tmp_path, 2)
+
+    def chunk_iterator(source):
+        yield pd.DataFrame({"a": ["1", "2"], "b": ["x", ""]})
+        yield pd.DataFrame({"a": ["3"], "b": ["y"]}, index=pd.RangeIndex(2, 3))
+
+    missed = list(cached_chunks(chunk_iterator, SOURCE))
+    hit = list(cached_chunks(chunk_iterator, SOURCE))
+    assert len(list_cache_entries()) == 1
+    assert len(hit) == 2
+    for expected, chunk in zip(missed, hit):
+        pd.testing.assert_frame_equal(chunk, expected, check_dtype=False)
+
+
+def test_cached_lab_rows_round_trip(monkeypatch, tmp_path):
+    # With chunks smaller than the file
+    _use_cache(monkeypatch, tmp_path, 4)
+    uncached = list(cornwall.row_iterator(SOURCE))
+    columns = cornwall.ROW_COLUMNS
+    expected = [{column: row[column] for column in columns} for row in uncached]
+    missed = list(cached_rows(cornwall.row_iterator, SOURCE, columns))
+    assert len(list_cache_entries()) == 1
+    hit = list(cached_rows(cornwall.row_iterator, SOURCE, columns))
+    assert len(expected) > 4
+    assert missed == hit == expected
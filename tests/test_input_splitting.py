@@ -0,0 +1,24 @@
+import csv
+
+from lib import input_splitting
+from lib.input_splitting import iter_csv_lines, split_csv
+
+
+def test_split_csv_never_splits_quoted_newlines(tmp_path, monkeypatch):
+    # Small blocks, so records and quoted fields span blocks too
+    monkeypatch.setattr(input_splitting, "BLOCK_SIZE", 7)
+    rows = [["id", "note"]] + [
+        [str(i), "line\none" if i % 3 else 'say ""hi""\n\nbye'] for i in range(50)
+    ]
+    path = tmp_path / "in.csv"
+    with open(path, "w", newline="") as f:
+        csv.writer(f, lineterminator="\n").writerows(rows)
+    for part_size in [1, 10, 45, 10 ** 6]:
+        parts = split_csv(str(path), part_size)
+        assert len(parts) > 1 or part_size == 10 ** 6
+        read = rows[:1]
+        for part in parts:
+            part_rows = list(csv.reader(iter_csv_lines(part)))
+            assert part_rows[0] == rows[0]
+            read.extend(part_rows[1:])
+        assert read == rows
@@ -0,0 +1,56 @@
+from collections import Counter
+
+import numpy as np
+
+from lib import settings
+from lib.intermediate_format import (
+    DictionaryEncoder,
+    counts_to_dataframe,
+    read_intermediate_file,
+    write_intermediate_file,
+    write_npz,
+)
+
+
+def test_uncategorised_results_are_dropped(tmp_path):
+    # `convert_to_result` gives a result category of None for results
+    # it can't categorise, which mustn't be read back as within range
+    month = settings.INTERMEDIATE_OUTPUT_DTYPES["month"].categories[0]
+    counts = Counter(
+        {
+            (month, "HB", "P1", 0): 2,
+            (month, "HB", "P1", None): 3,
+            (month, "K", "P2", -1): 1,
+        }
+    )
+    path = tmp_path / "converted.npz"
+    write_intermediate_file(path, counts_to_dataframe(counts))
+    df = read_intermediate_file(path)
+    rows = set(
+        zip(
+            df["month"].astype(str),
+            df["test_code"].astype(str),
+            df["practice_id"].astype(str),
+            df["result_category"].astype(int),
+            df["count"],
+        )
+    )
+    assert rows == {(month, "HB", "P1", 0, 2), (month, "K", "P2", -1, 1)}
+
+
+def test_dictionary_encoder_keeps_codes_across_chunks():
+    encoder = DictionaryEncoder()
+    assert list(encoder.encode(["b", "a", None, "b"])) == [0, 1, -1, 0]
+    assert list(encoder.encode(["c", "a"])) == [2, 1]
+    assert list(encoder.categories()) == ["b", "a", "c"]
+
+
+def test_write_npz_is_read_by_numpy(tmp_path):
+    arrays = {"a": np.arange(3, dtype=np.int16), "b": np.array(["x", "yz"])}
+    for compress in [False, True]:
+        write_npz(tmp_path / "arrays.npz", arrays, compress=compress)
+        with np.load(tmp_path / "arrays.npz") as f:
+            assert f.files == ["a", "b"]
+            for name, array in arrays.items():
+                assert f[name].dtype == array.dtype
+                assert np.array_equal(f[name], array)
@@ -0,0 +1,19 @@
+import logging
+
+from lib import logger, settings
+
+
+def test_only_row_level_messages_are_sampled(caplog, monkeypatch):
+    monkeypatch.setattr(settings, "LOG_SAMPLE_RATE", 3)
+    monkeypatch.setattr(settings, "LOG_SUMMARY_INTERVAL", 10 ** 6)
+    with caplog.at_level(logging.INFO):
+        for i in range(6):
+            logger.log_warning({"row": i}, "Bad row")
+            logger.log_info({}, "Reading file %s", i)
+            logger.log_error({"row": i}, "Very bad row")
+        logger.log_summary()
+    messages = [record.getMessage() for record in caplog.records]
+    assert len([m for m in messages if m.startswith("Bad row")]) == 2
+    assert len([m for m in messages if m.startswith("Reading file")]) == 6
+    assert len([m for m in messages if m.startswith("Very bad row")]) == 6
+    assert "4 more rows not logged (1 in 3 logged): Bad row" in messages
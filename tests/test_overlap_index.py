@@ -0,0 +1,91 @@
+import numpy as np
+import pandas as pd
+
+from data_sources.cornwall import anonymiser_config as cornwall
+from lib import settings
+from lib.chunked_file_processing import convert_part_in_chunks
+from lib.combined_store import append_segments
+from lib.intermediate_file_processing import convert_part
+from lib.intermediate_format import read_fingerprints, write_intermediate_file
+from lib.overlap_index import OverlapIndex, fingerprint_sources, is_rejected
+
+SAMPLE = "data_sources/cornwall/sample.csv.zip"
+
+
+def _counts(month):
+    return pd.DataFrame(
+        [(month, "HB", "P1", 0, 2), (month, "K", "P2", -1, 1)],
+        columns=settings.REQUIRED_NORMALISED_KEYS + ["count"],
+    )
+
+
+def test_rows_and_chunks_have_the_same_fingerprints(monkeypatch):
+    monkeypatch.setattr(settings, "INPUT_CACHE_SIZE", 0)
+    monkeypatch.setattr(settings, "DATE_FLOOR", "2010/01/01")
+    by_rows = convert_part(
+        "",
+        cornwall.row_iterator,
+        cornwall.drop_unwanted_data,
+        cornwall.normalise_data,
+        SAMPLE,
+        row_columns=cornwall.ROW_COLUMNS,
+    )
+    by_chunks = convert_part_in_chunks(
+        "",
+        cornwall.chunk_iterator,
+        cornwall.drop_unwanted_chunk,
+        cornwall.normalise_chunk,
+        SAMPLE,
+    )
+    assert by_rows.fingerprints
+    assert by_rows.fingerprints.keys() == by_chunks.fingerprints.keys()
+    for month, values in by_rows.fingerprints.items():
+        assert np.array_equal(values, by_chunks.fingerprints[month])
+
+
+def test_fingerprints_ignore_column_order_and_uncounted_results():
+    sources = pd.DataFrame({"a": ["1", "2", "3"], "b": ["x", "y", "z"]})
+    months = ["2020/01/01", "2020/01/01", "2020/02/01"]
+    fingerprints = fingerprint_sources(sources, months, [0, None, 1])
+    reordered = fingerprint_sources(
+        sources[["b", "a"]].iloc[[0, 2]], months[::2], [0, 1]
+    )
+    assert {month: list(values) for month, values in fingerprints.items()} == {
+        month: list(values) for month, values in reordered.items()
+    }
+    assert [len(values) for values in fingerprints.values()] == [1, 1]
+
+
+def test_fingerprints_are_kept_in_intermediate_files(tmp_path):
+    month = settings.INTERMEDIATE_OUTPUT_DTYPES["month"].categories[0]
+    fingerprints = {month: np.array([3, 1, 2], dtype=np.uint64)}
+    path = tmp_path / "converted.npz"
+    write_intermediate_file(path, _counts(month), fingerprints)
+    assert list(read_fingerprints(path)[month]) == [1, 2, 3]
+    write_intermediate_file(path, _counts(month))
+    assert read_fingerprints(path) == {}
+
+
+def test_appended_results_overlap(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "INTERMEDIATE_DIR", tmp_path)
+    month = settings.INTERMEDIATE_OUTPUT_DTYPES["month"].categories[0]
+    appended = np.arange(100, dtype=np.uint64)
+    append_segments("lab", _counts(month), "1", {month: appended})
+
+    index = OverlapIndex("lab")
+    [overlap] = index.check("again", {month: appended[:50]})
+    assert (overlap.results, overlap.overlapping) == (50, 50)
+    assert is_rejected(overlap)
+    # A few coincidental matches are only reported
+    new = np.arange(95, 200, dtype=np.uint64)
+    [overlap] = index.check("new", {month: new})
+    assert (overlap.results, overlap.overlapping) == (105, 5)
+    assert not is_rejected(overlap)
+    # Later files are checked against earlier ones
+    index.add({month: new})
+    [overlap] = index.check("new again", {month: new})
+    assert is_rejected(overlap)
+
+    # Segments of a batch which is about to be appended again are ignored
+    [overlap] = OverlapIndex("lab", pending={"1"}).check("again", {month: appended})
+    assert overlap.overlapping == 0
@@ -0,0 +1,38 @@
+import csv
+import logging
+
+from benchmarks.ref_ranges import make_rows, rows_to_columns, scan_convert_to_result
+from lib.intermediate_file_processing import get_ref_ranges, standard_convert_to_result
+from lib.result_classification import classify_results, get_ref_range_table
+
+# Overlapping bands (the first applies), a band without bounds, one
+# without bounds for F, and a gap between bands
+REFERENCE_RANGES = """test,min_adult_age,max_adult_age,low_F,low_M,high_F,high_M
+HB,18,65,115,130,165,180
+HB,60,120,110,125,160,175
+HB,0,18,,,,
+NA,20,50,,135,,145
+NA,60,120,133,133,146,146
+CRP,0,120,0,0,5,5
+"""
+
+
+def test_lookups_agree_with_a_scan_of_every_range(tmp_path):
+    path = tmp_path / "ranges.csv"
+    path.write_text(REFERENCE_RANGES)
+    with open(path, newline="") as f:
+        lines = sorted(csv.DictReader(f), key=lambda line: line["test"])
+    # Boundary ages, NaN ages and results, and every kind of invalid row
+    rows = make_rows(lines, 5000)
+    ranges = get_ref_ranges(str(path))
+    categories = classify_results(
+        get_ref_range_table(str(path)), **rows_to_columns(rows)
+    )
+    logging.disable(logging.WARNING)
+    try:
+        for row, category in zip(rows, categories):
+            expected = scan_convert_to_result(dict(row), lines)["result_category"]
+            actual = standard_convert_to_result(dict(row), ranges)["result_category"]
+            assert (actual, category) == (expected, expected), row
+    finally:
+        logging.disable(logging.NOTSET)
@@ -0,0 +1,76 @@
+import io
+
+import numpy as np
+import pandas as pd
+
+from lib import settings
+from lib.combined_store import append_segments
+from lib.whole_file_processing import (
+    _output_fingerprint,
+    normalise_and_suppress,
+    remove_orphaned_files,
+)
+
+
+def test_remove_orphaned_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "INTERMEDIATE_DIR", tmp_path)
+    monkeypatch.setattr(settings, "ENV", "")
+    names = [
+        "converted_lab_2020_01_01.npz",
+        "converted_lab_2020_02_01.npz",
+        "converted_lab_2020_03_01.csv",
+        "converted_other_2020_01_01.npz",
+    ]
+    for name in names:
+        (tmp_path / name).touch()
+    remove_orphaned_files("lab", {"1": [str(tmp_path / names[1])]})
+    assert sorted(path.name for path in tmp_path.iterdir()) == names[1::2]
+
+
+def test_output_fingerprint_of_a_lab_without_data(tmp_path, monkeypatch):
+    # Neither test codes nor practice metadata are needed
+    monkeypatch.setattr(settings, "INTERMEDIATE_DIR", tmp_path)
+    monkeypatch.setattr(settings, "FINAL_DIR", tmp_path / "missing")
+    assert _output_fingerprint("lab") == _output_fingerprint("lab")
+
+
+def _processed(directory, monkeypatch, max_memory):
+    """Return the output of `normalise_and_suppress` for a small store,
+    as it's computed with `max_memory`
+    """
+    monkeypatch.setattr(settings, "INTERMEDIATE_DIR", directory)
+    monkeypatch.setattr(settings, "FINAL_DIR", directory)
+    months = list(settings.INTERMEDIATE_OUTPUT_DTYPES["month"].categories[:7])
+    practices = ["P{}".format(i) for i in range(4)]
+    state = np.random.RandomState(0)
+    rows = [
+        (month, test_code, practice, category, state.randint(1, 20))
+        for month in months[:-1]
+        for test_code in ["HB", "K", "CRP"]
+        for practice in practices
+        for category in [-1, 0, 1]
+    ]
+    # A month with too few results, which is trimmed
+    rows.append((months[-1], "HB", "P0", 0, 1))
+    counts = pd.DataFrame(rows, columns=settings.REQUIRED_NORMALISED_KEYS + ["count"])
+    append_segments("cambridge", counts, "1")
+    pd.DataFrame(
+        [
+            ("CCG{}".format(i % 2), practice, practice, month.replace("/", "-"), i)
+            for i, practice in enumerate(practices)
+            for month in months
+        ],
+        columns=["ccg_id", "practice_id", "practice_name", "month", "total_list_size"],
+    ).to_csv(directory / "practice_codes.csv", index=False)
+    return normalise_and_suppress("cambridge", max_memory=max_memory).read_bytes()
+
+
+def test_batched_output_is_the_same(tmp_path, monkeypatch):
+    unbatched = _processed(tmp_path / "unbatched", monkeypatch, 0)
+    # A month at a time
+    batched = _processed(tmp_path / "batched", monkeypatch, 1)
+    assert batched == unbatched
+    df = pd.read_csv(io.BytesIO(unbatched), dtype=str, na_filter=False)
+    assert df["month"].nunique() == 6
+    keys = ["month", "test_code", "practice_id", "result_category"]
+    assert df[keys].equals(df[keys].sort_values(keys))
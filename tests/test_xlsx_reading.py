@@ -0,0 +1,24 @@
+import datetime
+
+from openpyxl import Workbook
+
+from benchmarks.xlsx_reading import SAMPLES, openpyxl_rows
+from lib.xlsx_reading import iter_xlsx_rows
+
+
+def test_samples_are_read_as_openpyxl_reads_them():
+    for path in SAMPLES:
+        assert list(iter_xlsx_rows(path)) == openpyxl_rows(path)
+
+
+def test_cell_types_are_read_as_openpyxl_reads_them(tmp_path):
+    workbook = Workbook()
+    sheet = workbook.active
+    sheet.append(["name", "count", "value", "taken", "flag"])
+    sheet.append(["a", 1, 2.5, datetime.datetime(2020, 1, 31, 9, 30), True])
+    sheet.append(["b", None, -0.1, datetime.date(2019, 12, 1), False])
+    sheet.append([None, 3, None, None, None])
+    sheet["G6"] = "gap"
+    path = tmp_path / "cells.xlsx"
+    workbook.save(path)
+    assert list(iter_xlsx_rows(str(path))) == openpyxl_rows(str(path))